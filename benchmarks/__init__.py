@@ -0,0 +1,16 @@
+# -*- coding: utf-8
+"""Benchmarks for the hot paths of the Elasticsearch 5 backend.
+
+The benchmark classes follow the asv conventions (``setup`` plus ``time_*``
+methods) and can be run with asv or with ``python -m benchmarks.run``.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import os
+import sys
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+django.setup()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import random
+
+from haystack import connections
+
+from haystack_es.fields import GeometryField, NestedField
+
+from . import fixtures
+
+
+class NestedConvert(object):
+
+    def setup(self):
+        self.field = NestedField()
+        self.variants = fixtures.make_variants(random.Random(fixtures.SEED))
+
+    def time_convert_200_variants(self):
+        self.field.convert([dict(v) for v in self.variants])
+
+
+class GeometryPrepare(object):
+
+    def setup(self):
+        try:
+            from django.contrib.gis.geos import Polygon
+            self.polygon = Polygon.from_bbox((0, 0, 10, 10))
+        except Exception:
+            # asv convention for skipping a benchmark, GEOS is not available.
+            raise NotImplementedError('GEOS is required')
+        self.field = GeometryField(model_attr='shape')
+
+    def time_prepare_polygon(self):
+        self.field.convert(self.field.prepare(self))
+
+    @property
+    def shape(self):
+        return self.polygon
+
+
+class BulkPrepare(object):
+
+    def setup(self):
+        from tests.models import Product
+
+        self.index = connections['default'].get_unified_index().get_index(Product)
+        self.backend = connections['default'].get_backend()
+        self.products = fixtures.products()
+
+    def time_full_prepare_10k(self):
+        from_python = self.backend._from_python
+        for obj in self.products:
+            prepped = self.index.full_prepare(obj)
+            dict((k, from_python(v)) for k, v in prepped.items())
@@ -0,0 +1,48 @@
+# -*- coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import threading
+import tracemalloc
+
+from haystack import connections
+from haystack.utils.loading import UnifiedIndex
+
+
+class PerThreadIndexMemory(object):
+    """Memory allocated for the search indexes by each new worker thread."""
+
+    unit = 'bytes'
+    threads = 16
+
+    def setup(self):
+        connections['memory'].get_unified_index().get_indexes()
+
+    def measure(self, load):
+        kept = []
+
+        def worker():
+            unified_index = load()
+            # Touching an index runs the ``threading.local`` initialization.
+            kept.extend((unified_index, index.fields) for index in unified_index.get_indexes().values())
+
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            for _ in range(self.threads):
+                thread = threading.Thread(target=worker)
+                thread.start()
+                thread.join()
+            return (tracemalloc.get_traced_memory()[0] - before) // self.threads
+        finally:
+            tracemalloc.stop()
+
+    def track_shared_unified_index(self):
+        return self.measure(lambda: connections['memory'].get_unified_index())
+
+    def track_per_thread_unified_index(self):
+        # What haystack's ``BaseEngine`` does, a unified index per thread.
+        def load():
+            unified_index = UnifiedIndex()
+            unified_index.build()
+            return unified_index
+        return self.measure(load)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from haystack import connections
+
+from . import fixtures
+
+
+class BuildSearchKwargs(object):
+
+    def setup(self):
+        self.backend = connections['default'].get_backend()
+        self.values = fixtures.filter_values()
+        self.facets = dict(('facet_%s' % i, {}) for i in range(fixtures.FACET_BUCKETS))
+
+    def time_terms_filter_1k_values(self):
+        self.backend.build_search_kwargs('product', filter_context=[{'category__in': self.values}])
+
+    def time_exact_filters_1k(self):
+        self.backend.build_search_kwargs(
+            'product', filter_context=[{'category__exact': v} for v in self.values])
+
+    def time_nested_filters(self):
+        self.backend.build_search_kwargs(
+            'product', filter_context=[{'variants>color__exact': 'red'}, {'variants>size__exact': 'xl'}])
+
+    def time_facets_50(self):
+        self.backend.build_search_kwargs('*:*', facets=dict((k, {}) for k in self.facets))
+
+
+class ChainedFilters(object):
+    """Building the query of a long chain of ``.filter()`` calls."""
+
+    def setup(self):
+        from haystack_es.query import SearchQuerySet
+
+        self.sqs = SearchQuerySet()
+        for i in range(50):
+            self.sqs = self.sqs.filter(**{'category__exact': 'value-%s' % i})
+
+    def time_build_params_50_filters(self):
+        query = self.sqs.filter(price__gte=10).query
+        query.backend.build_search_kwargs(query.build_query(), **query.build_params())
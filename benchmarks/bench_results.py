@@ -0,0 +1,62 @@
+# -*- coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from haystack import connections
+
+from haystack_es.backends import Elasticsearch5SearchBackend
+from haystack_es.memory import InMemorySearchBackend
+from haystack_es.models import LazySearchResult
+
+from . import fixtures
+from .stub_server import StubServer
+
+
+class ProcessResults(object):
+
+    def setup(self):
+        self.backend = connections['default'].get_backend()
+        self.page = fixtures.search_response()
+        self.facets = fixtures.facet_response()
+
+    def time_page_500_hits(self):
+        self.backend._process_results(self.page)
+
+    def time_page_500_hits_lazy(self):
+        self.backend._process_results(self.page, result_class=LazySearchResult)
+
+    def time_facets_50_buckets(self):
+        self.backend._process_results(self.facets)
+
+
+class SearchStubServer(object):
+    """Full ``search`` round trips against a local stub HTTP server."""
+
+    def setup(self):
+        self.server = StubServer(fixtures.search_response()).start()
+        self.backend = Elasticsearch5SearchBackend('default', URL=self.server.url,
+                                                   INDEX_NAME='test_haystack_es')
+        self.backend.setup_complete = True
+
+    def teardown(self):
+        self.server.stop()
+
+    def time_search_500_hits(self):
+        self.backend.search('product', start_offset=0, end_offset=fixtures.PAGE_HITS)
+
+
+class SearchInMemory(object):
+    """Full ``search`` calls through the in-memory engine, without any HTTP."""
+
+    def setup(self):
+        from tests.models import Product
+
+        self.backend = InMemorySearchBackend('default', INDEX_NAME='benchmarks')
+        self.backend.clear()
+        index = connections['default'].get_unified_index().get_index(Product)
+        self.backend.update(index, fixtures.products(fixtures.PAGE_HITS * 2))
+
+    def time_search_500_hits(self):
+        self.backend.search('*:*', start_offset=0, end_offset=fixtures.PAGE_HITS)
+
+    def time_facets_50_buckets(self):
+        self.backend.search('*:*', start_offset=0, end_offset=1, facets={'category': {'size': 50}})
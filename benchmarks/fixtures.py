@@ -0,0 +1,103 @@
+# -*- coding: utf-8
+"""Recorded Elasticsearch responses and documents used by the benchmarks.
+
+Responses are generated from a fixed seed so every run works on identical
+data and results stay comparable over time.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import random
+from datetime import datetime, timedelta
+
+SEED = 2017
+FILTER_VALUES = 1000
+PAGE_HITS = 500
+FACET_BUCKETS = 50
+BULK_DOCUMENTS = 10000
+NESTED_VARIANTS = 200
+
+
+def make_variants(rnd, count=NESTED_VARIANTS):
+    return [
+        {
+            'sku': 'sku-%s' % i,
+            'color': rnd.choice(['red', 'green', 'blue', 'black']),
+            'size': rnd.choice(['s', 'm', 'l', 'xl']),
+            'price': round(rnd.uniform(1, 500), 2),
+            'released': datetime(2017, 1, 1) + timedelta(days=i),
+        }
+        for i in range(count)
+    ]
+
+
+def filter_values(count=FILTER_VALUES):
+    return ['value-%s' % i for i in range(count)]
+
+
+def search_response(hits=PAGE_HITS, seed=SEED):
+    rnd = random.Random(seed)
+    return {
+        'took': 12,
+        'timed_out': False,
+        '_shards': {'total': 5, 'successful': 5, 'failed': 0},
+        'hits': {
+            'total': hits * 10,
+            'max_score': 1.0,
+            'hits': [
+                {
+                    '_index': 'test_haystack_es',
+                    '_type': 'modelresult',
+                    '_id': 'tests.product.%s' % i,
+                    '_score': rnd.random(),
+                    '_source': {
+                        'id': 'tests.product.%s' % i,
+                        'django_ct': 'tests.product',
+                        'django_id': str(i),
+                        'text': 'product %s' % i,
+                        'name': 'product %s' % i,
+                        'category': 'category %s' % rnd.randint(0, FACET_BUCKETS),
+                        'price': round(rnd.uniform(1, 500), 2),
+                        'created': (datetime(2017, 1, 1) + timedelta(minutes=i)).isoformat(),
+                        'attributes': {'brand': 'brand %s' % rnd.randint(0, 20), 'rating': rnd.randint(1, 5)},
+                        'variants': [
+                            dict(v, released=v['released'].isoformat()) for v in make_variants(rnd, 5)
+                        ],
+                    },
+                }
+                for i in range(hits)
+            ],
+        },
+    }
+
+
+def facet_response(buckets=FACET_BUCKETS, seed=SEED):
+    rnd = random.Random(seed)
+    response = search_response(hits=0, seed=seed)
+    response['aggregations'] = {
+        'category': {
+            'doc_count_error_upper_bound': 0,
+            'sum_other_doc_count': 0,
+            'buckets': [
+                {'key': 'category %s' % i, 'doc_count': rnd.randint(1, 1000)} for i in range(buckets)
+            ],
+        },
+        'created_haystack_date_histogram': {
+            'meta': {'_type': 'haystack_date_histogram'},
+            'buckets': [
+                {'key': 1483228800000 + i * 86400000, 'doc_count': rnd.randint(1, 1000)}
+                for i in range(buckets)
+            ],
+        },
+    }
+    return response
+
+
+def products(count=BULK_DOCUMENTS, seed=SEED):
+    from tests.models import Product
+
+    rnd = random.Random(seed)
+    return [
+        Product(pk=i, name='product %s' % i, category='category %s' % rnd.randint(0, FACET_BUCKETS),
+                price=round(rnd.uniform(1, 500), 2), created=datetime(2017, 1, 1) + timedelta(minutes=i))
+        for i in range(count)
+    ]
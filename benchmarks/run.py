@@ -0,0 +1,123 @@
+# -*- coding: utf-8
+"""Runs the benchmarks and records the results.
+
+Usage::
+
+    python -m benchmarks.run [--filter NAME] [--output FILE] [--compare FILE]
+
+Each ``time_*`` method is timed with ``timeit`` (best of ``--repeat`` runs).
+``track_*`` methods return the value to record themselves, in the ``unit`` of
+their class.
+Results are written as JSON together with the interpreter and package
+versions so runs can be compared with ``--compare``.
+"""
+from __future__ import unicode_literals, absolute_import, print_function
+
+import argparse
+import importlib
+import inspect
+import json
+import os
+import platform
+import sys
+import timeit
+from datetime import datetime
+
+import django
+import elasticsearch
+import haystack
+
+import haystack_es
+
+from . import fixtures
+
+MODULES = ['bench_query', 'bench_results', 'bench_fields', 'bench_indexes']
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.benchmarks')
+
+
+def collect(name_filter=None):
+    for module_name in MODULES:
+        module = importlib.import_module('benchmarks.%s' % module_name)
+        for class_name, klass in inspect.getmembers(module, inspect.isclass):
+            if klass.__module__ != module.__name__:
+                continue
+            for method_name in sorted(dir(klass)):
+                if not method_name.startswith(('time_', 'track_')):
+                    continue
+                name = '%s.%s.%s' % (module_name, class_name, method_name)
+                if name_filter and name_filter not in name:
+                    continue
+                yield name, klass, method_name
+
+
+def run_benchmark(klass, method_name, repeat):
+    bench = klass()
+    try:
+        if hasattr(bench, 'setup'):
+            bench.setup()
+    except NotImplementedError:
+        return None
+    try:
+        func = getattr(bench, method_name)
+        if method_name.startswith('track_'):
+            return func()
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange() if hasattr(timer, 'autorange') else (1, None)
+        return min(timer.repeat(repeat=repeat, number=number)) / number
+    finally:
+        if hasattr(bench, 'teardown'):
+            bench.teardown()
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'django': django.get_version(),
+        'haystack': '.'.join(str(v) for v in haystack.__version__),
+        'elasticsearch': '.'.join(str(v) for v in elasticsearch.VERSION),
+        'haystack_es': haystack_es.__version__,
+        'seed': fixtures.SEED,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the django-haystack-es benchmarks.')
+    parser.add_argument('--filter', help='Only run benchmarks whose name contains this string.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='Result file, defaults to .benchmarks/<timestamp>.json')
+    parser.add_argument('--compare', help='Previous result file to compare against.')
+    args = parser.parse_args(argv)
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+
+    results = {}
+    for name, klass, method_name in collect(args.filter):
+        value = run_benchmark(klass, method_name, args.repeat)
+        results[name] = value
+        if value is None:
+            print('%-60s skipped' % name)
+            continue
+        if method_name.startswith('track_'):
+            line = '%-60s %10d %s' % (name, value, getattr(klass, 'unit', ''))
+        else:
+            line = '%-60s %10.3fms' % (name, value * 1000)
+        if previous.get(name):
+            line += '  %.2fx' % (value / previous[name])
+        print(line)
+
+    output = args.output
+    if output is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, '%s.json' % datetime.utcnow().strftime('%Y%m%dT%H%M%S'))
+    with open(output, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2, sort_keys=True)
+    print('Results written to %s' % output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
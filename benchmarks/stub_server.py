@@ -0,0 +1,64 @@
+# -*- coding: utf-8
+"""A local HTTP server which answers every request with a recorded response.
+
+It lets the benchmarks exercise the full ``search`` path, including transport
+and JSON (de)serialization, without a running Elasticsearch cluster.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import json
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        body = self.server.response_body
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_HEAD = do_DELETE = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, response=None, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), StubHandler)
+        self.set_response(response or {})
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s/' % self.server_address
+
+    def set_response(self, response):
+        self.response_body = json.dumps(response).encode('utf-8')
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8
+"""Server-side aggregations for ``SearchQuerySet.aggregate``.
+
+Each aggregation compiles to the query DSL sent by ``build_search_kwargs`` and
+parses its part of the response to a plain python value::
+
+    SearchQuerySet().aggregate(price=Stats('price'), sellers=Cardinality('seller'))
+    {'price': StatsResult(count=25, min=0.0, max=24.0, avg=12.0, sum=300.0), 'sellers': 7}
+"""
+
+from collections import OrderedDict, namedtuple
+
+__all__ = ['Aggregation', 'Stats', 'ExtendedStats', 'Cardinality', 'Percentiles', 'Histogram',
+           'Nested', 'GeohashGrid', 'GeoBounds', 'GeoCentroid', 'StatsResult', 'ExtendedStatsResult',
+           'HistogramBucket', 'NestedResult', 'GeohashBucket', 'GeoBoundsResult', 'GeoCentroidResult']
+
+StatsResult = namedtuple('StatsResult', ['count', 'min', 'max', 'avg', 'sum'])
+ExtendedStatsResult = namedtuple('ExtendedStatsResult', [
+    'count', 'min', 'max', 'avg', 'sum', 'sum_of_squares', 'variance', 'std_deviation',
+    'std_deviation_bounds'])
+HistogramBucket = namedtuple('HistogramBucket', ['key', 'doc_count', 'aggregations'])
+NestedResult = namedtuple('NestedResult', ['doc_count', 'aggregations'])
+GeohashBucket = namedtuple('GeohashBucket', ['key', 'doc_count', 'aggregations'])
+# Corners as ``(lat, lon)`` tuples.
+GeoBoundsResult = namedtuple('GeoBoundsResult', ['top_left', 'bottom_right'])
+GeoCentroidResult = namedtuple('GeoCentroidResult', ['lat', 'lon'])
+
+
+def _parse_aggregations(aggregations, raw_results):
+    return dict((name, aggregation.parse(raw_results[name]))
+                for name, aggregation in aggregations.items() if name in raw_results)
+
+
+class Aggregation(object):
+    """Base class of the aggregations, ``type`` is the ES aggregation name.
+
+    ``field`` is the index field name, use the ``.raw`` sub-field of analyzed
+    text fields.
+    """
+
+    type = None
+
+    def __init__(self, field, **options):
+        self.field = field
+        self.options = options
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.field)
+
+    def to_dict(self):
+        body = dict(self.options)
+        body['field'] = self.field
+        return {self.type: body}
+
+    def parse(self, raw_result):
+        raise NotImplementedError
+
+
+class Stats(Aggregation):
+    type = 'stats'
+
+    def parse(self, raw_result):
+        return StatsResult(*[raw_result.get(name) for name in StatsResult._fields])
+
+
+class ExtendedStats(Aggregation):
+    type = 'extended_stats'
+
+    def parse(self, raw_result):
+        values = [raw_result.get(name) for name in ExtendedStatsResult._fields[:-1]]
+        bounds = raw_result.get('std_deviation_bounds') or {}
+        return ExtendedStatsResult(*values + [(bounds.get('lower'), bounds.get('upper'))])
+
+
+class Cardinality(Aggregation):
+    """Approximate count of distinct values."""
+
+    type = 'cardinality'
+
+    def parse(self, raw_result):
+        return raw_result.get('value')
+
+
+class Percentiles(Aggregation):
+    """Returns an ordered mapping of percent to value."""
+
+    type = 'percentiles'
+
+    def __init__(self, field, percents=None, **options):
+        if percents is not None:
+            options['percents'] = list(percents)
+        super(Percentiles, self).__init__(field, **options)
+
+    def parse(self, raw_result):
+        values = raw_result.get('values') or {}
+        return OrderedDict(sorted((float(percent), value) for percent, value in values.items()
+                                  if not percent.endswith('_as_string')))
+
+
+class BucketAggregation(Aggregation):
+    """An aggregation whose buckets can have sub-aggregations."""
+
+    def __init__(self, field, aggregations=None, **options):
+        super(BucketAggregation, self).__init__(field, **options)
+        self.aggregations = aggregations or {}
+
+    def to_dict(self):
+        body = super(BucketAggregation, self).to_dict()
+        if self.aggregations:
+            body['aggregations'] = dict(
+                (name, aggregation.to_dict()) for name, aggregation in self.aggregations.items())
+        return body
+
+
+class Histogram(BucketAggregation):
+    """Fixed ``interval`` buckets of a numeric field, as ``HistogramBucket`` list."""
+
+    type = 'histogram'
+
+    def __init__(self, field, interval, aggregations=None, **options):
+        options['interval'] = interval
+        super(Histogram, self).__init__(field, aggregations=aggregations, **options)
+
+    def parse(self, raw_result):
+        return [HistogramBucket(bucket['key'], bucket['doc_count'],
+                                _parse_aggregations(self.aggregations, bucket))
+                for bucket in raw_result.get('buckets', [])]
+
+
+class Nested(BucketAggregation):
+    """Runs ``aggregations`` over the nested objects at ``path``."""
+
+    type = 'nested'
+
+    def __init__(self, path, aggregations):
+        super(Nested, self).__init__(path, aggregations=aggregations)
+
+    def to_dict(self):
+        body = super(Nested, self).to_dict()
+        body['nested'] = {'path': self.field}
+        return body
+
+    def parse(self, raw_result):
+        return NestedResult(raw_result.get('doc_count', 0),
+                            _parse_aggregations(self.aggregations, raw_result))
+
+
+class GeohashGrid(BucketAggregation):
+    """Groups the points of a ``geo_point`` field into geohash cells of ``precision``, 1 to 12.
+
+    Returns ``GeohashBucket`` list, most populated cells first, e.g. for
+    clustering markers on a map.
+    """
+
+    type = 'geohash_grid'
+
+    def __init__(self, field, precision=5, size=None, aggregations=None, **options):
+        options['precision'] = precision
+        if size is not None:
+            options['size'] = size
+        super(GeohashGrid, self).__init__(field, aggregations=aggregations, **options)
+
+    def parse(self, raw_result):
+        return [GeohashBucket(bucket['key'], bucket['doc_count'],
+                              _parse_aggregations(self.aggregations, bucket))
+                for bucket in raw_result.get('buckets', [])]
+
+
+class GeoBounds(Aggregation):
+    """The box enclosing the points of a ``geo_point`` field, ``None`` without points."""
+
+    type = 'geo_bounds'
+
+    def parse(self, raw_result):
+        bounds = raw_result.get('bounds')
+        if not bounds:
+            return None
+        top_left, bottom_right = bounds['top_left'], bounds['bottom_right']
+        return GeoBoundsResult((top_left['lat'], top_left['lon']), (bottom_right['lat'], bottom_right['lon']))
+
+
+class GeoCentroid(Aggregation):
+    """The mean location of the points of a ``geo_point`` field, ``None`` without points."""
+
+    type = 'geo_centroid'
+
+    def parse(self, raw_result):
+        location = raw_result.get('location')
+        if not location:
+            return None
+        return GeoCentroidResult(location['lat'], location['lon'])
@@ -2,23 +2,49 @@
 
 import warnings
 import ast
+import hashlib
+import json
+import random
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from timeit import default_timer
 
 import elasticsearch
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import bulk, scan, streaming_bulk
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db.models import Model, QuerySet
+from django.dispatch import receiver
+from django.utils import six
+from django.utils.module_loading import import_string
 from django.utils.translation import ugettext_lazy as _
 
 import haystack
 from haystack.backends.elasticsearch_backend import ElasticsearchSearchBackend, ElasticsearchSearchQuery
-from haystack.backends import SearchNode, BaseEngine, log_query
+from haystack.backends import BaseEngine, log_query
+from haystack.exceptions import SearchBackendError, SkipDocument
 from haystack.models import SearchResult
 from haystack.constants import (DEFAULT_OPERATOR, DJANGO_CT, DJANGO_ID, FUZZY_MAX_EXPANSIONS, DEFAULT_ALIAS,
-                                FILTER_SEPARATOR, VALID_FILTERS)
-from haystack.utils import get_model_ct
+                                FILTER_SEPARATOR, ID, VALID_FILTERS)
+from haystack.utils import get_identifier, get_model_ct
 from haystack.utils.app_loading import haystack_get_model
 
-__all__ = ['Elasticsearch5SearchBackend', 'Elasticsearch5SearchEngine']
+from .models import LazySearchResult
+from .filters import CompiledFilter, FilterNode
+from .circuit import (DEFAULT_FAILURE_THRESHOLD, DEFAULT_RESET_TIMEOUT, SearchUnavailable,
+                      get_circuit_breaker)
+from .instrumentation import DEFAULT_SLOW_QUERY_LOG_SIZE, ResponseSizeRecorder, get_slow_query_log
+from .querylog import get_query_recorder
+from .signals import query_executed, saved_searches_matched
+from .templates import FROM_PARAM, SIZE_PARAM, SearchTemplate
+
+__all__ = ['Elasticsearch5SearchBackend', 'Elasticsearch5SearchEngine', 'warm_up']
 
 DATE_HISTOGRAM_FIELD_NAME_SUFFIX = '_haystack_date_histogram'
 DATE_RANGE_FIELD_NAME_SUFFIX = '_haystack_date_range'
@@ -37,13 +63,634 @@ FIELD_MAPPINGS = {
     'nested': {'type': 'nested'},
     'location': {'type': 'geo_point'},
     'geometry': {'type': 'geo_shape'},
+    'completion': {'type': 'completion'},
 }
 
 NESTED_FILTER_SEPARATOR = '>'
 
+# Names of the inner hits holding the members of collapsed groups and of the
+# aggregation counting the groups.
+COLLAPSE_INNER_HITS_NAME = 'haystack_collapse'
+COLLAPSE_COUNT_AGGREGATION_NAME = 'haystack_collapse_count'
+# Highest ``precision_threshold`` of a ``cardinality`` aggregation, below it
+# the number of groups is close to exact.
+COLLAPSE_COUNT_PRECISION = 40000
+
+# Rescore score modes matching the function_score boost modes.
+RESCORE_SCORE_MODES = {'multiply': 'multiply', 'sum': 'total', 'avg': 'avg', 'max': 'max', 'min': 'min',
+                       'replace': 'total'}
+
+FILTER_QUERY_STRINGS = {
+    'content': u'%s',
+    'contains': u'*%s*',
+    'endswith': u'*%s',
+    'startswith': u'%s*',
+    'exact': u'%s',
+    'gt': u'{%s TO *}',
+    'gte': u'[%s TO *]',
+    'lt': u'{* TO %s}',
+    'lte': u'[* TO %s]',
+    'fuzzy': u'%s~',
+}
+
+SCHEMA_FINGERPRINT_KEY = 'haystack_es_fingerprint'
+
+# Search templates compiled per index, name and schema fingerprint, and the
+# ids of the templates stored by this process.
+_compiled_templates = {}
+_stored_templates = set()
+DEFAULT_TEMPLATE_SIZE = 10
+
+# Type and field of the saved searches in the percolator index.
+PERCOLATOR_DOC_TYPE = 'saved_search'
+PERCOLATOR_QUERY_FIELD = 'query'
+DEFAULT_PERCOLATE_SIZE = 1000
+
+# Schema fingerprints known to be in place, per index. Shared by the backend
+# instances of all threads so only the first ``setup`` in a process checks ES.
+_schema_fingerprints = {}
+
+# Read-only state derived from the indexes, shared by the backends of all threads.
+_unified_indexes = {}
+_unified_indexes_lock = threading.Lock()
+_schemas = weakref.WeakKeyDictionary()
+_field_converters = weakref.WeakKeyDictionary()
+
+SPELLING_EAGER = 'eager'
+SPELLING_LAZY = 'lazy'
+DEFAULT_SPELLING_CACHE_SIZE = 1000
+
+_spelling_caches = {}
+_spelling_caches_lock = threading.Lock()
+
+_prefetch_executor = None
+_prefetch_executor_lock = threading.Lock()
+
+
+def reset_unified_indexes(using=None):
+    """Drops the shared ``UnifiedIndex`` of ``using``, or of all aliases.
+
+    Engines created afterwards, e.g. by ``connections.reload``, build a new
+    one. Engines already holding the index keep it.
+    """
+    with _unified_indexes_lock:
+        for key in list(_unified_indexes):
+            if using is None or key[0] == using:
+                del _unified_indexes[key]
+
+
+@receiver(setting_changed)
+def _reset_unified_indexes_on_setting_changed(setting, **kwargs):
+    if setting.startswith('HAYSTACK_') or setting == 'INSTALLED_APPS':
+        reset_unified_indexes()
+
+
+def is_missing_script(error):
+    """Whether a ``TransportError`` says a stored script or template doesn't exist."""
+    if error.error == 'resource_not_found_exception':
+        return True
+    return 'unable to find script' in six.text_type(error).lower()
+
+
+def get_prefetch_executor():
+    """Returns the thread pool used for running queries in the background."""
+    global _prefetch_executor
+    with _prefetch_executor_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'HAYSTACK_PREFETCH_WORKERS', 4))
+        return _prefetch_executor
+
+
+class SpellingSuggestionCache(object):
+    """Least recently used spelling suggestions, keyed by field and text."""
+
+    def __init__(self, size=DEFAULT_SPELLING_CACHE_SIZE):
+        self.size = size
+        self.suggestions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns ``(found, suggestion)`` for ``key``."""
+        with self.lock:
+            if key not in self.suggestions:
+                return False, None
+            suggestion = self.suggestions.pop(key)
+            self.suggestions[key] = suggestion
+            return True, suggestion
+
+    def set(self, key, suggestion):
+        with self.lock:
+            self.suggestions.pop(key, None)
+            self.suggestions[key] = suggestion
+            while len(self.suggestions) > self.size:
+                self.suggestions.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.suggestions.clear()
+
+
+def get_spelling_cache(connection_alias, size=DEFAULT_SPELLING_CACHE_SIZE):
+    """Returns the spelling suggestion cache of ``connection_alias``."""
+    with _spelling_caches_lock:
+        if connection_alias not in _spelling_caches:
+            _spelling_caches[connection_alias] = SpellingSuggestionCache(size)
+        return _spelling_caches[connection_alias]
+
+
+def format_timeout(timeout):
+    """Returns an ES time value for ``timeout``, given in seconds or as ES time value."""
+    if isinstance(timeout, six.string_types):
+        return timeout
+    return '%dms' % (timeout * 1000)
+
+
+def parse_spelling_suggestion(raw_suggest):
+    """Joins the best option, or the original text, of each suggested term."""
+    if not raw_suggest:
+        return None
+    return ' '.join(word['text'] if len(word['options']) == 0 else word['options'][0]['text']
+                    for word in raw_suggest)
+
 
 class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
 
+    def __init__(self, connection_alias, **connection_options):
+        super(Elasticsearch5SearchBackend, self).__init__(connection_alias, **connection_options)
+        # Writes go to ``self.conn``, searches to ``read_conn``, by default both
+        # use the ``URL`` of the connection.
+        default_kwargs = connection_options.get('KWARGS', {})
+        if 'WRITE_URL' in connection_options:
+            self.conn = elasticsearch.Elasticsearch(connection_options['WRITE_URL'], timeout=self.timeout,
+                                                    **connection_options.get('WRITE_KWARGS', default_kwargs))
+        self._read_conn = None
+        if 'READ_URL' in connection_options:
+            self._read_conn = elasticsearch.Elasticsearch(
+                connection_options['READ_URL'], timeout=self.timeout,
+                **connection_options.get('READ_KWARGS', default_kwargs))
+        self.preference = connection_options.get('PREFERENCE')
+        self.preference_callback = connection_options.get('PREFERENCE_CALLBACK')
+        if isinstance(self.preference_callback, six.string_types):
+            self.preference_callback = import_string(self.preference_callback)
+        self.slow_query_threshold = connection_options.get('SLOW_QUERY_THRESHOLD')
+        self.profile_sample_rate = connection_options.get('PROFILE_SAMPLE_RATE', 0)
+        self.query_callback = connection_options.get('QUERY_CALLBACK')
+        if isinstance(self.query_callback, six.string_types):
+            self.query_callback = import_string(self.query_callback)
+        self.response_sizes = ResponseSizeRecorder.install(self.read_conn)
+        self.slow_query_log = get_slow_query_log(
+            connection_alias,
+            size=connection_options.get('SLOW_QUERY_LOG_SIZE', DEFAULT_SLOW_QUERY_LOG_SIZE),
+            cache_alias=connection_options.get('SLOW_QUERY_CACHE'))
+        self.query_recorder = None
+        if connection_options.get('QUERY_LOG_PATH'):
+            self.query_recorder = get_query_recorder(
+                connection_alias, connection_options['QUERY_LOG_PATH'],
+                sample_rate=connection_options.get('QUERY_LOG_SAMPLE_RATE', 1.0),
+                scrubber=connection_options.get('QUERY_LOG_SCRUBBER'))
+        self.spelling_mode = connection_options.get('SPELLING_MODE', SPELLING_EAGER)
+        if self.spelling_mode not in (SPELLING_EAGER, SPELLING_LAZY):
+            raise ImproperlyConfigured(
+                "SPELLING_MODE must be '%s' or '%s'." % (SPELLING_EAGER, SPELLING_LAZY))
+        self.spelling_field = connection_options.get('SPELLING_FIELD', '_all')
+        self.spelling_threshold = connection_options.get('SPELLING_THRESHOLD')
+        self.spelling_cache = get_spelling_cache(
+            connection_alias, size=connection_options.get('SPELLING_CACHE_SIZE', DEFAULT_SPELLING_CACHE_SIZE))
+        self.delete_slices = connection_options.get('DELETE_BY_QUERY_SLICES')
+        self.delete_throttle = connection_options.get('DELETE_BY_QUERY_THROTTLE')
+        self.current_fingerprint = None
+        self.search_templates = dict(
+            (name, SearchTemplate(name, build))
+            for name, build in connection_options.get('SEARCH_TEMPLATES', {}).items())
+        self.percolator_index_name = connection_options.get(
+            'PERCOLATOR_INDEX_NAME', '%s_percolator' % self.index_name)
+        self.percolate_on_update = connection_options.get('PERCOLATE_ON_UPDATE', False)
+        self.percolator_setup_complete = False
+        self.search_timeout = connection_options.get('SEARCH_TIMEOUT')
+        self.terminate_after = connection_options.get('TERMINATE_AFTER')
+        self.circuit_breaker = None
+        max_concurrent = connection_options.get('MAX_CONCURRENT_SEARCHES')
+        latency_threshold = connection_options.get('CIRCUIT_BREAKER_LATENCY')
+        if max_concurrent or latency_threshold is not None:
+            self.circuit_breaker = get_circuit_breaker(
+                connection_alias,
+                max_concurrent=max_concurrent,
+                queue_timeout=connection_options.get('SEARCH_QUEUE_TIMEOUT', 0),
+                latency_threshold=latency_threshold,
+                failure_threshold=connection_options.get(
+                    'CIRCUIT_BREAKER_FAILURES', DEFAULT_FAILURE_THRESHOLD),
+                reset_timeout=connection_options.get('CIRCUIT_BREAKER_RESET', DEFAULT_RESET_TIMEOUT))
+
+    @property
+    def read_conn(self):
+        """The client searches are sent with, ``READ_URL`` or the client used for writes."""
+        return self._read_conn if self._read_conn is not None else self.conn
+
+    def get_preference(self, preference=None):
+        """Returns the ``preference`` search parameter, shard copies are picked by.
+
+        An explicit ``preference`` wins over the ``PREFERENCE_CALLBACK`` and
+        ``PREFERENCE`` connection options. Passing the same value, e.g. the
+        session key, for a user's searches keeps them on the same shard copies.
+        """
+        if preference is None and self.preference_callback is not None:
+            preference = self.preference_callback()
+        if preference is None:
+            preference = self.preference
+        return preference
+
+    def setup(self):
+        """Creates the index and mapping unless the current schema is already in place.
+
+        The mapping carries a fingerprint of the schema in its ``_meta``, so the
+        check is a single small request and ``put_mapping`` only runs when the
+        schema changed.
+        """
+        unified_index = haystack.connections[self.connection_alias].get_unified_index()
+        self.content_field_name, field_mapping = self.get_schema(unified_index)
+        fingerprint = self.schema_fingerprint(field_mapping)
+        current_mapping = {
+            'modelresult': {
+                '_meta': {SCHEMA_FINGERPRINT_KEY: fingerprint},
+                'properties': field_mapping,
+            }
+        }
+
+        if _schema_fingerprints.get(self.index_name) != fingerprint:
+            existing_fingerprint = None
+            try:
+                existing = self.conn.indices.get_mapping(
+                    index=self.index_name, doc_type='modelresult',
+                    filter_path='*.mappings.modelresult._meta')
+                for index_mapping in existing.values():
+                    meta = index_mapping['mappings']['modelresult'].get('_meta', {})
+                    existing_fingerprint = meta.get(SCHEMA_FINGERPRINT_KEY)
+            except NotFoundError:
+                pass
+            except Exception:
+                if not self.silently_fail:
+                    raise
+
+            if existing_fingerprint != fingerprint:
+                try:
+                    # Make sure the index is there first.
+                    self.conn.indices.create(index=self.index_name, body=self.DEFAULT_SETTINGS, ignore=400)
+                    self.conn.indices.put_mapping(index=self.index_name, doc_type='modelresult',
+                                                  body=current_mapping)
+                except Exception:
+                    if not self.silently_fail:
+                        raise
+                    self.setup_complete = True
+                    return
+
+            _schema_fingerprints[self.index_name] = fingerprint
+
+        self.existing_mapping = current_mapping
+        self.current_fingerprint = fingerprint
+        self.setup_complete = True
+
+        if self.search_templates:
+            try:
+                self.store_search_templates()
+            except elasticsearch.TransportError as e:
+                if not self.silently_fail:
+                    raise
+
+                self.log.error("Failed to store search templates: %s", e, exc_info=True)
+
+    def get_search_template(self, name):
+        """Returns the ``CompiledTemplate`` of the search template ``name``.
+
+        Templates are compiled once per process and schema fingerprint.
+        """
+        try:
+            template = self.search_templates[name]
+        except KeyError:
+            raise SearchBackendError("Unknown search template '%s'." % name)
+        if not self.setup_complete:
+            self.setup()
+
+        key = (self.index_name, name, self.current_fingerprint)
+        compiled = _compiled_templates.get(key)
+        if compiled is None:
+            compiled = _compiled_templates[key] = template.compile(self, self.current_fingerprint)
+        return compiled
+
+    def store_search_templates(self):
+        """Stores the ``SEARCH_TEMPLATES`` not yet stored for the current schema.
+
+        Templates are stored through ``read_conn``, the cluster running them.
+        """
+        for name in sorted(self.search_templates):
+            compiled = self.get_search_template(name)
+            if compiled.id not in _stored_templates:
+                self.read_conn.put_template(id=compiled.id, body={'template': compiled.source})
+                _stored_templates.add(compiled.id)
+
+    def search_template(self, body, **params):
+        """Sends a ``_search/template`` body built by ``build_template_kwargs``.
+
+        When the cluster lost the stored template, e.g. after a snapshot
+        restore, it is stored again and the search retried once.
+        """
+        try:
+            return self.read_conn.search_template(body=body, index=self.index_name, doc_type='modelresult',
+                                                  **params)
+        except elasticsearch.TransportError as e:
+            if not is_missing_script(e):
+                raise
+            self.log.warning("Search template '%s' is missing, storing it again.", body['id'])
+            _stored_templates.discard(body['id'])
+            self.store_search_templates()
+            return self.read_conn.search_template(body=body, index=self.index_name, doc_type='modelresult',
+                                                  **params)
+
+    def build_template_kwargs(self, name, params, start_offset=0, end_offset=None):
+        """Returns the ``_search/template`` body running the stored template ``name``."""
+        compiled = self.get_search_template(name)
+        if compiled.id not in _stored_templates:
+            self.store_search_templates()
+
+        missing = set(compiled.params) - set(params)
+        if missing:
+            raise SearchBackendError("Missing parameters of search template '%s': %s" % (
+                name, ', '.join(sorted(missing))))
+        params = dict(params)
+        params[FROM_PARAM] = start_offset
+        if end_offset is not None and end_offset > start_offset:
+            params[SIZE_PARAM] = end_offset - start_offset
+        else:
+            params[SIZE_PARAM] = DEFAULT_TEMPLATE_SIZE
+        return {'id': compiled.id, 'params': params}
+
+    def schema_fingerprint(self, field_mapping):
+        """Returns a hash of the mapping and index settings built by this backend."""
+        schema = json.dumps([field_mapping, self.DEFAULT_SETTINGS], sort_keys=True)
+        return hashlib.sha1(schema.encode('utf-8')).hexdigest()
+
+    def clear(self, models=None, commit=True):
+        if models is None:
+            super(Elasticsearch5SearchBackend, self).clear(commit=commit)
+            _schema_fingerprints.pop(self.index_name, None)
+        else:
+            model_choices = sorted(get_model_ct(model) for model in models)
+            try:
+                self.delete_by_query({'terms': {DJANGO_CT: model_choices}}, commit=commit)
+            except elasticsearch.TransportError as e:
+                if not self.silently_fail:
+                    raise
+
+                self.log.error("Failed to clear Elasticsearch index of models '%s': %s",
+                               ','.join(model_choices), e, exc_info=True)
+        self.spelling_cache.clear()
+
+    def update(self, index, iterable, commit=True):
+        """Indexes the objects of ``iterable``.
+
+        With ``PERCOLATE_ON_UPDATE`` the prepared documents are then matched
+        against the saved searches and ``saved_searches_matched`` is sent.
+        """
+        if not self.setup_complete:
+            try:
+                self.setup()
+            except elasticsearch.TransportError as e:
+                if not self.silently_fail:
+                    raise
+
+                self.log.error("Failed to add documents to Elasticsearch: %s", e, exc_info=True)
+                return
+
+        prepped_docs = []
+
+        for obj in iterable:
+            try:
+                prepped_data = index.full_prepare(obj)
+                final_data = {}
+
+                # Convert the data to make sure it's happy.
+                for key, value in prepped_data.items():
+                    final_data[key] = self._from_python(value)
+                final_data['_id'] = final_data[ID]
+
+                prepped_docs.append(final_data)
+            except SkipDocument:
+                self.log.debug(u"Indexing for object `%s` skipped", obj)
+            except elasticsearch.TransportError as e:
+                if not self.silently_fail:
+                    raise
+
+                self.log.error(u"%s while preparing object for update" % e.__class__.__name__, exc_info=True,
+                               extra={"data": {"index": index,
+                                               "object": get_identifier(obj)}})
+
+        bulk(self.conn, prepped_docs, index=self.index_name, doc_type='modelresult')
+
+        if commit:
+            self.conn.indices.refresh(index=self.index_name)
+
+        if self.percolate_on_update and prepped_docs:
+            documents = [dict((key, value) for key, value in doc.items() if key != '_id')
+                         for doc in prepped_docs]
+            try:
+                matches = self.percolate(documents)
+            except elasticsearch.TransportError as e:
+                if not self.silently_fail:
+                    raise
+
+                self.log.error("Failed to percolate documents: %s", e, exc_info=True)
+                return
+
+            matches = dict((doc[ID], saved_search_ids)
+                           for doc, saved_search_ids in zip(prepped_docs, matches) if saved_search_ids)
+            if matches:
+                saved_searches_matched.send(sender=self.__class__, connection_alias=self.connection_alias,
+                                            index=index, matches=matches)
+
+    def setup_percolator(self):
+        """Creates the percolator index, with the document mapping and the saved search type."""
+        if not self.setup_complete:
+            self.setup()
+
+        self.conn.indices.create(index=self.percolator_index_name, body=self.DEFAULT_SETTINGS, ignore=400)
+        self.conn.indices.put_mapping(index=self.percolator_index_name, doc_type='modelresult',
+                                      body=self.existing_mapping)
+        self.conn.indices.put_mapping(index=self.percolator_index_name, doc_type=PERCOLATOR_DOC_TYPE, body={
+            PERCOLATOR_DOC_TYPE: {'properties': {PERCOLATOR_QUERY_FIELD: {'type': 'percolator'}}},
+        })
+        self.percolator_setup_complete = True
+
+    def save_search(self, saved_search_id, search_queryset, commit=True):
+        """Stores the query of ``search_queryset`` as a percolator query with ``saved_search_id``."""
+        if not self.percolator_setup_complete:
+            self.setup_percolator()
+
+        query = search_queryset.query
+        search_kwargs = self.build_search_kwargs(query.build_query(), **query.build_params())
+        self.conn.index(index=self.percolator_index_name, doc_type=PERCOLATOR_DOC_TYPE, id=saved_search_id,
+                        body={PERCOLATOR_QUERY_FIELD: search_kwargs['query']}, refresh=commit)
+
+    def delete_saved_search(self, saved_search_id, commit=True):
+        if not self.percolator_setup_complete:
+            self.setup_percolator()
+
+        self.conn.delete(index=self.percolator_index_name, doc_type=PERCOLATOR_DOC_TYPE, id=saved_search_id,
+                         refresh=commit, ignore=404)
+
+    def percolate(self, documents, size=DEFAULT_PERCOLATE_SIZE):
+        """Returns the ids of the saved searches matching each of the prepared ``documents``.
+
+        All documents are percolated in a single multi search request, at most
+        ``size`` saved searches are returned per document.
+        """
+        if not documents:
+            return []
+        if not self.percolator_setup_complete:
+            self.setup_percolator()
+
+        body = []
+        for document in documents:
+            body.append({'index': self.percolator_index_name, 'type': PERCOLATOR_DOC_TYPE})
+            body.append({
+                'query': {'percolate': {'field': PERCOLATOR_QUERY_FIELD, 'document_type': 'modelresult',
+                                        'document': document}},
+                '_source': False,
+                'size': size,
+            })
+        responses = self.conn.msearch(body=body)['responses']
+        errors = [response['error'] for response in responses if 'error' in response]
+        if errors:
+            raise SearchBackendError('%d documents failed to be percolated: %r' % (len(errors), errors[:5]))
+        return [[hit['_id'] for hit in response['hits']['hits']] for response in responses]
+
+    def remove(self, obj_or_string, commit=True):
+        """Removes an object, or every object of an iterable or queryset, from the index.
+
+        Several objects are deleted through streaming bulk requests of
+        ``BATCH_SIZE`` deletes, querysets are read as primary keys only.
+        Returns the number of deleted documents.
+        """
+        if isinstance(obj_or_string, (six.string_types, Model)):
+            super(Elasticsearch5SearchBackend, self).remove(obj_or_string, commit=commit)
+            return None
+
+        if isinstance(obj_or_string, QuerySet):
+            model_ct = get_model_ct(obj_or_string.model)
+            doc_ids = ('%s.%s' % (model_ct, pk)
+                       for pk in obj_or_string.values_list('pk', flat=True).iterator())
+        else:
+            doc_ids = (get_identifier(obj) for obj in obj_or_string)
+
+        actions = (
+            {'_op_type': 'delete', '_index': self.index_name, '_type': 'modelresult', '_id': doc_id}
+            for doc_id in doc_ids)
+        deleted = 0
+        try:
+            if not self.setup_complete:
+                self.setup()
+
+            errors = []
+            responses = streaming_bulk(self.conn, actions, chunk_size=self.batch_size, raise_on_error=False)
+            for ok, item in responses:
+                if ok:
+                    deleted += 1
+                elif item['delete'].get('status') != 404:
+                    errors.append(item['delete'])
+
+            if commit:
+                self.conn.indices.refresh(index=self.index_name)
+        except elasticsearch.TransportError as e:
+            if not self.silently_fail:
+                raise
+
+            self.log.error("Failed to remove documents from Elasticsearch: %s", e, exc_info=True)
+            return deleted
+
+        if errors:
+            if not self.silently_fail:
+                raise SearchBackendError('%d documents failed to be removed: %r' % (len(errors), errors[:5]))
+
+            self.log.error("%d documents failed to be removed from Elasticsearch: %r",
+                           len(errors), errors[:5])
+        return deleted
+
+    def remove_by_query(self, search_queryset, slices=None, requests_per_second=None,
+                        wait_for_completion=True, commit=True):
+        """Removes the documents matching ``search_queryset`` in one ``_delete_by_query`` job.
+
+        The job runs in ``slices`` parallel parts and is throttled to
+        ``requests_per_second``, they default to the ``DELETE_BY_QUERY_SLICES``
+        and ``DELETE_BY_QUERY_THROTTLE`` options. Returns the ES response, with
+        the task id when not waiting for completion.
+        """
+        query = search_queryset.query
+        search_kwargs = self.build_search_kwargs(query.build_query(), **query.build_params())
+        try:
+            return self.delete_by_query(search_kwargs['query'], slices=slices,
+                                        requests_per_second=requests_per_second,
+                                        wait_for_completion=wait_for_completion, commit=commit)
+        except elasticsearch.TransportError as e:
+            if not self.silently_fail:
+                raise
+
+            self.log.error("Failed to remove documents by query from Elasticsearch: %s", e, exc_info=True)
+            return None
+
+    def delete_by_query(self, query, slices=None, requests_per_second=None, wait_for_completion=True,
+                        commit=True):
+        """Sends a ``_delete_by_query`` for the ``query`` DSL, documents changed meanwhile are skipped."""
+        params = {'conflicts': 'proceed', 'wait_for_completion': wait_for_completion}
+        slices = slices if slices is not None else self.delete_slices
+        if slices is not None:
+            params['slices'] = slices
+        requests_per_second = requests_per_second if requests_per_second is not None else self.delete_throttle
+        if requests_per_second is not None:
+            params['requests_per_second'] = requests_per_second
+        if commit:
+            params['refresh'] = True
+        return self.conn.delete_by_query(index=self.index_name, doc_type='modelresult',
+                                         body={'query': query}, **params)
+
+    def iter_document_ids(self, model, batch_size=None):
+        """Yields the primary keys, as strings, of the documents of ``model`` in the index.
+
+        The documents are scrolled through in index order ``batch_size`` at a
+        time, without their ``_source``.
+        """
+        if not self.setup_complete:
+            self.setup()
+
+        model_ct = get_model_ct(model)
+        hits = scan(self.conn, index=self.index_name, doc_type='modelresult',
+                    query={'query': {'term': {DJANGO_CT: model_ct}}, '_source': False},
+                    size=batch_size or self.batch_size)
+        for hit in hits:
+            yield hit['_id'][len(model_ct) + 1:]
+
+    def get_indexed_ids(self, model, pks):
+        """Returns which of the primary keys ``pks`` of ``model`` are in the index, as strings."""
+        if not self.setup_complete:
+            self.setup()
+
+        model_ct = get_model_ct(model)
+        doc_ids = ['%s.%s' % (model_ct, pk) for pk in pks]
+        if not doc_ids:
+            return set()
+        response = self.conn.mget(index=self.index_name, doc_type='modelresult', body={'ids': doc_ids},
+                                  _source=False)
+        return set(doc['_id'][len(model_ct) + 1:] for doc in response['docs'] if doc.get('found'))
+
+    def get_schema(self, unified_index):
+        """Returns ``build_schema`` for the fields of ``unified_index``.
+
+        The result is computed once per process and must not be modified.
+        """
+        fields = unified_index.all_searchfields()
+        cached = _schemas.get(unified_index)
+        if cached is None or cached[0] is not fields or cached[1] is not type(self):
+            cached = _schemas[unified_index] = (fields, type(self), self.build_schema(fields))
+        return cached[2]
+
     def build_schema(self, fields):
         content_field_name = ''
         mapping = {
@@ -63,7 +710,15 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
                     field_mapping['index'] = 'not_analyzed'
                     field_mapping['type'] = 'keyword'
 
-            if field_mapping['type'] not in ['object', 'nested', 'geo_point', 'geo_shape']:
+            if hasattr(field_class, 'get_mapping_options'):
+                field_mapping.update(field_class.get_mapping_options())
+
+            if field_mapping['type'] == 'completion' and field_class.contexts:
+                field_mapping['contexts'] = [
+                    {'name': context, 'type': 'category', 'path': context} for context in field_class.contexts
+                ]
+
+            if field_mapping['type'] not in ['object', 'nested', 'geo_point', 'geo_shape', 'completion']:
                 # add raw field
                 if not field_mapping.get('fields'):
                     field_mapping['fields'] = {}
@@ -77,111 +732,76 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
 
         return (content_field_name, mapping)
 
+    def build_highlight(self, content_field, highlight):
+        """Returns the ``highlight`` section of a search body.
+
+        ``highlight`` is ``True`` for the content field with the default
+        options, or the options of ``SearchQuerySet.highlight``. ``fields`` is
+        a list of fields or a dict of per-field options, the other options
+        apply to all fields.
+        """
+        options = dict(highlight) if isinstance(highlight, dict) else {}
+        fields = options.pop('fields', None) or [content_field]
+        if isinstance(fields, dict):
+            options['fields'] = dict((field, dict(field_options or {}))
+                                     for field, field_options in fields.items())
+        else:
+            options['fields'] = dict((field, {}) for field in fields)
+        return options
+
     def build_search_kwargs(self, query_string, sort_by=None, start_offset=0, end_offset=None,
                             fields='', highlight=False, boost_fields=None, boost_negative=None,
-                            filter_context=None, narrow_queries=None, spelling_query=None,
+                            filter_context=None, filter_chain=None, narrow_queries=None, spelling_query=None,
                             facets=None, date_facets=None, query_facets=None,
                             within=None, dwithin=None, distance_point=None,
                             models=None, limit_to_registered_models=None, result_class=None,
+                            inner_hits=None, aggregations=None, collapse=None, rescore=None,
+                            timeout=None, terminate_after=None, preference=None, template=None,
                             **extra_kwargs):
-
+        # ``preference`` and ``template`` are request parameters, never part of the body.
         index = haystack.connections[self.connection_alias].get_unified_index()
         content_field = index.document_field
 
         filters = []
         filters_with_score = []
-        filter_query_strings = {
-            'content': u'%s',
-            'contains': u'*%s*',
-            'endswith': u'*%s',
-            'startswith': u'%s*',
-            'exact': u'%s',
-            'gt': u'{%s TO *}',
-            'gte': u'[%s TO *]',
-            'lt': u'{* TO %s}',
-            'lte': u'[* TO %s]',
-            'fuzzy': u'%s~',
-        }
+        # One nested query per path, so all its filters must match the same nested object.
+        nested_queries = {}
 
         if filter_context:
-            for f in filter_context:
-                if f.get('content'):
-                    content = str(f.pop('content'))
-                    if query_string == '*:*':
-                        query_string = content
-                    else:
-                        query_string = '%s %s' % (query_string, content)
-                for k, v in f.items():
-                    _filter = None
-                    _filter_with_score = None
-                    try:
-                        _value = v.prepare()
-                    except AttributeError:
-                        _value = str(v)
-                    _field, _lookup = self.get_filter_lookup(k)
-                    _is_nested = NESTED_FILTER_SEPARATOR in _field
-                    _nested_path = None
-                    if _is_nested:
-                        _nested_path = _field.split(NESTED_FILTER_SEPARATOR)[0]
-                        _field = ('.').join(_field.split(NESTED_FILTER_SEPARATOR))
-                    if _lookup == 'exact':
-                        if _is_nested:
-                            _filter = {'term': {_field: _value}}
-                        else:
-                            _filter = {'term': {_field + '.raw': _value}}
-                    elif _lookup == 'content':
-                        _filter_with_score = {'match': {_field: _value}}
-                    elif _lookup == 'in':
-                        if not isinstance(_value, list):
-                            _value = ast.literal_eval(str(_value))
-                        _filter = {
-                            'query_string': {
-                                'fields': [_field],
-                                'query': ' OR '.join(['"%s"' % i for i in _value])
-                            }}
-                    elif _lookup == 'range':
-                        if isinstance(_value, dict):
-                            _filter = {'range': {_field: _value}}
-                        elif _value:
-                            if not isinstance(_value, list):
-                                _value = _value.split(',')
-                            if len(_value) >= 2:
-                                _range = {}
-                                _range['gte'] = _value[0]
-                                _range['lte'] = _value[1]
-                                _filter = {'range': {_field: _range}}
-                            else:
-                                raise ValueError(
-                                    _('Range lookup requires minimum and maximum values,'
-                                      'only one value was provided'))
-                    else:
-                        _filter = {
-                            'query_string': {
-                                'fields': [_field],
-                                'query': filter_query_strings[_lookup] % _value,
-                            }}
-
-                    # nested filter
-                    if _is_nested:
-                        if _filter:
-                            _filter = {
-                                'nested': {
-                                    'path': _nested_path,
-                                    'query': _filter
-                                }
-                            }
-                        if _filter_with_score:
-                            _filter_with_score = {
-                                'nested': {
-                                    'path': _nested_path,
-                                    'query': _filter_with_score
-                                }
-                            }
+            compiled_filters = [self.compile_filter(k, v) for f in filter_context for k, v in f.items()]
+        elif filter_chain is not None:
+            compiled_filters = filter_chain.compile(self)
+        else:
+            compiled_filters = []
 
-                    if _filter:
-                        filters.append(_filter)
-                    if _filter_with_score:
-                        filters.append(_filter_with_score)
+        for compiled in compiled_filters:
+            if compiled.query_string is not None:
+                if query_string == '*:*':
+                    query_string = compiled.query_string
+                else:
+                    query_string = '%s %s' % (query_string, compiled.query_string)
+            elif compiled.nested_path is not None:
+                if compiled.nested_path not in nested_queries:
+                    nested_queries[compiled.nested_path] = []
+                    filters.append({'nested': {'path': compiled.nested_path}})
+                nested_queries[compiled.nested_path].append(compiled.clause)
+            elif compiled.clause is not None:
+                filters.append(compiled.clause)
+
+        for _filter in filters:
+            _nested = _filter.get('nested')
+            if _nested is None or 'query' in _nested:
+                continue
+            _clauses = nested_queries[_nested['path']]
+            _nested['query'] = _clauses[0] if len(_clauses) == 1 else {'bool': {'must': _clauses}}
+            if inner_hits and _nested['path'] in inner_hits:
+                _nested['inner_hits'] = dict(inner_hits[_nested['path']])
+
+        if inner_hits and nested_queries:
+            # Matching nested objects come back through inner_hits only.
+            source_filter = {'excludes': sorted(p for p in nested_queries if p in inner_hits)}
+        else:
+            source_filter = None
 
         if query_string == '*:*':
             kwargs = {
@@ -224,6 +844,9 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
 
             kwargs['stored_fields'] = fields
 
+        if source_filter and source_filter['excludes']:
+            kwargs['_source'] = source_filter
+
         if sort_by is not None:
             order_list = []
             for field, direction in sort_by:
@@ -249,21 +872,14 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
             kwargs['sort'] = order_list
 
         if highlight:
-            kwargs['highlight'] = {
-                'fields': {
-                    content_field: {},
-                }
-            }
-
-            if isinstance(highlight, dict):
-                kwargs['highlight'].update(highlight)
+            kwargs['highlight'] = self.build_highlight(content_field, highlight)
 
         if self.include_spelling:
             kwargs['suggest'] = {
                 'suggest': {
                     'text': spelling_query or query_string,
                     'term': {
-                        'field': '_all',
+                        'field': self.spelling_field,
                     },
                 },
             }
@@ -271,6 +887,29 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
         if narrow_queries is None:
             narrow_queries = set()
 
+        if collapse:
+            collapse_field = collapse['field'] + '.raw'
+            kwargs['collapse'] = {'field': collapse_field}
+            if collapse.get('size'):
+                kwargs['collapse']['inner_hits'] = {
+                    'name': COLLAPSE_INNER_HITS_NAME,
+                    'size': collapse['size'],
+                }
+            # The hits total counts every match, the number of groups comes from here.
+            kwargs.setdefault('aggregations', {})
+            kwargs['aggregations'][COLLAPSE_COUNT_AGGREGATION_NAME] = {
+                'cardinality': {'field': collapse_field, 'precision_threshold': COLLAPSE_COUNT_PRECISION},
+                'meta': {'_type': 'haystack_collapse_count'},
+            }
+
+        if aggregations:
+            # Only the aggregated values are needed, not the documents.
+            kwargs['size'] = 0
+            kwargs.setdefault('aggregations', {})
+
+            for name, aggregation in aggregations.items():
+                kwargs['aggregations'][name] = aggregation.to_dict()
+
         if facets is not None:
             kwargs.setdefault('aggregations', {})
 
@@ -409,6 +1048,40 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
             }
             filters.append(dwithin_filter)
 
+        score_functions, score_mode, boost_mode = self.build_score_functions(model_choices)
+        if rescore is not None:
+            rescore_query = rescore.get('query')
+            query_weight = rescore.get('query_weight', 1.0)
+            rescore_score_mode = rescore.get('score_mode')
+            if rescore_query is None and score_functions:
+                # The index functions only score the top hits of each shard.
+                rescore_query = {'function_score': {
+                    'functions': score_functions, 'score_mode': score_mode, 'boost_mode': 'replace'}}
+                if boost_mode == 'replace':
+                    query_weight = 0
+                rescore_score_mode = rescore_score_mode or RESCORE_SCORE_MODES[boost_mode]
+            if rescore_query is not None:
+                if sort_by or collapse:
+                    # Elasticsearch rejects rescoring of sorted or collapsed results.
+                    raise SearchBackendError('Rescoring cannot be combined with %s.' % (
+                        'order_by' if sort_by else 'collapse'))
+                kwargs['rescore'] = {
+                    'window_size': rescore['window_size'],
+                    'query': {
+                        'rescore_query': rescore_query,
+                        'query_weight': query_weight,
+                        'rescore_query_weight': rescore.get('rescore_query_weight', 1.0),
+                        'score_mode': rescore_score_mode or 'total',
+                    },
+                }
+        elif score_functions:
+            kwargs['query'] = {'function_score': {
+                'query': kwargs.pop('query'),
+                'functions': score_functions,
+                'score_mode': score_mode,
+                'boost_mode': boost_mode,
+            }}
+
         # if we want to filter, change the query type to filteres
         if filters:
             kwargs["query"] = {"bool": {"must": kwargs.pop("query")}}
@@ -418,12 +1091,49 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
             else:
                 kwargs['query']['bool']["filter"] = {"bool": {"must": filters}}
 
+        # Budgets, ES returns what it found so far once one is used up.
+        timeout = timeout if timeout is not None else self.search_timeout
+        if timeout is not None:
+            kwargs['timeout'] = format_timeout(timeout)
+        terminate_after = terminate_after if terminate_after is not None else self.terminate_after
+        if terminate_after:
+            kwargs['terminate_after'] = terminate_after
+
         if extra_kwargs:
             kwargs.update(extra_kwargs)
         return kwargs
 
+    def build_score_functions(self, model_choices=None):
+        """Returns the ``score_functions`` of the searched indexes with their modes.
+
+        Each function is limited to the documents of its index. Indexes searched
+        together must use the same ``score_mode`` and ``boost_mode``.
+        """
+        unified_index = haystack.connections[self.connection_alias].get_unified_index()
+        functions = []
+        modes = set()
+        indexes = sorted((get_model_ct(model), index) for model, index in unified_index.get_indexes().items())
+        for model_ct, index in indexes:
+            if not getattr(index, 'score_functions', None):
+                continue
+            if model_choices and model_ct not in model_choices:
+                continue
+            modes.add((index.score_mode, index.boost_mode))
+            for function in index.score_functions:
+                function = function.to_dict()
+                model_filter = {'term': {DJANGO_CT: model_ct}}
+                if 'filter' in function:
+                    model_filter = {'bool': {'filter': [model_filter, function['filter']]}}
+                function['filter'] = model_filter
+                functions.append(function)
+
+        if len(modes) > 1:
+            raise SearchBackendError('Indexes searched together must use the same score_mode and boost_mode.')
+        score_mode, boost_mode = modes.pop() if modes else (None, None)
+        return functions, score_mode, boost_mode
+
     @log_query
-    def search(self, query_string, **kwargs):
+    def search(self, query_string, preference=None, template=None, **kwargs):
 
         if len(query_string) == 0:
             return {
@@ -434,8 +1144,18 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
         if not self.setup_complete:
             self.setup()
 
-        search_kwargs = self.build_search_kwargs(query_string, **kwargs)
-        search_kwargs['from'] = kwargs.get('start_offset', 0)
+        started = default_timer()
+        end_offset = kwargs.get('end_offset')
+        start_offset = kwargs.get('start_offset', 0)
+
+        if template is not None:
+            search_kwargs = self.build_template_kwargs(template[0], template[1], start_offset, end_offset)
+        else:
+            search_kwargs = self.build_search_kwargs(query_string, **kwargs)
+            search_kwargs['from'] = start_offset
+
+            if end_offset is not None and end_offset > start_offset:
+                search_kwargs['size'] = end_offset - start_offset
 
         order_fields = set()
 
@@ -445,30 +1165,155 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
 
         geo_sort = '_geo_distance' in order_fields
 
-        end_offset = kwargs.get('end_offset')
-        start_offset = kwargs.get('start_offset', 0)
+        # In lazy mode the suggester runs as a separate request, if at all.
+        spelling_suggest = None
+        if self.spelling_mode == SPELLING_LAZY:
+            spelling_suggest = search_kwargs.pop('suggest', None)
 
-        if end_offset is not None and end_offset > start_offset:
-            search_kwargs['size'] = end_offset - start_offset
+        if self.query_recorder is not None and template is None:
+            self.query_recorder.record(search_kwargs)
+
+        built = default_timer()
+
+        search_params = {} if '_source' in search_kwargs or template is not None else {'_source': True}
+        preference = self.get_preference(preference)
+        if preference is not None:
+            search_params['preference'] = preference
 
+        circuit_breaker = self.circuit_breaker
+        if circuit_breaker is not None:
+            permit = circuit_breaker.acquire()
+            if permit is None:
+                return self.shed_search(query_string)
+
+        response_sizes = self.response_sizes
+        if response_sizes is not None:
+            response_sizes.reset()
+
+        failed = False
         try:
-            raw_results = self.conn.search(body=search_kwargs, index=self.index_name, doc_type='modelresult',
-                                           _source=True)
+            if template is not None:
+                raw_results = self.search_template(search_kwargs, **search_params)
+            else:
+                raw_results = self.read_conn.search(body=search_kwargs, index=self.index_name,
+                                                    doc_type='modelresult', **search_params)
         except elasticsearch.TransportError as e:
+            failed = True
             if not self.silently_fail:
                 raise
 
             self.log.error("Failed to query Elasticsearch using '%s': %s", query_string, e, exc_info=True)
             raw_results = {}
+        finally:
+            requested = default_timer()
+            if circuit_breaker is not None:
+                circuit_breaker.release(permit, requested - built, failed=failed)
+        response_bytes = response_sizes.size if response_sizes is not None else None
+
+        results = self._process_results(raw_results,
+                                        highlight=kwargs.get('highlight'),
+                                        result_class=kwargs.get('result_class', SearchResult),
+                                        distance_point=kwargs.get('distance_point'),
+                                        geo_sort=geo_sort,
+                                        aggregations=kwargs.get('aggregations'),
+                                        collapse=kwargs.get('collapse'))
+
+        if spelling_suggest is not None:
+            results['spelling_query'] = spelling_suggest['suggest']['text']
+            if self.spelling_threshold is not None and results['hits'] < self.spelling_threshold:
+                results['spelling_suggestion'] = self.spelling_suggestion(results['spelling_query'])
+
+        if self.is_instrumented():
+            self.instrument_query(query_string, search_kwargs, raw_results, results, {
+                'build_time': built - started,
+                'request_time': requested - built,
+                'process_time': default_timer() - requested,
+            }, response_bytes=response_bytes, template=template[0] if template is not None else None)
+
+        return results
+
+    def shed_search(self, query_string):
+        """Handles a search rejected by the circuit breaker.
+
+        Raises ``SearchUnavailable``, or with ``SILENTLY_FAIL`` returns empty
+        results flagged as ``degraded``.
+        """
+        message = "Search '%s' rejected, Elasticsearch is overloaded or the circuit is open." % query_string
+        if not self.silently_fail:
+            raise SearchUnavailable(message)
 
-        return self._process_results(raw_results,
-                                     highlight=kwargs.get('highlight'),
-                                     result_class=kwargs.get('result_class', SearchResult),
-                                     distance_point=kwargs.get('distance_point'),
-                                     geo_sort=geo_sort)
+        self.log.warning(message)
+        return {
+            'results': [],
+            'hits': 0,
+            'facets': {},
+            'spelling_suggestion': None,
+            'timed_out': False,
+            'degraded': True,
+        }
+
+    def is_instrumented(self):
+        """Whether query statistics need to be collected at all."""
+        if self.slow_query_threshold is not None or self.query_callback is not None:
+            return True
+        return query_executed.has_listeners()
+
+    def instrument_query(self, query_string, search_kwargs, raw_results, results, timings,
+                         response_bytes=None, template=None):
+        """Collects query statistics and hands them to the configured consumers.
+
+        Statistics are sent through the ``query_executed`` signal and the
+        ``QUERY_CALLBACK`` connection option. Queries slower than
+        ``SLOW_QUERY_THRESHOLD`` seconds are kept in the slow query log and,
+        sampled by ``PROFILE_SAMPLE_RATE``, re-run with the ES profile API on
+        the prefetch thread pool before they are added to the log.
+        """
+        stats = {
+            'query_string': query_string,
+            'body': search_kwargs,
+            'timestamp': datetime.utcnow(),
+            'took': raw_results.get('took'),
+            'timed_out': raw_results.get('timed_out', False),
+            'shards': raw_results.get('_shards', {}),
+            'hits': results.get('hits', 0),
+            'returned': len(results.get('results', [])),
+            'response_bytes': response_bytes,
+            'template': template,
+        }
+        stats.update(timings)
+        stats['total_time'] = timings['build_time'] + timings['request_time'] + timings['process_time']
+
+        if self.slow_query_threshold is not None and stats['total_time'] >= self.slow_query_threshold:
+            # A template body can't be sent to ``_search``, it is not profiled.
+            profile = template is None and self.profile_sample_rate
+            if profile and random.random() < self.profile_sample_rate:
+                get_prefetch_executor().submit(self.log_profiled_query, dict(stats))
+            else:
+                self.slow_query_log.add(stats)
+
+        if self.query_callback is not None:
+            self.query_callback(self.connection_alias, stats)
+
+        query_executed.send(sender=self.__class__, connection_alias=self.connection_alias, stats=stats)
+
+    def log_profiled_query(self, stats):
+        """Adds a slow query to the slow query log with its profile."""
+        stats['profile'] = self.profile_query(stats['body'])
+        self.slow_query_log.add(stats)
+
+    def profile_query(self, search_kwargs):
+        """Re-runs a query with ``profile: true`` and returns the profile output."""
+        body = dict(search_kwargs, profile=True)
+        try:
+            raw_results = self.read_conn.search(body=body, index=self.index_name, doc_type='modelresult',
+                                                _source=False)
+        except elasticsearch.TransportError as e:
+            self.log.error("Failed to profile Elasticsearch query: %s", e, exc_info=True)
+            return None
+        return raw_results.get('profile')
 
     def _process_results(self, raw_results, highlight=False, result_class=None,
-                         distance_point=None, geo_sort=False):
+                         distance_point=None, geo_sort=False, aggregations=None, collapse=None):
         from haystack import connections
         results = []
         hits = raw_results.get('hits', {}).get('total', 0)
@@ -479,16 +1324,19 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
             result_class = SearchResult
 
         if self.include_spelling and 'suggest' in raw_results:
-            raw_suggest = raw_results['suggest'].get('suggest')
-            if raw_suggest:
-                spelling_suggestion = ' '.join(
-                    [
-                        word['text'] if len(word['options']) == 0 else word['options'][0]['text']
-                        for word in raw_suggest
-                    ]
-                )
+            spelling_suggestion = parse_spelling_suggestion(raw_results['suggest'].get('suggest'))
+
+        if collapse and COLLAPSE_COUNT_AGGREGATION_NAME in raw_results.get('aggregations', {}):
+            # There are never more groups than matching documents.
+            hits = min(raw_results['aggregations'][COLLAPSE_COUNT_AGGREGATION_NAME]['value'], hits)
+
+        # Only facets go into ``facets``, not the aggregations run for
+        # ``aggregations`` or to count collapsed groups.
+        facet_aggregations = dict(
+            (name, info) for name, info in raw_results.get('aggregations', {}).items()
+            if name != COLLAPSE_COUNT_AGGREGATION_NAME and not (aggregations and name in aggregations))
 
-        if 'aggregations' in raw_results:
+        if facet_aggregations:
             facets = {
                 'fields': {},
                 'dates': {},
@@ -502,8 +1350,7 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
                 else:
                     return datetime(1970, 1, 1) + timedelta(seconds=tm)
 
-            for facet_fieldname, facet_info in raw_results['aggregations'].items():
-
+            for facet_fieldname, facet_info in facet_aggregations.items():
                 try:
                     facet_type = facet_info['meta']['_type']
                 except KeyError:
@@ -531,29 +1378,43 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
 
         unified_index = connections[self.connection_alias].get_unified_index()
         indexed_models = unified_index.get_indexed_models()
+        lazy = issubclass(result_class, LazySearchResult)
+        converters = {}
 
         for raw_result in raw_results.get('hits', {}).get('hits', []):
             source = raw_result['_source']
+            group_hits = None
+            if 'inner_hits' in raw_result:
+                source = dict(source)
+                for path, inner_hits in raw_result['inner_hits'].items():
+                    if path == COLLAPSE_INNER_HITS_NAME:
+                        group_hits = inner_hits
+                        continue
+                    source[path] = [hit.get('_source', {}) for hit in inner_hits['hits']['hits']]
             app_label, model_name = source[DJANGO_CT].split('.')
             additional_fields = {}
             model = haystack_get_model(app_label, model_name)
 
             if model and model in indexed_models:
-                for key, value in source.items():
-                    index = unified_index.get_index(model)
-                    string_key = str(key)
+                if model not in converters:
+                    converters[model] = self.get_field_converter(unified_index.get_index(model))
+                convert = converters[model]
 
-                    if string_key in index.fields and hasattr(index.fields[string_key], 'convert'):
-                        additional_fields[string_key] = index.fields[string_key].convert(value)
-                    else:
-                        additional_fields[string_key] = self._to_python(value)
+                if not lazy:
+                    for key, value in source.items():
+                        string_key = str(key)
+                        additional_fields[string_key] = convert(string_key, value)
 
-                del(additional_fields[DJANGO_CT])
-                del(additional_fields[DJANGO_ID])
+                    del(additional_fields[DJANGO_CT])
+                    del(additional_fields[DJANGO_ID])
 
                 if 'highlight' in raw_result:
                     additional_fields['highlighted'] = raw_result['highlight']
 
+                if group_hits is not None:
+                    additional_fields['group_members'] = self._process_results(
+                        group_hits, highlight=highlight, result_class=result_class)['results']
+
                 if distance_point:
                     additional_fields['_point_of_origin'] = distance_point
 
@@ -563,19 +1424,210 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
                     else:
                         additional_fields['_distance'] = None
 
-                result = result_class(app_label, model_name, source[DJANGO_ID], raw_result['_score'],
-                                      **additional_fields)
+                if lazy:
+                    source = dict(source)
+                    del source[DJANGO_CT]
+                    django_id = source.pop(DJANGO_ID)
+                    result = result_class(app_label, model_name, django_id, raw_result['_score'],
+                                          source=source, converter=convert, **additional_fields)
+                else:
+                    result = result_class(app_label, model_name, source[DJANGO_ID], raw_result['_score'],
+                                          **additional_fields)
                 results.append(result)
             else:
                 hits -= 1
 
-        return {
+        processed = {
             'results': results,
             'hits': hits,
             'facets': facets,
             'spelling_suggestion': spelling_suggestion,
+            # Partial results, a budget ran out before all shards finished.
+            'timed_out': bool(raw_results.get('timed_out') or raw_results.get('terminated_early')),
         }
 
+        if aggregations:
+            raw_aggregations = raw_results.get('aggregations', {})
+            processed['aggregations'] = dict(
+                (name, aggregation.parse(raw_aggregations[name]))
+                for name, aggregation in aggregations.items() if name in raw_aggregations)
+
+        return processed
+
+    def spelling_suggestion(self, text):
+        """Returns the spelling suggestion for ``text`` from a suggest-only request.
+
+        The ``term`` suggester runs on the ``SPELLING_FIELD`` connection option,
+        ``_all`` by default. Suggestions are cached per field and text.
+        """
+        key = (self.spelling_field, text)
+        found, suggestion = self.spelling_cache.get(key)
+        if found:
+            return suggestion
+
+        if not self.setup_complete:
+            self.setup()
+
+        body = {
+            'size': 0,
+            'suggest': {'suggest': {'text': text, 'term': {'field': self.spelling_field}}},
+        }
+        try:
+            raw_results = self.read_conn.search(body=body, index=self.index_name, doc_type='modelresult')
+        except elasticsearch.TransportError as e:
+            if not self.silently_fail:
+                raise
+
+            self.log.error("Failed to fetch the spelling suggestion for '%s': %s", text, e, exc_info=True)
+            return None
+
+        suggestion = parse_spelling_suggestion(raw_results.get('suggest', {}).get('suggest'))
+        self.spelling_cache.set(key, suggestion)
+        return suggestion
+
+    def suggest_complete(self, prefix, size=10, field=None, contexts=None, models=None):
+        """Returns completion suggestions for ``prefix`` as ``LazySearchResult`` objects.
+
+        Suggestions come from the ``completion`` suggester of ``field``, the
+        first ``CompletionField`` of the unified index by default. When the
+        field has a ``django_ct`` context the suggestions are limited to
+        ``models``.
+        """
+        from haystack import connections
+
+        unified_index = connections[self.connection_alias].get_unified_index()
+        completion_fields = dict(
+            (field_class.index_fieldname, field_class)
+            for field_class in unified_index.all_searchfields().values()
+            if field_class.field_type == 'completion')
+        if field is None and completion_fields:
+            field = sorted(completion_fields)[0]
+        if field not in completion_fields:
+            raise SearchBackendError("No CompletionField named '%s' found." % field)
+
+        if not self.setup_complete:
+            self.setup()
+
+        completion = {'field': field, 'size': size}
+        contexts = dict(contexts or {})
+        if models and DJANGO_CT in completion_fields[field].contexts:
+            contexts.setdefault(DJANGO_CT, sorted(get_model_ct(model) for model in models))
+        if contexts:
+            completion['contexts'] = contexts
+
+        body = {
+            '_source': [DJANGO_CT, DJANGO_ID, field],
+            'size': 0,
+            'suggest': {'completion': {'prefix': prefix, 'completion': completion}},
+        }
+        try:
+            raw_results = self.read_conn.search(body=body, index=self.index_name, doc_type='modelresult')
+        except elasticsearch.TransportError as e:
+            if not self.silently_fail:
+                raise
+
+            self.log.error("Failed to fetch suggestions for '%s': %s", prefix, e, exc_info=True)
+            return []
+
+        results = []
+        converters = {}
+        for suggestion in raw_results.get('suggest', {}).get('completion', []):
+            for option in suggestion.get('options', []):
+                source = dict(option['_source'])
+                app_label, model_name = source.pop(DJANGO_CT).split('.')
+                model = haystack_get_model(app_label, model_name)
+                if model not in converters:
+                    converters[model] = self.get_field_converter(unified_index.get_index(model))
+                results.append(LazySearchResult(
+                    app_label, model_name, source.pop(DJANGO_ID), option.get('_score'), source=source,
+                    converter=converters[model], suggestion=option['text']))
+        return results
+
+    def get_field_converters(self, index):
+        """Returns the ``convert`` methods of the fields of ``index`` by field name.
+
+        The mapping is built once per index and shared between threads, it
+        only holds the index fields.
+        """
+        field_converters = _field_converters.get(index)
+        if field_converters is None:
+            field_converters = _field_converters[index] = dict(
+                (name, field.convert) for name, field in index.fields.items() if hasattr(field, 'convert'))
+        return field_converters
+
+    def get_field_converter(self, index):
+        """Returns a function converting raw source values of ``index`` to python."""
+        field_converters = self.get_field_converters(index)
+        to_python = self._to_python
+
+        def convert(key, value):
+            field_convert = field_converters.get(key)
+            if field_convert is not None:
+                return field_convert(value)
+            return to_python(value)
+
+        return convert
+
+    def compile_filter(self, expression, value):
+        """Compiles a single ``(expression, value)`` filter to a ``CompiledFilter``.
+
+        The returned clause is shared between queries and must not be modified.
+        """
+        if expression == 'content' and value:
+            return CompiledFilter(str(value), None, None)
+
+        _filter = None
+        try:
+            _value = value.prepare()
+        except AttributeError:
+            _value = str(value)
+        _field, _lookup = self.get_filter_lookup(expression)
+        _is_nested = NESTED_FILTER_SEPARATOR in _field
+        _nested_path = None
+        if _is_nested:
+            _nested_path = _field.split(NESTED_FILTER_SEPARATOR)[0]
+            _field = ('.').join(_field.split(NESTED_FILTER_SEPARATOR))
+        if _lookup == 'exact':
+            if _is_nested:
+                _filter = {'term': {_field: _value}}
+            else:
+                _filter = {'term': {_field + '.raw': _value}}
+        elif _lookup == 'content':
+            _filter = {'match': {_field: _value}}
+        elif _lookup == 'in':
+            if not isinstance(_value, list):
+                _value = ast.literal_eval(str(_value))
+            _filter = {
+                'query_string': {
+                    'fields': [_field],
+                    'query': ' OR '.join(['"%s"' % i for i in _value])
+                }}
+        elif _lookup == 'range':
+            if isinstance(_value, dict):
+                _filter = {'range': {_field: _value}}
+            elif _value:
+                if not isinstance(_value, list):
+                    _value = _value.split(',')
+                if len(_value) >= 2:
+                    _range = {}
+                    _range['gte'] = _value[0]
+                    _range['lte'] = _value[1]
+                    _filter = {'range': {_field: _range}}
+                else:
+                    raise ValueError(
+                        _('Range lookup requires minimum and maximum values,'
+                          'only one value was provided'))
+        else:
+            _filter = {
+                'query_string': {
+                    'fields': [_field],
+                    'query': FILTER_QUERY_STRINGS[_lookup] % _value,
+                }}
+
+        if _filter is None:
+            _nested_path = None
+        return CompiledFilter(None, _filter, _nested_path)
+
     def get_filter_lookup(self, expression):
         """Parses an expression and determines the field and filter type."""
         parts = expression.split(FILTER_SEPARATOR)
@@ -588,17 +1640,115 @@ class Elasticsearch5SearchBackend(ElasticsearchSearchBackend):
         return (field, filter_type)
 
 
+def warm_up(using=None):
+    """Sets up the Elasticsearch 5 backends ahead of the first search.
+
+    Meant for server hooks such as gunicorn's ``post_fork`` so no request
+    pays for the mapping check. ``using`` limits it to one connection alias.
+    """
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+
+    aliases = [using] if using is not None else haystack.connections.connections_info.keys()
+    for alias in aliases:
+        backend = haystack.connections[alias].get_backend()
+        if isinstance(backend, Elasticsearch5SearchBackend) and not backend.setup_complete:
+            backend.setup()
+
+
 class Elasticsearch5SearchQuery(ElasticsearchSearchQuery):
 
     def __init__(self, using=DEFAULT_ALIAS):
         self.boost_fields = {}
         self.boost_negative = []
-        self.filter_context = []
+        self.filter_chain = None
+        self.inner_hits = {}
+        self.collapse = None
+        self.rescore = None
+        self.budget = {}
+        self.preference = None
+        self.template = None
+        self._timed_out = None
+        self._degraded = None
+        self._prefetched = {}
+        self._spelling_query = None
         super(Elasticsearch5SearchQuery, self).__init__(using=using)
 
-    def build_query(self):
-        """Adds parameters to the filter context.
+    def run(self, spelling_query=None, **kwargs):
+        prefetched = self._prefetched.pop((self.start_offset, self.end_offset), None)
+        if prefetched is not None and (spelling_query is not None or kwargs):
+            # Built for other parameters, its request is of no use.
+            prefetched[1].cancel()
+        elif prefetched is not None:
+            query, future = prefetched
+            future.result()
+            self._results = query._results
+            self._hit_count = query._hit_count
+            self._facet_counts = query._facet_counts
+            self._spelling_suggestion = query._spelling_suggestion
+            self._spelling_query = query._spelling_query
+            self._timed_out = query._timed_out
+            self._degraded = query._degraded
+            return
+
+        final_query = self.build_query()
+        search_kwargs = self.build_params(spelling_query=spelling_query)
+
+        if kwargs:
+            search_kwargs.update(kwargs)
+
+        results = self.backend.search(final_query, **search_kwargs)
+        self._results = results.get('results', [])
+        self._hit_count = results.get('hits', 0)
+        self._facet_counts = self.post_process_facets(results)
+        self._spelling_suggestion = results.get('spelling_suggestion', None)
+        self._spelling_query = results.get('spelling_query')
+        self._timed_out = results.get('timed_out', False)
+        self._degraded = results.get('degraded', False)
+
+    def get_spelling_suggestion(self, preferred_query=None):
+        """Returns the spelling suggestion, fetching it on demand in lazy spelling mode."""
+        if not self.backend.include_spelling or self.backend.spelling_mode != SPELLING_LAZY:
+            return super(Elasticsearch5SearchQuery, self).get_spelling_suggestion(preferred_query)
+
+        if preferred_query:
+            return self.backend.spelling_suggestion(preferred_query)
+
+        if not self.has_run():
+            self.run()
+        if self._spelling_suggestion is None and self._spelling_query:
+            self._spelling_suggestion = self.backend.spelling_suggestion(self._spelling_query)
+        return self._spelling_suggestion
+
+    def prefetch(self, start_offset, end_offset):
+        """Runs the query for another slice in the background.
+
+        A later ``run`` for the same slice uses the prefetched results instead
+        of sending a new request.
+        """
+        key = (start_offset, end_offset)
+        if key in self._prefetched:
+            return self._prefetched[key][1]
+        query = self._clone()
+        query.set_limits(start_offset, end_offset)
+        future = get_prefetch_executor().submit(query.get_results)
+        self._prefetched[key] = (query, future)
+        return future
+
+    def cancel_prefetches(self, before=None):
+        """Cancels the prefetched slices not started yet and discards their results.
+
+        With ``before`` only the slices starting before that offset, which
+        iteration has already passed, are discarded.
         """
+        for key in list(self._prefetched):
+            if before is None or key[0] < before:
+                self._prefetched.pop(key)[1].cancel()
+
+    def build_query(self):
         final_query = self.matching_all_fragment()
 
         if self.boost:
@@ -609,18 +1759,11 @@ class Elasticsearch5SearchQuery(ElasticsearchSearchQuery):
 
             final_query = "%s %s" % (final_query, " ".join(boost_list))
 
-        self.build_filter_context(self.query_filter)
-
         return final_query
 
-    def build_filter_context(self, query_filter):
-        for f in query_filter.children:
-            if isinstance(f, SearchNode):
-                self.build_filter_context(f)
-            else:
-                filter_query = {f[0]: f[1]}
-                if filter_query not in self.filter_context:
-                    self.filter_context.append({f[0]: f[1]})
+    def add_filter(self, query_filter, use_or=False):
+        super(Elasticsearch5SearchQuery, self).add_filter(query_filter, use_or=use_or)
+        self.filter_chain = FilterNode.extend(self.filter_chain, query_filter)
 
     def build_params(self, spelling_query=None, **kwargs):
         search_kwargs = super(Elasticsearch5SearchQuery, self).build_params(spelling_query, **kwargs)
@@ -628,8 +1771,22 @@ class Elasticsearch5SearchQuery(ElasticsearchSearchQuery):
             search_kwargs['boost_fields'] = self.boost_fields
         if self.boost_negative:
             search_kwargs['boost_negative'] = self.boost_negative
-        if self.filter_context:
-            search_kwargs['filter_context'] = self.filter_context
+        if self.filter_chain is not None:
+            search_kwargs['filter_chain'] = self.filter_chain
+        if self.inner_hits:
+            search_kwargs['inner_hits'] = self.inner_hits
+        if self.collapse:
+            search_kwargs['collapse'] = self.collapse
+        if self.rescore:
+            search_kwargs['rescore'] = self.rescore
+        search_kwargs.update(self.budget)
+        if self.preference is not None:
+            search_kwargs['preference'] = self.preference
+        if self.template is not None:
+            name, params = self.template
+            escaped = self.backend.get_search_template(name).escaped
+            search_kwargs['template'] = (name, dict(
+                (param, self.clean(value) if param in escaped else value) for param, value in params.items()))
         return search_kwargs
 
     def add_boost_fields(self, fields):
@@ -640,14 +1797,91 @@ class Elasticsearch5SearchQuery(ElasticsearchSearchQuery):
         """Add negative boost to the query."""
         self.boost_negative = [query, negative_boost]
 
+    def add_inner_hits(self, path, **options):
+        """Returns the nested objects of ``path`` matching the filters as inner hits."""
+        self.inner_hits[path] = options
+
+    def add_collapse(self, field, size=None):
+        """Returns only the top hit per value of ``field``, with ``size`` group members."""
+        self.collapse = {'field': field, 'size': size}
+
+    def add_rescore(self, window_size, query=None, **options):
+        """Scores the top ``window_size`` hits per shard again with ``query``."""
+        self.rescore = dict(options, window_size=window_size, query=query)
+
+    def get_aggregations(self, aggregations):
+        """Runs ``aggregations`` over all matching documents and returns their values."""
+        search_kwargs = self.build_params()
+        search_kwargs.update(aggregations=aggregations, start_offset=0, end_offset=0)
+        results = self.backend.search(self.build_query(), **search_kwargs)
+        return results.get('aggregations', {})
+
+    def add_budget(self, timeout=None, terminate_after=None):
+        """Limits the time and the number of documents per shard spent on the search."""
+        if timeout is not None:
+            self.budget['timeout'] = timeout
+        if terminate_after is not None:
+            self.budget['terminate_after'] = terminate_after
+
+    def add_preference(self, preference):
+        """Sends the search to the shard copies picked by ``preference``."""
+        self.preference = preference
+
+    def add_template(self, name, params):
+        """Runs the stored search template ``name`` with ``params`` instead of the built query."""
+        self.template = (name, params)
+
+    def get_timed_out(self):
+        """Whether the results are partial, runs the query if needed."""
+        if self._timed_out is None:
+            self.run()
+        return self._timed_out
+
+    def get_degraded(self):
+        """Whether the search was rejected by the circuit breaker, runs the query if needed."""
+        if self._degraded is None:
+            self.run()
+        return self._degraded
+
+    def _reset(self):
+        super(Elasticsearch5SearchQuery, self)._reset()
+        self._spelling_query = None
+        self._timed_out = None
+        self._degraded = None
+
     def _clone(self, klass=None, using=None):
         clone = super(Elasticsearch5SearchQuery, self)._clone(klass, using)
+        clone.inner_hits = self.inner_hits.copy()
         clone.boost_fields = self.boost_fields.copy()
         clone.boost_negative = self.boost_negative.copy()
-        clone.filter_context = self.filter_context.copy()
+        clone.filter_chain = self.filter_chain
+        clone.collapse = self.collapse
+        clone.rescore = self.rescore
+        clone.budget = self.budget.copy()
+        clone.preference = self.preference
+        clone.template = self.template
         return clone
 
 
 class Elasticsearch5SearchEngine(BaseEngine):
     backend = Elasticsearch5SearchBackend
     query = Elasticsearch5SearchQuery
+
+    def get_unified_index(self):
+        """Returns the ``UnifiedIndex`` of this alias shared by all threads.
+
+        Haystack keeps an engine per thread, each building its own unified
+        index and index instances, only the backend needs to be per thread.
+        The shared index is dropped when the Haystack settings change, or by
+        ``reset_unified_indexes``.
+        """
+        if self._index is None:
+            excluded_indexes = self.options.get('EXCLUDED_INDEXES', [])
+            key = (self.using, self.options.get('ENGINE'), tuple(excluded_indexes))
+            with _unified_indexes_lock:
+                if key not in _unified_indexes:
+                    unified_index = self.unified_index(excluded_indexes)
+                    unified_index.build()
+                    _unified_indexes[key] = unified_index
+                self._index = _unified_indexes[key]
+        return self._index
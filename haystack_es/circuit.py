@@ -0,0 +1,122 @@
+# -*- coding: utf-8
+
+import threading
+from collections import namedtuple
+from timeit import default_timer
+
+from haystack.exceptions import SearchBackendError
+
+__all__ = ['SearchUnavailable', 'CircuitBreaker', 'Permit', 'get_circuit_breaker']
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+# Handed out by ``CircuitBreaker.acquire``. ``generation`` counts the times
+# the circuit opened before the search started.
+Permit = namedtuple('Permit', ['trial', 'generation'])
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+class SearchUnavailable(SearchBackendError):
+    """Raised when a search is rejected without contacting Elasticsearch."""
+
+
+class CircuitBreaker(object):
+    """Limits concurrent searches and stops searching while Elasticsearch is slow.
+
+    At most ``max_concurrent`` searches run at once, others wait up to
+    ``queue_timeout`` seconds for a slot. After ``failure_threshold``
+    consecutive searches failed or took longer than ``latency_threshold``
+    seconds the circuit opens and searches are rejected for ``reset_timeout``
+    seconds. Then a single trial search decides whether it closes again,
+    searches started before the circuit opened don't count.
+    """
+
+    def __init__(self, max_concurrent=None, queue_timeout=0, latency_threshold=None,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.latency_threshold = latency_threshold
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._generation = 0
+        self._slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def acquire(self):
+        """Returns a ``Permit`` if a search may run, else ``None``.
+
+        The permit must be passed to ``release`` once the search is done.
+        """
+        with self._lock:
+            trial = False
+            if self.opened_at is not None:
+                if self._trial or default_timer() - self.opened_at < self.reset_timeout:
+                    return None
+                self._trial = trial = True
+            permit = Permit(trial, self._generation)
+
+        if self._slots is not None:
+            if self.queue_timeout:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            else:
+                acquired = self._slots.acquire(False)
+            if not acquired:
+                if trial:
+                    with self._lock:
+                        self._trial = False
+                return None
+        return permit
+
+    def release(self, permit, latency, failed=False):
+        """Records the outcome of the search started with ``permit``."""
+        if self._slots is not None:
+            self._slots.release()
+
+        failed = failed or (self.latency_threshold is not None and latency > self.latency_threshold)
+        with self._lock:
+            if permit.trial:
+                # Only the trial search moves the circuit out of half-open.
+                self._trial = False
+                if failed:
+                    self._open()
+                else:
+                    self.failures = 0
+                    self.opened_at = None
+            elif permit.generation != self._generation or self.opened_at is not None:
+                # Started before the circuit opened, its outcome is already
+                # accounted for by the failures that opened it.
+                return
+            elif failed:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self._open()
+            else:
+                self.failures = 0
+
+    def _open(self):
+        self.opened_at = default_timer()
+        self._generation += 1
+
+    def reset(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+
+def get_circuit_breaker(connection_alias, **options):
+    """Returns the process wide circuit breaker of a connection."""
+    with _circuit_breakers_lock:
+        if connection_alias not in _circuit_breakers:
+            _circuit_breakers[connection_alias] = CircuitBreaker(**options)
+        return _circuit_breakers[connection_alias]
@@ -1,20 +1,237 @@
 # -*- coding: utf-8
 
 import json
-from haystack.fields import SearchField, CharField
+
+from django.utils import six
+
+from haystack.fields import SearchField, CharField as BaseCharField, LocationField as BaseLocationField
+
+GEOJSON_TYPES = dict((geojson_type.lower(), geojson_type) for geojson_type in (
+    'Point', 'MultiPoint', 'LineString', 'MultiLineString', 'Polygon', 'MultiPolygon', 'GeometryCollection'))
+
+DICT_STORAGE_OBJECT = 'object'
+DICT_STORAGE_DISABLED = 'disabled'
+DICT_STORAGE_FLATTENED = 'flattened'
+DICT_STORAGES = (DICT_STORAGE_OBJECT, DICT_STORAGE_DISABLED, DICT_STORAGE_FLATTENED)
+
+
+def geometry_to_geojson(geometry):
+    """Returns the GeoJSON-like dict of a ``GEOSGeometry`` as ES expects it, from its coordinates."""
+    if geometry.geom_type == 'GeometryCollection':
+        return {'type': 'geometrycollection', 'geometries': [geometry_to_geojson(part) for part in geometry]}
+    return {'type': geometry.geom_type.lower(), 'coordinates': geometry.coords}
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, item.lower() if key == 'type' else _freeze(item))
+                            for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, six.integer_types + (float,)):
+        return float(value)
+    return value
+
+
+def _geos_geojson(geojson):
+    geojson = dict(geojson)
+    geojson['type'] = GEOJSON_TYPES.get(geojson['type'].lower(), geojson['type'])
+    if 'geometries' in geojson:
+        geojson['geometries'] = [_geos_geojson(part) for part in geojson['geometries']]
+    return geojson
+
+
+class LazyGeometry(object):
+    """A geometry read from the index, turned into a ``GEOSGeometry`` on first use.
+
+    ``type`` and ``coordinates`` are the raw values of the document and don't
+    need GEOS, any other attribute is read from the ``GEOSGeometry``. It is
+    not a ``GEOSGeometry`` instance, use ``geometry`` where one is needed. It
+    compares equal to a geometry with the same coordinates, as long as it is
+    on the left, ``lazy == Point(...)``, and its hash only depends on the
+    coordinates.
+    """
+
+    __slots__ = ('geojson', '_geometry')
+
+    def __init__(self, geojson):
+        self.geojson = geojson
+        self._geometry = None
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.type)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyGeometry):
+            return _freeze(self.geojson) == _freeze(other.geojson)
+        if hasattr(other, 'geom_type'):
+            return _freeze(self.geojson) == _freeze(geometry_to_geojson(other))
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(_freeze(self.geojson))
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self.geometry, attr)
+
+    def __getstate__(self):
+        return {'geojson': self.geojson}
+
+    def __setstate__(self, state):
+        self.geojson = state['geojson']
+        self._geometry = None
+
+    @property
+    def type(self):
+        return self.geojson.get('type')
+
+    @property
+    def coordinates(self):
+        return self.geojson.get('coordinates')
+
+    @property
+    def geometry(self):
+        if self._geometry is None:
+            self._geometry = self.build_geometry()
+        return self._geometry
+
+    def build_geometry(self):
+        from django.contrib.gis.geos import GEOSGeometry
+
+        return GEOSGeometry(json.dumps(_geos_geojson(self.geojson)))
+
+
+class LazyPoint(LazyGeometry):
+    """A location read from the index, ``lat``, ``lon`` and ``coords`` don't need GEOS."""
+
+    __slots__ = ()
+
+    def __init__(self, lat, lon):
+        super(LazyPoint, self).__init__({'type': 'point', 'coordinates': [lon, lat]})
+
+    @property
+    def lat(self):
+        return self.coordinates[1]
+
+    @property
+    def lon(self):
+        return self.coordinates[0]
+
+    @property
+    def coords(self):
+        return tuple(self.coordinates)
+
+    def build_geometry(self):
+        from haystack.utils.geo import Point
+
+        return Point(self.lon, self.lat)
+
+
+class MappingOptionsMixin(object):
+    """Sets the ``mapping_options`` attributes that are not ``None`` on the field mapping."""
+    mapping_options = ()
+
+    def get_mapping_options(self):
+        return dict((option, getattr(self, option)) for option in self.mapping_options
+                    if getattr(self, option) is not None)
+
+
+class CharField(MappingOptionsMixin, BaseCharField):
+    """Text field with ``term_vector`` and ``index_options`` set on the mapping.
+
+    ``term_vector='with_positions_offsets'`` allows the ``fvh`` highlighter and
+    ``index_options='offsets'`` the ``postings`` highlighter, neither has to
+    re-analyze the text of each hit.
+    """
+    mapping_options = ('term_vector', 'index_options')
+
+    def __init__(self, term_vector=None, index_options=None, **kwargs):
+        super(CharField, self).__init__(**kwargs)
+        self.term_vector = term_vector
+        self.index_options = index_options
 
 
 class DictField(SearchField):
+    """Field for free-form dicts, stored as set by ``storage``.
+
+    * ``'object'`` (default) maps each key as an object property, ``dynamic``
+      (``True``, ``False`` or ``'strict'``) sets whether unknown keys are
+      mapped, ignored or rejected.
+    * ``'disabled'`` keeps the dict in the source only, it is neither mapped
+      nor searchable.
+    * ``'flattened'`` indexes a single keyword field of ``key=value`` pairs,
+      nested keys joined with dots, filtered with e.g.
+      ``attributes__exact='color=red'``. Values are read back as strings. A
+      ``prepare_<field>`` method of the index must return ``flatten`` pairs.
+
+    With ``'disabled'`` and ``'flattened'`` the mapping doesn't grow with the
+    number of distinct keys.
+    """
     field_type = 'dict'
 
-    def prepare(self, obj):
-        return self.convert(super(DictField, self).prepare(obj))
+    def __init__(self, storage=DICT_STORAGE_OBJECT, dynamic=None, separator='=', **kwargs):
+        if storage not in DICT_STORAGES:
+            raise ValueError("Unknown DictField storage '%s'." % storage)
+        if dynamic not in (None, True, False, 'strict'):
+            raise ValueError("DictField dynamic must be True, False or 'strict'.")
+        if dynamic is not None and storage != DICT_STORAGE_OBJECT:
+            raise ValueError("DictField dynamic only applies to the '%s' storage." % DICT_STORAGE_OBJECT)
+        super(DictField, self).__init__(**kwargs)
+        self.storage = storage
+        self.dynamic = dynamic
+        self.separator = separator
 
-    def convert(self, value):
+    def get_mapping_options(self):
+        if self.storage == DICT_STORAGE_DISABLED:
+            return {'enabled': False}
+        if self.storage == DICT_STORAGE_FLATTENED:
+            return {'type': 'keyword'}
+        if self.dynamic is not None:
+            return {'dynamic': self.dynamic}
+        return {}
+
+    def prepare(self, obj):
+        value = super(DictField, self).prepare(obj)
         if value is None:
             return None
+        if self.storage == DICT_STORAGE_FLATTENED:
+            return sorted(self.flatten(value))
         return dict(value)
 
+    def flatten(self, value, prefix=''):
+        for key, item in value.items():
+            key = '%s%s' % (prefix, key)
+            if isinstance(item, dict):
+                for pair in self.flatten(item, prefix=key + '.'):
+                    yield pair
+            elif isinstance(item, (list, tuple)):
+                for element in item:
+                    yield '%s%s%s' % (key, self.separator, element)
+            elif item is not None:
+                yield '%s%s%s' % (key, self.separator, item)
+
+    def convert(self, value):
+        if value is None or isinstance(value, dict):
+            return value
+        if isinstance(value, six.string_types):
+            value = [value]
+        converted = {}
+        for pair in value:
+            key, _, item = pair.partition(self.separator)
+            if key in converted:
+                if not isinstance(converted[key], list):
+                    converted[key] = [converted[key]]
+                converted[key].append(item)
+            else:
+                converted[key] = item
+        return converted
+
 
 class NestedField(SearchField):
     field_type = 'nested'
@@ -38,26 +255,100 @@ class NestedField(SearchField):
         return values
 
 
-class GeometryField(SearchField):
-    field_type = 'geometry'
+class LocationField(BaseLocationField):
+    """Location field whose values are ``LazyPoint`` objects.
+
+    Besides geometries, a ``{'lat': ..., 'lon': ...}`` dict or a ``(lat, lon)``
+    tuple can be indexed without GEOS.
+    """
 
     def prepare(self, obj):
-        from haystack.utils.geo import ensure_geometry
+        value = SearchField.prepare(self, obj)
+        if value is None:
+            return None
+        if isinstance(value, dict):
+            return {'lat': float(value['lat']), 'lon': float(value['lon'])}
+        if isinstance(value, (list, tuple)):
+            return {'lat': float(value[0]), 'lon': float(value[1])}
+        if isinstance(value, LazyPoint):
+            return {'lat': value.lat, 'lon': value.lon}
 
+        from haystack.utils.geo import ensure_point
+
+        lon, lat = ensure_point(value).coords
+        return {'lat': lat, 'lon': lon}
+
+    def convert(self, value):
+        if value is None or isinstance(value, LazyPoint):
+            return value
+        if hasattr(value, 'geom_type'):
+            lon, lat = value.coords
+        elif isinstance(value, six.string_types):
+            lat, lon = value.split(',')
+        elif isinstance(value, (list, tuple)):
+            # GeoJSON-alike
+            lon, lat = value[0], value[1]
+        elif isinstance(value, dict):
+            lat, lon = value.get('lat', 0), value.get('lon', 0)
+        else:
+            raise TypeError('Unable to extract coordinates from %r' % value)
+        return LazyPoint(float(lat), float(lon))
+
+
+class GeometryField(MappingOptionsMixin, SearchField):
+    """Field mapped to the Elasticsearch ``geo_shape`` type, with ``LazyGeometry`` values.
+
+    ``tree``, ``precision``, ``tree_levels``, ``distance_error_pct``,
+    ``strategy`` and ``points_only`` are set on the mapping, a coarser
+    ``precision`` makes indexing and shape filters faster.
+    """
+    field_type = 'geometry'
+    mapping_options = ('tree', 'precision', 'tree_levels', 'distance_error_pct', 'strategy', 'points_only')
+
+    def __init__(self, tree=None, precision=None, tree_levels=None, distance_error_pct=None, strategy=None,
+                 points_only=None, **kwargs):
+        super(GeometryField, self).__init__(**kwargs)
+        self.tree = tree
+        self.precision = precision
+        self.tree_levels = tree_levels
+        self.distance_error_pct = distance_error_pct
+        self.strategy = strategy
+        self.points_only = points_only
+
+    def prepare(self, obj):
         value = super(GeometryField, self).prepare(obj)
         if not value:
             return value
-        value = ensure_geometry(value)
-        value = json.loads(value.geojson)
+        if isinstance(value, LazyGeometry):
+            value = value.geojson
+        if isinstance(value, dict):
+            value = dict(value)
+        else:
+            from haystack.utils.geo import ensure_geometry
+
+            value = geometry_to_geojson(ensure_geometry(value))
         value['type'] = value['type'].lower()
         return value
 
     def convert(self, value):
-        from django.contrib.gis.geos import GEOSGeometry
+        if value is None or isinstance(value, LazyGeometry):
+            return value
+        if hasattr(value, 'geom_type'):
+            value = geometry_to_geojson(value)
+        return LazyGeometry(value)
 
-        if value is None:
-            return None
-        return GEOSGeometry(value)
+
+class CompletionField(SearchField):
+    """Field mapped to the Elasticsearch ``completion`` type.
+
+    ``contexts`` is a list of document fields, e.g. ``['django_ct']``, used as
+    category contexts for filtering suggestions.
+    """
+    field_type = 'completion'
+
+    def __init__(self, contexts=None, **kwargs):
+        super(CompletionField, self).__init__(**kwargs)
+        self.contexts = list(contexts or [])
 
 
 class NgramField(CharField):
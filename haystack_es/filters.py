@@ -0,0 +1,111 @@
+# -*- coding: utf-8
+
+from collections import namedtuple
+
+from django.utils import tree
+
+__all__ = ['CompiledFilter', 'FilterNode']
+
+# A filter compiled by ``Elasticsearch5SearchBackend.compile_filter``. Either
+# ``query_string`` is set, for plain ``content`` filters which become part of
+# the main query string, or ``clause`` holds the query DSL of the filter which
+# goes inside a ``nested`` query when ``nested_path`` is set.
+CompiledFilter = namedtuple('CompiledFilter', ['query_string', 'clause', 'nested_path'])
+
+
+def freeze(value):
+    """Returns a hashable representation of a filter value."""
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(freeze(v) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return (type(value), frozenset(freeze(v) for v in value))
+    if isinstance(value, dict):
+        return (dict, frozenset((k, freeze(v)) for k, v in value.items()))
+    try:
+        hash(value)
+    except TypeError:
+        return (type(value), repr(value))
+    return (type(value), value)
+
+
+class FilterNode(object):
+    """Immutable link in a chain of ``(expression, value)`` filters.
+
+    Each node points at the filters added before it, so clones of a query
+    share every filter they have in common and a filter is compiled only once
+    per connection, no matter how many clones use it. A chain holds each
+    filter once.
+    """
+
+    __slots__ = ('expression', 'value', 'parent', 'key', 'length', '_hash', '_compiled')
+
+    def __init__(self, expression, value, parent=None):
+        self.expression = expression
+        self.value = value
+        self.parent = parent
+        self.key = (expression, freeze(value))
+        self.length = 1 if parent is None else parent.length + 1
+        self._hash = hash((self.key, parent._hash if parent is not None else None))
+        # Compiled filters by connection alias, as mappings can differ.
+        self._compiled = {}
+
+    @classmethod
+    def extend(cls, chain, query_filter):
+        """Returns ``chain`` extended with the filters of a ``SearchNode`` tree it doesn't hold yet."""
+        keys = set(node.key for node in chain) if chain is not None else set()
+        return cls._extend(chain, query_filter, keys)
+
+    @classmethod
+    def _extend(cls, chain, query_filter, keys):
+        for child in query_filter.children:
+            if isinstance(child, tree.Node):
+                chain = cls._extend(chain, child, keys)
+                continue
+            key = (child[0], freeze(child[1]))
+            if key not in keys:
+                keys.add(key)
+                chain = cls(child[0], child[1], chain)
+        return chain
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, FilterNode) or self.length != other.length:
+            return False
+        node = self
+        while node is not None:
+            if node is other:
+                return True
+            if node._hash != other._hash or node.key != other.key:
+                return False
+            node, other = node.parent, other.parent
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        nodes = []
+        node = self
+        while node is not None:
+            nodes.append(node)
+            node = node.parent
+        return reversed(nodes)
+
+    def __repr__(self):
+        return '<FilterNode: %s>' % ', '.join('%s=%r' % (node.expression, node.value) for node in self)
+
+    def compile_node(self, backend):
+        compiled = self._compiled.get(backend.connection_alias)
+        if compiled is None:
+            compiled = self._compiled[backend.connection_alias] = backend.compile_filter(
+                self.expression, self.value)
+        return compiled
+
+    def compile(self, backend):
+        """Returns the compiled filters of the chain."""
+        return [node.compile_node(backend) for node in self]
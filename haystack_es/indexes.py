@@ -4,6 +4,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import threading
+import weakref
 
 from django.utils.six import with_metaclass
 
@@ -70,8 +71,56 @@ class _Elasticsearch5Index(with_metaclass(DeclarativeMetaclass, threading.local)
     pass
 
 
+# Attributes holding the state of the object being prepared, these are the only
+# ones kept per thread. Everything else set up by ``__init__`` is read-only.
+THREAD_LOCAL_ATTRIBUTES = ('prepared_data',)
+
+_shared_states = weakref.WeakKeyDictionary()
+_shared_states_lock = threading.RLock()
+
+
+def init_shared_state(index, init, *args, **kwargs):
+    """Runs ``init`` for the first thread using ``index`` only.
+
+    ``threading.local`` calls ``__init__`` again in every thread touching the
+    index. Other threads get the attributes set up by the first one instead, so
+    field definitions and field name maps exist once per process.
+    """
+    with _shared_states_lock:
+        state = _shared_states.get(index)
+        if state is None:
+            init(*args, **kwargs)
+            # Nested calls from subclass initializers run with the lock held,
+            # the outermost one stores the complete state last.
+            _shared_states[index] = dict((attr, value) for attr, value in index.__dict__.items()
+                                         if attr not in THREAD_LOCAL_ATTRIBUTES)
+            return
+
+    index.__dict__.update(state)
+    for attr in THREAD_LOCAL_ATTRIBUTES:
+        setattr(index, attr, None)
+
+
 class Elasticsearch5SearchIndex(SearchIndex, _Elasticsearch5Index):  # noqa: F405
-    pass
+    # Relations to follow when loading model instances for search results.
+    select_related = None
+    prefetch_related = None
+    # ``haystack_es.scoring`` functions applied to the documents of this index
+    # and how they combine, see Elasticsearch's ``function_score`` query.
+    score_functions = None
+    score_mode = 'multiply'
+    boost_mode = 'multiply'
+
+    def __init__(self, *args, **kwargs):
+        init_shared_state(self, super(Elasticsearch5SearchIndex, self).__init__, *args, **kwargs)
+
+    def read_queryset(self, using=None):
+        queryset = super(Elasticsearch5SearchIndex, self).read_queryset(using=using)
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        return queryset
 
 
 SearchIndex = Elasticsearch5SearchIndex
@@ -82,7 +131,9 @@ class BasicSearchIndex(SearchIndex):
 
 
 class Elasticsearch5ModelSearchIndex(ModelSearchIndex, SearchIndex):  # noqa: F405
-    pass
+
+    def __init__(self, *args, **kwargs):
+        init_shared_state(self, super(Elasticsearch5ModelSearchIndex, self).__init__, *args, **kwargs)
 
 
 ModelSearchIndex = Elasticsearch5ModelSearchIndex
@@ -92,7 +143,9 @@ try:
     from celery_haystack.indexes import CelerySearchIndex
 
     class Elasticsearch5CelerySearchIndex(CelerySearchIndex, SearchIndex):
-        pass
+
+        def __init__(self, *args, **kwargs):
+            init_shared_state(self, super(Elasticsearch5CelerySearchIndex, self).__init__, *args, **kwargs)
 
     CelerySearchIndex = Elasticsearch5CelerySearchIndex
 except ImportError:
@@ -0,0 +1,108 @@
+# -*- coding: utf-8
+
+import threading
+from collections import deque
+
+from django.core.cache import caches
+from django.utils import six
+
+__all__ = ['ResponseSizeRecorder', 'SlowQueryLog', 'get_slow_query_log']
+
+DEFAULT_SLOW_QUERY_LOG_SIZE = 50
+SLOW_QUERY_CACHE_KEY = 'haystack_es:slow_queries:%s'
+
+_slow_query_logs = {}
+_slow_query_logs_lock = threading.Lock()
+
+
+class SlowQueryLog(object):
+    """Bounded buffer of the most recent slow queries for a connection.
+
+    Entries are kept in process memory. When ``cache_alias`` is given they are
+    mirrored to that Django cache so other processes, e.g. the
+    ``es_slow_queries`` management command, can read them.
+    """
+
+    def __init__(self, connection_alias, size=DEFAULT_SLOW_QUERY_LOG_SIZE, cache_alias=None):
+        self.connection_alias = connection_alias
+        self.size = size
+        self.cache_alias = cache_alias
+        self.cache_key = SLOW_QUERY_CACHE_KEY % connection_alias
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        if self.cache_alias is None:
+            return None
+        return caches[self.cache_alias]
+
+    def add(self, stats):
+        with self._lock:
+            self._entries.append(stats)
+            if self.cache is not None:
+                entries = self.cache.get(self.cache_key) or []
+                entries.append(stats)
+                self.cache.set(self.cache_key, entries[-self.size:], None)
+
+    def entries(self):
+        if self.cache is not None:
+            return list(self.cache.get(self.cache_key) or [])
+        with self._lock:
+            return list(self._entries)
+
+    def slowest(self, limit=None):
+        """Returns the buffered queries ordered by total time, slowest first."""
+        entries = sorted(self.entries(), key=lambda s: s['total_time'], reverse=True)
+        if limit is not None:
+            entries = entries[:limit]
+        return entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self.cache is not None:
+                self.cache.delete(self.cache_key)
+
+
+def get_slow_query_log(connection_alias, size=DEFAULT_SLOW_QUERY_LOG_SIZE, cache_alias=None):
+    """Returns the process wide slow query log of a connection."""
+    with _slow_query_logs_lock:
+        if connection_alias not in _slow_query_logs:
+            _slow_query_logs[connection_alias] = SlowQueryLog(connection_alias, size=size,
+                                                              cache_alias=cache_alias)
+        return _slow_query_logs[connection_alias]
+
+
+class ResponseSizeRecorder(object):
+    """Wraps the deserializer of a transport to keep the size of the last response body.
+
+    The size is the one received over the wire, kept per thread, so it costs
+    nothing beyond the ``len`` of a body that is decoded anyway.
+    """
+
+    def __init__(self, deserializer):
+        self.deserializer = deserializer
+        self._local = threading.local()
+
+    @classmethod
+    def install(cls, client):
+        """Wraps the deserializer of ``client``, returns ``None`` for clients without one."""
+        transport = getattr(client, 'transport', None)
+        deserializer = getattr(transport, 'deserializer', None)
+        if deserializer is None:
+            return None
+        if not isinstance(deserializer, cls):
+            transport.deserializer = cls(deserializer)
+        return transport.deserializer
+
+    @property
+    def size(self):
+        return getattr(self._local, 'size', None)
+
+    def reset(self):
+        self._local.size = None
+
+    def loads(self, s, mimetype=None):
+        self._local.size = len(s.encode('utf-8') if isinstance(s, six.text_type) else s)
+        return self.deserializer.loads(s, mimetype)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from haystack import connections
+from haystack.constants import DEFAULT_ALIAS
+from haystack.utils import get_model_ct
+
+from haystack_es.reconcile import reconcile
+
+
+class Command(BaseCommand):
+    help = ("Reindexes the objects missing from the index and removes the documents of deleted objects, "
+            "without a full rebuild.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'labels', nargs='*', metavar='app_label[.ModelName]',
+            help='The apps or models to reconcile, all indexed models by default.')
+        parser.add_argument(
+            '-u', '--using', default=DEFAULT_ALIAS,
+            help='The search connection to reconcile.')
+        parser.add_argument(
+            '-b', '--batch-size', type=int, dest='batch_size',
+            help='Number of ids compared per request, defaults to the BATCH_SIZE of the connection.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report the differences.')
+
+    def get_models(self, unified_index, labels):
+        models = unified_index.get_indexed_models()
+        if not labels:
+            return models
+
+        selected = []
+        for label in labels:
+            try:
+                if '.' in label:
+                    selected.append(apps.get_model(label))
+                else:
+                    selected.extend(apps.get_app_config(label).get_models())
+            except LookupError as e:
+                raise CommandError(e)
+        return [model for model in models if model in selected]
+
+    def handle(self, **options):
+        connection = connections[options['using']]
+        backend = connection.get_backend()
+        unified_index = connection.get_unified_index()
+
+        for model in self.get_models(unified_index, options['labels']):
+            index = unified_index.get_index(model)
+            result = reconcile(backend, index, batch_size=options['batch_size'], dry_run=options['dry_run'])
+            self.stdout.write(
+                '%s: %d objects, %d documents, %d missing %s, %d stale %s' % (
+                    get_model_ct(model), result.objects, result.documents,
+                    result.missing, 'to reindex' if options['dry_run'] else 'reindexed',
+                    result.stale, 'to remove' if options['dry_run'] else 'removed'))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8
+
+import elasticsearch
+
+from django.core.management.base import BaseCommand
+
+from haystack import connections
+from haystack.constants import DEFAULT_ALIAS
+
+from haystack_es.querylog import (DEFAULT_REPLAY_CONCURRENCY, REPLAY_PERCENTILES, percentile, read_query_log,
+                                  replay)
+
+
+class Command(BaseCommand):
+    help = "Replays a recorded query log and reports latency percentiles, throughput and errors."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The query log written through the QUERY_LOG_PATH option.')
+        parser.add_argument(
+            '-u', '--using', default=DEFAULT_ALIAS,
+            help='The search connection to send the queries to.')
+        parser.add_argument(
+            '--url',
+            help='Send the queries to this cluster instead of the one of the connection.')
+        parser.add_argument(
+            '--index',
+            help='Send the queries to this index instead of the one of the connection.')
+        parser.add_argument(
+            '-c', '--concurrency', type=int, default=DEFAULT_REPLAY_CONCURRENCY,
+            help='Number of queries sent at once.')
+        parser.add_argument(
+            '-l', '--limit', type=int,
+            help='Maximum number of queries to replay.')
+
+    def handle(self, **options):
+        backend = connections[options['using']].get_backend()
+        conn = elasticsearch.Elasticsearch(options['url']) if options['url'] else backend.read_conn
+        index_name = options['index'] or backend.index_name
+
+        report = replay(conn, index_name, read_query_log(options['path'], limit=options['limit']),
+                        concurrency=options['concurrency'])
+
+        error_rate = float(report.errors) / report.requests if report.requests else 0
+        throughput = report.requests / report.duration if report.duration else 0
+        self.stdout.write('%d queries in %.3fs (%.1f/s), %d errors (%.2f%%)' % (
+            report.requests, report.duration, throughput, report.errors, error_rate * 100))
+        if report.latencies:
+            latencies = ['p%s %.3fs' % (percent, percentile(report.latencies, percent))
+                         for percent in REPLAY_PERCENTILES]
+            latencies.append('max %.3fs' % report.latencies[-1])
+            self.stdout.write('latency %s' % ', '.join(latencies))
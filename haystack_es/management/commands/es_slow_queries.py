@@ -0,0 +1,43 @@
+# -*- coding: utf-8
+
+import json
+
+from django.core.management.base import BaseCommand
+
+from haystack import connections
+from haystack.constants import DEFAULT_ALIAS
+
+
+class Command(BaseCommand):
+    help = "Shows the slowest recent queries recorded by the Elasticsearch 5 backend."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-u', '--using', default=DEFAULT_ALIAS,
+            help='The search connection to read the slow query log of.')
+        parser.add_argument(
+            '-l', '--limit', type=int, default=10,
+            help='Maximum number of queries to show.')
+        parser.add_argument(
+            '--json', action='store_true', dest='as_json',
+            help='Output the full query statistics as JSON.')
+        parser.add_argument(
+            '--clear', action='store_true',
+            help='Clear the slow query log after showing it.')
+
+    def handle(self, **options):
+        backend = connections[options['using']].get_backend()
+        slow_query_log = backend.slow_query_log
+        entries = slow_query_log.slowest(options['limit'])
+
+        if options['as_json']:
+            self.stdout.write(json.dumps(entries, indent=2, default=str))
+        else:
+            for stats in entries:
+                self.stdout.write(
+                    '%(total_time).3fs (build %(build_time).3fs, request %(request_time).3fs, '
+                    'took %(took)sms, process %(process_time).3fs) hits=%(hits)s '
+                    'bytes=%(response_bytes)s: %(query_string)s' % stats)
+
+        if options['clear']:
+            slow_query_log.clear()
@@ -0,0 +1,1173 @@
+# -*- coding: utf-8
+"""In-process stand-in for Elasticsearch.
+
+``InMemorySearchEngine`` runs the regular ``Elasticsearch5SearchBackend`` code
+path, including ``build_search_kwargs`` and ``_process_results``, against an
+in-memory document store instead of a cluster. It understands the subset of
+the query DSL the backend produces: ``bool``, ``term``, ``terms``, ``range``,
+``match``, ``query_string``, ``nested``, ``boosting``, ``function_score`` and
+``percolate`` queries, ``terms``, ``date_histogram``, ``date_range``,
+``filter``, ``stats``, ``extended_stats``, ``cardinality``, ``percentiles``,
+``histogram``, ``nested``, ``geohash_grid``, ``geo_bounds`` and
+``geo_centroid`` aggregations, ``completion`` and ``term`` suggesters, field
+collapsing, ``terminate_after``, sorting, paging, scrolling, ``mget``,
+``msearch`` and stored search templates. Scoring is not emulated, every hit
+scores ``1.0``, ``rescore`` and ``timeout`` are ignored.
+
+Example::
+
+    HAYSTACK_CONNECTIONS = {
+        'default': {
+            'ENGINE': 'haystack_es.memory.InMemorySearchEngine',
+            'INDEX_NAME': 'test',
+        }
+    }
+"""
+
+import copy
+import fnmatch
+import json
+import re
+import threading
+import uuid
+from datetime import datetime
+
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.serializer import DEFAULT_SERIALIZERS, Deserializer, JSONSerializer
+
+from django.utils import six
+
+from .backends import Elasticsearch5SearchBackend, Elasticsearch5SearchEngine, Elasticsearch5SearchQuery
+from .instrumentation import ResponseSizeRecorder
+
+__all__ = ['InMemoryElasticsearch', 'InMemorySearchBackend', 'InMemorySearchEngine']
+
+DEFAULT_SIZE = 10
+DEFAULT_TERMS_SIZE = 10
+DEFAULT_PERCENTS = (1, 5, 25, 50, 75, 95, 99)
+
+QUERY_STRING_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[()\[\]{}]|(?:[^\s()\[\]{}"\\]|\\.)+')
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+DATETIME_RE = re.compile(r'^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?')
+TIMEZONE_RE = re.compile(r'(Z|[+-]\d{2}:?\d{2})$')
+MUSTACHE_VARIABLE_RE = re.compile(r'\{\{(\w+)\}\}')
+INTERVAL_RE = re.compile(r'^(\d+)([smhdw])$')
+INTERVAL_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+NAMED_INTERVALS = {'second': '1s', 'minute': '1m', 'hour': '1h', 'day': '1d', 'week': '1w'}
+EPOCH = datetime(1970, 1, 1)
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+DEFAULT_GEOHASH_GRID_SIZE = 10000
+_MISSING = object()
+
+_indices = {}
+_indices_lock = threading.Lock()
+_scrolls = {}
+_scrolls_lock = threading.Lock()
+_templates = {}
+
+
+def _tokens(value):
+    return WORD_RE.findall(six.text_type(value).lower())
+
+
+def _edit_distance(first, second):
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+        for j, second_char in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (first_char != second_char)))
+        previous = current
+    return previous[-1]
+
+
+def _parse_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, six.string_types) and DATETIME_RE.match(value):
+        value = TIMEZONE_RE.sub('', value.replace(' ', 'T'))
+        for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+            try:
+                return datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+    return None
+
+
+def _comparable(value):
+    """Normalizes a stored or queried value so numbers and dates compare naturally."""
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    parsed = _parse_datetime(value)
+    if parsed is not None:
+        return parsed
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return six.text_type(value)
+
+
+def _compare(left, right):
+    left, right = _comparable(left), _comparable(right)
+    if type(left) is not type(right):
+        left, right = six.text_type(left), six.text_type(right)
+    return (left > right) - (left < right)
+
+
+RANGE_CHECKS = {
+    'gt': lambda c: c > 0,
+    'gte': lambda c: c >= 0,
+    'lt': lambda c: c < 0,
+    'lte': lambda c: c <= 0,
+}
+
+
+def _in_range(value, bounds):
+    for op, check in RANGE_CHECKS.items():
+        if bounds.get(op) not in (None, '*') and not check(_compare(value, bounds[op])):
+            return False
+    return True
+
+
+def _flatten(value):
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            for v in _flatten(item):
+                yield v
+    elif isinstance(value, dict):
+        for item in value.values():
+            for v in _flatten(item):
+                yield v
+    elif value is not None:
+        yield value
+
+
+def _lookup_raw(source, path):
+    values = [source]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, list):
+                found.extend(v[part] for v in value if isinstance(v, dict) and part in v)
+            elif isinstance(value, dict) and part in value:
+                found.append(value[part])
+        values = found
+    return values
+
+
+def _lookup(source, path):
+    """Returns the leaf values found at a dotted path of a document."""
+    return list(_flatten(_lookup_raw(source, path)))
+
+
+def _geo_points(value):
+    """Yields the ``(lat, lon)`` pairs of a ``geo_point`` value in any of its ES formats."""
+    if isinstance(value, six.string_types):
+        lat, lon = value.split(',')
+        yield float(lat), float(lon)
+    elif isinstance(value, dict):
+        yield float(value['lat']), float(value['lon'])
+    elif isinstance(value, (list, tuple)):
+        if len(value) == 2 and all(isinstance(v, (int, float)) for v in value):
+            yield float(value[1]), float(value[0])
+        else:
+            for item in value:
+                for point in _geo_points(item):
+                    yield point
+
+
+def _geohash(lat, lon, precision):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash = []
+    bits = char = 0
+    even = True
+    while len(geohash) < precision:
+        value_range, value = (lon_range, lon) if even else (lat_range, lat)
+        middle = (value_range[0] + value_range[1]) / 2
+        char <<= 1
+        if value >= middle:
+            char |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            geohash.append(GEOHASH_BASE32[char])
+            bits = char = 0
+    return ''.join(geohash)
+
+
+def _field(options):
+    field = options['field']
+    return field[:-len('.raw')] if field.endswith('.raw') else field
+
+
+def _numbers(matching, field):
+    values = []
+    for doc_id, source in matching:
+        for value in _lookup(source, field):
+            try:
+                values.append(float(value))
+            except (TypeError, ValueError):
+                pass
+    return values
+
+
+def _listify(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def _filter_source(source, includes):
+    if includes is True or includes is None:
+        return copy.deepcopy(source)
+    if isinstance(includes, dict):
+        excludes = includes.get('excludes', [])
+        includes = includes.get('includes') or [key for key in source if key not in excludes]
+    if isinstance(includes, six.string_types):
+        includes = [includes]
+    return copy.deepcopy(dict((key, value) for key, value in source.items() if key in includes))
+
+
+def _find_inner_hits(query):
+    """Returns the nested queries of a query body which request inner hits."""
+    found = []
+    if isinstance(query, dict):
+        nested = query.get('nested')
+        if isinstance(nested, dict) and 'inner_hits' in nested:
+            found.append(nested)
+        for value in query.values():
+            found.extend(_find_inner_hits(value))
+    elif isinstance(query, list):
+        for value in query:
+            found.extend(_find_inner_hits(value))
+    return found
+
+
+class MemoryIndex(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.mappings = {}
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def properties(self):
+        properties = {}
+        for mapping in self.mappings.values():
+            properties.update(mapping.get('properties', {}))
+        return properties
+
+
+class MemoryIndicesClient(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def exists(self, index, **params):
+        return index in _indices
+
+    def create(self, index, body=None, ignore=None, **params):
+        with _indices_lock:
+            if index not in _indices:
+                _indices[index] = MemoryIndex(index)
+        return {'acknowledged': True}
+
+    def delete(self, index, ignore=None, **params):
+        with _indices_lock:
+            if _indices.pop(index, None) is None and not _ignored(404, ignore):
+                raise NotFoundError(404, 'index_not_found_exception', {'index': index})
+        return {'acknowledged': True}
+
+    def get_mapping(self, index, doc_type=None, **params):
+        return {index: {'mappings': copy.deepcopy(self.client.get_index(index).mappings)}}
+
+    def put_mapping(self, doc_type, body, index=None, **params):
+        self.create(index)
+        memory_index = self.client.get_index(index)
+        with memory_index.lock:
+            mapping = body.get(doc_type, body)
+            type_mapping = memory_index.mappings.setdefault(doc_type, {})
+            type_mapping.setdefault('properties', {}).update(copy.deepcopy(mapping.get('properties', {})))
+            if '_meta' in mapping:
+                type_mapping['_meta'] = copy.deepcopy(mapping['_meta'])
+        return {'acknowledged': True}
+
+    def refresh(self, index=None, **params):
+        return {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+
+class MemoryTransport(object):
+
+    def __init__(self):
+        self.serializer = JSONSerializer()
+        self.deserializer = Deserializer(DEFAULT_SERIALIZERS)
+
+    def respond(self, body):
+        """Returns ``body`` as sent over the wire, through the ``deserializer`` as a cluster response."""
+        return self.deserializer.loads(self.serializer.dumps(body), 'application/json')
+
+
+def _ignored(status, ignore):
+    if ignore is None:
+        return False
+    if isinstance(ignore, int):
+        ignore = (ignore,)
+    return status in ignore
+
+
+class InMemoryElasticsearch(object):
+    """Implements the parts of the ``elasticsearch.Elasticsearch`` client used by the backend."""
+
+    def __init__(self):
+        self.indices = MemoryIndicesClient(self)
+        self.transport = MemoryTransport()
+
+    def get_index(self, index):
+        try:
+            return _indices[index]
+        except KeyError:
+            raise NotFoundError(404, 'index_not_found_exception', {'index': index})
+
+    def index(self, index, doc_type, body, id=None, **params):
+        self.indices.create(index)
+        memory_index = self.get_index(index)
+        source = self.transport.serializer.loads(self.transport.serializer.dumps(body))
+        with memory_index.lock:
+            memory_index.documents[six.text_type(id)] = source
+        return {'_index': index, '_type': doc_type, '_id': id, 'result': 'created'}
+
+    def delete(self, index, doc_type, id, ignore=None, **params):
+        memory_index = self.get_index(index)
+        with memory_index.lock:
+            found = memory_index.documents.pop(six.text_type(id), None) is not None
+        if not found and not _ignored(404, ignore):
+            raise NotFoundError(404, 'not_found', {'_id': id})
+        return {'_index': index, '_type': doc_type, '_id': id, 'found': found}
+
+    def bulk(self, body, index=None, doc_type=None, **params):
+        if isinstance(body, six.string_types):
+            body = [line for line in body.splitlines() if line.strip()]
+        loads = self.transport.serializer.loads
+        lines = [loads(line) if isinstance(line, six.string_types) else line for line in body]
+        items = []
+        while lines:
+            action = lines.pop(0)
+            op_type, meta = list(action.items())[0]
+            target = meta.get('_index', index)
+            target_type = meta.get('_type', doc_type)
+            if op_type == 'delete':
+                result = self.delete(target, target_type, meta['_id'], ignore=404)
+                status = 200 if result['found'] else 404
+            else:
+                source = lines.pop(0)
+                if op_type == 'update':
+                    source = source.get('doc', source)
+                self.index(target, target_type, source, id=meta.get('_id'))
+                status = 201
+            items.append({op_type: {'_index': target, '_type': target_type, '_id': meta.get('_id'),
+                                    'status': status}})
+        return {'took': 0, 'errors': False, 'items': items}
+
+    def count(self, index=None, doc_type=None, body=None, **params):
+        return {'count': len(self._matching(index, (body or {}).get('query')))}
+
+    def delete_by_query(self, index, body, doc_type=None, **params):
+        memory_index = self.get_index(index)
+        matching = self._matching(index, body.get('query'))
+        with memory_index.lock:
+            for doc_id, source in matching:
+                memory_index.documents.pop(doc_id, None)
+        return {'deleted': len(matching), 'timed_out': False, 'failures': []}
+
+    def search(self, index=None, doc_type=None, body=None, _source=True, **params):
+        return self.transport.respond(self._search(index, doc_type, body, _source, **params))
+
+    def _search(self, index=None, doc_type=None, body=None, _source=True, **params):
+        body = body or {}
+        memory_index = self.get_index(index)
+        matching = self._matching(index, body.get('query'))
+
+        terminated_early = None
+        if body.get('terminate_after'):
+            terminated_early = len(matching) > body['terminate_after']
+            matching = matching[:body['terminate_after']]
+
+        for sort in reversed(_listify(body.get('sort', []))):
+            matching = self._sort(matching, sort)
+
+        total = len(matching)
+        collapse = body.get('collapse')
+        groups = {}
+        if collapse:
+            # Keeps the first hit of each group, as ES the total still counts all matches.
+            collapsed = []
+            for doc_id, source in matching:
+                key = tuple(_lookup(source, _field(collapse)))
+                if key not in groups:
+                    groups[key] = []
+                    collapsed.append((doc_id, source))
+                groups[key].append((doc_id, source))
+            matching = collapsed
+
+        start = int(body.get('from', params.get('from_', 0)) or 0)
+        size = int(body.get('size', params.get('size', DEFAULT_SIZE)))
+        includes = body.get('_source', _source)
+        nested_inner_hits = _find_inner_hits(body.get('query'))
+        evaluator = QueryEvaluator(memory_index.properties())
+
+        def make_hit(doc_id, source):
+            hit = {'_index': index, '_type': doc_type or 'modelresult', '_id': doc_id, '_score': 1.0}
+            if includes:
+                hit['_source'] = _filter_source(source, includes)
+            return hit
+
+        hits = []
+        for doc_id, source in matching[start:start + size]:
+            hit = make_hit(doc_id, source)
+            if nested_inner_hits:
+                hit['inner_hits'] = dict(
+                    (nested['path'], evaluator.inner_hits(nested, source)) for nested in nested_inner_hits)
+            if collapse and collapse.get('inner_hits'):
+                group = groups[tuple(_lookup(source, _field(collapse)))]
+                inner_hits = collapse['inner_hits']
+                hit.setdefault('inner_hits', {})[inner_hits['name']] = {'hits': {
+                    'total': len(group),
+                    'max_score': 1.0,
+                    'hits': [make_hit(*member) for member in group[:inner_hits.get('size', 3)]],
+                }}
+            hits.append(hit)
+
+        raw_results = {
+            'took': 0,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {'total': total, 'max_score': 1.0 if matching else None, 'hits': hits},
+        }
+        if params.get('scroll'):
+            # The following pages are taken from a snapshot, as ES scroll contexts.
+            scroll_id = uuid.uuid4().hex
+            remaining = [make_hit(doc_id, source) for doc_id, source in matching[start + size:]]
+            with _scrolls_lock:
+                _scrolls[scroll_id] = (total, size, remaining)
+            raw_results['_scroll_id'] = scroll_id
+        if terminated_early is not None:
+            raw_results['terminated_early'] = terminated_early
+
+        aggregations = body.get('aggregations', body.get('aggs'))
+        if aggregations:
+            raw_results['aggregations'] = self._aggregate(memory_index, matching, aggregations)
+
+        if body.get('suggest'):
+            raw_results['suggest'] = self._suggest(index, doc_type, body['suggest'], includes)
+
+        return raw_results
+
+    def scroll(self, scroll_id=None, body=None, **params):
+        scroll_id = scroll_id or (body or {}).get('scroll_id')
+        with _scrolls_lock:
+            if scroll_id not in _scrolls:
+                raise NotFoundError(404, 'search_context_missing_exception', {'scroll_id': scroll_id})
+            total, size, remaining = _scrolls[scroll_id]
+            hits, _scrolls[scroll_id] = remaining[:size], (total, size, remaining[size:])
+        return {
+            '_scroll_id': scroll_id,
+            'took': 0,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {'total': total, 'max_score': 1.0 if hits else None, 'hits': hits},
+        }
+
+    def clear_scroll(self, scroll_id=None, body=None, ignore=None, **params):
+        scroll_ids = _listify(scroll_id or (body or {}).get('scroll_id'))
+        with _scrolls_lock:
+            found = [_scrolls.pop(scroll_id, None) is not None for scroll_id in scroll_ids]
+        if not all(found) and not _ignored(404, ignore):
+            raise NotFoundError(404, 'search_context_missing_exception', {'scroll_id': scroll_ids})
+        return {'succeeded': all(found), 'num_freed': sum(found)}
+
+    def put_template(self, id, body, **params):
+        _templates[id] = body['template']
+        return {'acknowledged': True}
+
+    def search_template(self, index=None, doc_type=None, body=None, **params):
+        if 'id' in body:
+            if body['id'] not in _templates:
+                raise NotFoundError(404, 'resource_not_found_exception', {'error': {
+                    'reason': 'unable to find script [%s] in cluster state' % body['id']}})
+            source = _templates[body['id']]
+        else:
+            source = body['inline']
+        values = body.get('params', {})
+        # Values are JSON escaped, as by the mustache templates of ES.
+        rendered = MUSTACHE_VARIABLE_RE.sub(
+            lambda match: json.dumps(six.text_type(values.get(match.group(1), '')))[1:-1], source)
+        return self.transport.respond(
+            self._search(index=index, doc_type=doc_type, body=json.loads(rendered), **params))
+
+    def msearch(self, body, index=None, doc_type=None, **params):
+        if isinstance(body, six.string_types):
+            body = [self.transport.serializer.loads(line) for line in body.splitlines() if line.strip()]
+        responses = []
+        for header, search in zip(body[::2], body[1::2]):
+            responses.append(self._search(index=header.get('index', index),
+                                          doc_type=header.get('type', doc_type), body=search))
+        return self.transport.respond({'responses': responses})
+
+    def mget(self, body, index=None, doc_type=None, _source=True, **params):
+        memory_index = self.get_index(index)
+        docs = []
+        for doc_id in body.get('ids', []):
+            with memory_index.lock:
+                source = memory_index.documents.get(six.text_type(doc_id))
+            doc = {'_index': index, '_type': doc_type or 'modelresult', '_id': doc_id,
+                   'found': source is not None}
+            if source is not None and _source:
+                doc['_source'] = _filter_source(source, _source)
+            docs.append(doc)
+        return {'docs': docs}
+
+    def _suggest(self, index, doc_type, suggest, includes):
+        suggestions = {}
+        for name, options in suggest.items():
+            if name == 'text':
+                continue
+            text = options.get('prefix', options.get('text', suggest.get('text', '')))
+            if 'completion' in options:
+                completion_options = self._completion_options(
+                    index, doc_type, text, options['completion'], includes)
+                suggestions[name] = [
+                    {'text': text, 'offset': 0, 'length': len(text), 'options': completion_options}]
+            else:
+                suggestions[name] = self._term_options(index, text, options.get('term', {}))
+        return suggestions
+
+    def _term_options(self, index, text, term):
+        evaluator = QueryEvaluator(self.get_index(index).properties())
+        field = term.get('field', '_all')
+        frequencies = {}
+        for doc_id, source in self._matching(index, None):
+            for token in set(token for value in evaluator.values(source, field) for token in _tokens(value)):
+                frequencies[token] = frequencies.get(token, 0) + 1
+
+        suggestions = []
+        for token in _tokens(text):
+            options = []
+            # Like ES' default ``missing`` suggest mode, only unknown terms get options.
+            if token not in frequencies:
+                for candidate, freq in frequencies.items():
+                    distance = _edit_distance(token, candidate)
+                    if distance <= term.get('max_edits', 2):
+                        score = 1.0 - float(distance) / max(len(token), len(candidate))
+                        options.append({'text': candidate, 'score': score, 'freq': freq})
+                options.sort(key=lambda option: (-option['score'], -option['freq'], option['text']))
+            suggestions.append(
+                {'text': token, 'offset': 0, 'length': len(token), 'options': options[:term.get('size', 5)]})
+        return suggestions
+
+    def _completion_options(self, index, doc_type, prefix, completion, includes):
+        contexts = completion.get('contexts') or {}
+        prefix = prefix.lower()
+        options = []
+        for doc_id, source in self._matching(index, None):
+            if any(not set(_flatten(wanted)) & set(_lookup(source, name))
+                   for name, wanted in contexts.items()):
+                continue
+            best = None
+            for entry in _listify(source.get(completion['field'])):
+                inputs = entry.get('input') if isinstance(entry, dict) else entry
+                weight = entry.get('weight', 1) if isinstance(entry, dict) else 1
+                for text in _listify(inputs):
+                    if six.text_type(text).lower().startswith(prefix) and (best is None or weight > best[1]):
+                        best = (text, weight)
+            if best is not None:
+                options.append({
+                    'text': best[0], '_index': index, '_type': doc_type or 'modelresult', '_id': doc_id,
+                    '_score': float(best[1]), '_source': _filter_source(source, includes),
+                })
+        options.sort(key=lambda option: (-option['_score'], option['text']))
+        return options[:completion.get('size', 5)]
+
+    def _matching(self, index, query):
+        memory_index = self.get_index(index)
+        evaluator = QueryEvaluator(memory_index.properties())
+        with memory_index.lock:
+            documents = list(memory_index.documents.items())
+        if not query:
+            return documents
+        return [(doc_id, source) for doc_id, source in documents if evaluator.matches(query, source)]
+
+    def _sort(self, matching, sort):
+        if isinstance(sort, six.string_types):
+            field, order = sort, 'asc'
+        else:
+            field, order = list(sort.items())[0]
+            if isinstance(order, dict):
+                order = order.get('order', 'asc')
+        if field == '_score':
+            return matching
+        if field == '_geo_distance':
+            raise NotImplementedError('Geo distance sorting is not supported by the in-memory backend.')
+        if field.endswith('.raw'):
+            field = field[:-len('.raw')]
+
+        def key(item):
+            values = _lookup(item[1], field)
+            return _comparable(values[0]) if values else _MISSING
+
+        present = [item for item in matching if key(item) is not _MISSING]
+        missing = [item for item in matching if key(item) is _MISSING]
+        present.sort(key=lambda item: _SortKey(key(item)), reverse=order == 'desc')
+        return present + missing
+
+    def _aggregate(self, memory_index, matching, aggregations):
+        evaluator = QueryEvaluator(memory_index.properties())
+        results = {}
+        for name, aggregation in aggregations.items():
+            result = {}
+            sub_aggregations = aggregation.get('aggregations', aggregation.get('aggs'))
+            if 'terms' in aggregation:
+                result = self._terms_aggregation(matching, aggregation['terms'])
+            elif 'stats' in aggregation:
+                result = self._stats_aggregation(matching, aggregation['stats'])
+            elif 'extended_stats' in aggregation:
+                result = self._stats_aggregation(matching, aggregation['extended_stats'], extended=True)
+            elif 'cardinality' in aggregation:
+                values = set()
+                for doc_id, source in matching:
+                    values.update(_lookup(source, _field(aggregation['cardinality'])))
+                result = {'value': len(values)}
+            elif 'percentiles' in aggregation:
+                result = self._percentiles_aggregation(matching, aggregation['percentiles'])
+            elif 'histogram' in aggregation:
+                result = self._histogram_aggregation(memory_index, matching, aggregation['histogram'],
+                                                     sub_aggregations)
+                sub_aggregations = None
+            elif 'nested' in aggregation:
+                path = aggregation['nested']['path']
+                nested = [(doc_id, {path: value}) for doc_id, source in matching
+                          for value in _listify(source.get(path))]
+                result = {'doc_count': len(nested)}
+                if sub_aggregations:
+                    result.update(self._aggregate(memory_index, nested, sub_aggregations))
+                sub_aggregations = None
+            elif 'geohash_grid' in aggregation:
+                result = self._geohash_grid_aggregation(memory_index, matching, aggregation['geohash_grid'],
+                                                        sub_aggregations)
+                sub_aggregations = None
+            elif 'geo_bounds' in aggregation:
+                points = self._points(matching, aggregation['geo_bounds'])
+                if points:
+                    lats, lons = [point[0] for point in points], [point[1] for point in points]
+                    result = {'bounds': {'top_left': {'lat': max(lats), 'lon': min(lons)},
+                                         'bottom_right': {'lat': min(lats), 'lon': max(lons)}}}
+            elif 'geo_centroid' in aggregation:
+                points = self._points(matching, aggregation['geo_centroid'])
+                if points:
+                    result = {'location': {'lat': sum(point[0] for point in points) / len(points),
+                                           'lon': sum(point[1] for point in points) / len(points)}}
+            elif 'date_histogram' in aggregation:
+                result = self._date_histogram_aggregation(matching, aggregation['date_histogram'])
+            elif 'date_range' in aggregation:
+                result = self._date_range_aggregation(matching, aggregation['date_range'])
+            elif 'filter' in aggregation:
+                result = {'doc_count': len([
+                    item for item in matching if evaluator.matches(aggregation['filter'], item[1])])}
+            else:
+                raise NotImplementedError(
+                    'Aggregation %r is not supported by the in-memory backend.' % list(aggregation))
+            if sub_aggregations:
+                raise NotImplementedError('Sub-aggregations of %r are not supported by the in-memory backend.'
+                                          % list(aggregation))
+            if 'meta' in aggregation:
+                result['meta'] = aggregation['meta']
+            results[name] = result
+        return results
+
+    def _terms_aggregation(self, matching, options):
+        field = options['field']
+        if field.endswith('.raw'):
+            field = field[:-len('.raw')]
+        counts = {}
+        for doc_id, source in matching:
+            for value in set(_lookup(source, field)):
+                counts[value] = counts.get(value, 0) + 1
+        buckets = sorted(counts.items(), key=lambda item: (-item[1], _SortKey(_comparable(item[0]))))
+        size = options.get('size', DEFAULT_TERMS_SIZE)
+        return {
+            'doc_count_error_upper_bound': 0,
+            'sum_other_doc_count': sum(count for key, count in buckets[size:]),
+            'buckets': [{'key': key, 'doc_count': count} for key, count in buckets[:size]],
+        }
+
+    def _stats_aggregation(self, matching, options, extended=False):
+        values = _numbers(matching, _field(options))
+        count = len(values)
+        result = {
+            'count': count,
+            'min': min(values) if values else None,
+            'max': max(values) if values else None,
+            'avg': sum(values) / count if values else None,
+            'sum': sum(values),
+        }
+        if extended:
+            sigma = options.get('sigma', 2)
+            variance = sum((value - result['avg']) ** 2 for value in values) / count if values else None
+            deviation = variance ** 0.5 if values else None
+            result.update({
+                'sum_of_squares': sum(value ** 2 for value in values),
+                'variance': variance,
+                'std_deviation': deviation,
+                'std_deviation_bounds': {
+                    'upper': result['avg'] + sigma * deviation if values else None,
+                    'lower': result['avg'] - sigma * deviation if values else None,
+                },
+            })
+        return result
+
+    def _percentiles_aggregation(self, matching, options):
+        values = sorted(_numbers(matching, _field(options)))
+        percentiles = {}
+        for percent in options.get('percents', DEFAULT_PERCENTS):
+            value = None
+            if values:
+                # Linear interpolation between the closest ranks, ES estimates them with t-digest.
+                rank = (len(values) - 1) * percent / 100.0
+                lower = int(rank)
+                upper = min(lower + 1, len(values) - 1)
+                value = values[lower] + (values[upper] - values[lower]) * (rank - lower)
+            percentiles[six.text_type(float(percent))] = value
+        return {'values': percentiles}
+
+    def _histogram_aggregation(self, memory_index, matching, options, sub_aggregations):
+        interval = options['interval']
+        offset = options.get('offset', 0)
+        buckets = {}
+        for doc_id, source in matching:
+            keys = set((value - offset) // interval * interval + offset
+                       for value in _numbers([(doc_id, source)], _field(options)))
+            for key in keys:
+                buckets.setdefault(key, []).append((doc_id, source))
+
+        if buckets and options.get('min_doc_count', 0) == 0:
+            # Like ES, fill the gaps between the lowest and highest buckets.
+            key = min(buckets)
+            while key < max(buckets):
+                buckets.setdefault(key, [])
+                key += interval
+
+        results = []
+        for key in sorted(buckets):
+            if len(buckets[key]) < options.get('min_doc_count', 0):
+                continue
+            bucket = {'key': float(key), 'doc_count': len(buckets[key])}
+            if sub_aggregations:
+                bucket.update(self._aggregate(memory_index, buckets[key], sub_aggregations))
+            results.append(bucket)
+        return {'buckets': results}
+
+    def _points(self, matching, options):
+        return [point for doc_id, source in matching
+                for value in _lookup_raw(source, _field(options)) for point in _geo_points(value)]
+
+    def _geohash_grid_aggregation(self, memory_index, matching, options, sub_aggregations):
+        precision = options.get('precision', 5)
+        cells = {}
+        for doc_id, source in matching:
+            points = self._points([(doc_id, source)], options)
+            keys = set(_geohash(lat, lon, precision) for lat, lon in points)
+            for key in keys:
+                cells.setdefault(key, []).append((doc_id, source))
+
+        keys = sorted(cells, key=lambda key: (-len(cells[key]), key))
+        results = []
+        for key in keys[:options.get('size', DEFAULT_GEOHASH_GRID_SIZE)]:
+            bucket = {'key': key, 'doc_count': len(cells[key])}
+            if sub_aggregations:
+                bucket.update(self._aggregate(memory_index, cells[key], sub_aggregations))
+            results.append(bucket)
+        return {'buckets': results}
+
+    def _date_histogram_aggregation(self, matching, options):
+        interval = NAMED_INTERVALS.get(options['interval'], options['interval'])
+        counts = {}
+        for doc_id, source in matching:
+            for value in _lookup(source, options['field']):
+                parsed = _parse_datetime(value)
+                if parsed is None:
+                    continue
+                if interval in ('month', 'quarter', 'year'):
+                    month = 1 if interval == 'year' else parsed.month
+                    if interval == 'quarter':
+                        month = (parsed.month - 1) // 3 * 3 + 1
+                    bucket = datetime(parsed.year, month, 1)
+                else:
+                    match = INTERVAL_RE.match(interval)
+                    if match is None:
+                        raise NotImplementedError('Unsupported date_histogram interval %r.' % interval)
+                    seconds = int(match.group(1)) * INTERVAL_SECONDS[match.group(2)]
+                    epoch_seconds = int((parsed - EPOCH).total_seconds())
+                    bucket = datetime.utcfromtimestamp(epoch_seconds - epoch_seconds % seconds)
+                counts[bucket] = counts.get(bucket, 0) + 1
+        return {'buckets': [
+            {
+                'key_as_string': bucket.isoformat(),
+                'key': int((bucket - EPOCH).total_seconds() * 1000),
+                'doc_count': counts[bucket],
+            }
+            for bucket in sorted(counts)
+        ]}
+
+    def _date_range_aggregation(self, matching, options):
+        buckets = []
+        for date_range in options.get('ranges', []):
+            bounds = {'gte': date_range.get('from'), 'lt': date_range.get('to')}
+            count = 0
+            for doc_id, source in matching:
+                if any(_in_range(value, bounds) for value in _lookup(source, options['field'])):
+                    count += 1
+            buckets.append(dict(date_range, doc_count=count))
+        return {'buckets': buckets}
+
+
+class _SortKey(object):
+    """Orders values of mixed types without raising ``TypeError``."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return _compare(self.value, other.value) < 0
+
+    def __eq__(self, other):
+        return _compare(self.value, other.value) == 0
+
+
+class QueryEvaluator(object):
+    """Evaluates a query DSL body against a single document source."""
+
+    def __init__(self, properties):
+        self.properties = properties
+
+    def matches(self, query, source):
+        if not query:
+            return True
+        query_type, options = list(query.items())[0]
+        handler = getattr(self, 'query_%s' % query_type, None)
+        if handler is None:
+            raise NotImplementedError('Query %r is not supported by the in-memory backend.' % query_type)
+        return handler(options, source)
+
+    def is_analyzed(self, field):
+        if field.endswith('.raw'):
+            return False
+        mapping = self.properties.get(field)
+        if mapping is None:
+            return True
+        return mapping.get('type') == 'text' and mapping.get('index') not in ('not_analyzed', 'no', False)
+
+    def values(self, source, field):
+        if field in ('_all', '*'):
+            return list(_flatten(source))
+        if field.endswith('.raw'):
+            field = field[:-len('.raw')]
+        return _lookup(source, field)
+
+    def _clauses(self, clauses):
+        if clauses is None:
+            return []
+        if isinstance(clauses, dict):
+            return [clauses]
+        return clauses
+
+    def query_match_all(self, options, source):
+        return True
+
+    def query_bool(self, options, source):
+        for clause in self._clauses(options.get('must')) + self._clauses(options.get('filter')):
+            if not self.matches(clause, source):
+                return False
+        for clause in self._clauses(options.get('must_not')):
+            if self.matches(clause, source):
+                return False
+        should = self._clauses(options.get('should'))
+        if should:
+            has_required = options.get('must') is not None or options.get('filter') is not None
+            minimum = int(options.get('minimum_should_match', 0 if has_required else 1))
+            if len([clause for clause in should if self.matches(clause, source)]) < minimum:
+                return False
+        return True
+
+    def query_boosting(self, options, source):
+        return self.matches(options['positive'], source)
+
+    def query_constant_score(self, options, source):
+        return self.matches(options['filter'], source)
+
+    def query_function_score(self, options, source):
+        return self.matches(options.get('query'), source)
+
+    def query_percolate(self, options, source):
+        return self.matches(source.get(options['field']), options['document'])
+
+    def query_nested(self, options, source):
+        path = options['path']
+        children = source.get(path) or []
+        if isinstance(children, dict):
+            children = [children]
+        for child in children:
+            view = dict(source)
+            view[path] = child
+            if self.matches(options['query'], view):
+                return True
+        return False
+
+    def inner_hits(self, nested, source):
+        path = nested['path']
+        options = nested['inner_hits']
+        includes = options.get('_source', True)
+        if not isinstance(includes, (bool, dict)):
+            prefix = path + '.'
+            includes = [field[len(prefix):] if field.startswith(prefix) else field for field in includes]
+        children = [
+            (offset, child) for offset, child in enumerate(_listify(source.get(path)))
+            if self.query_nested({'path': path, 'query': nested['query']}, dict(source, **{path: child}))
+        ]
+        start = options.get('from', 0)
+        return {'hits': {'total': len(children), 'hits': [
+            {'_nested': {'field': path, 'offset': offset}, '_score': 1.0,
+             '_source': _filter_source(child, includes)}
+            for offset, child in children[start:start + options.get('size', 3)]
+        ]}}
+
+    def query_term(self, options, source):
+        field, value = list(options.items())[0]
+        if isinstance(value, dict):
+            value = value.get('value')
+        analyzed = self.is_analyzed(field)
+        for stored in self.values(source, field):
+            if analyzed and isinstance(stored, six.string_types):
+                if six.text_type(value).lower() in _tokens(stored):
+                    return True
+            elif _compare(stored, value) == 0:
+                return True
+        return False
+
+    def query_terms(self, options, source):
+        field, values = list(options.items())[0]
+        return any(self.query_term({field: value}, source) for value in values)
+
+    def query_range(self, options, source):
+        field, bounds = list(options.items())[0]
+        return any(_in_range(stored, bounds) for stored in self.values(source, field))
+
+    def query_match(self, options, source):
+        field, value = list(options.items())[0]
+        if isinstance(value, dict):
+            value = value.get('query')
+        wanted = set(_tokens(value))
+        return any(wanted & set(_tokens(stored)) for stored in self.values(source, field))
+
+    def query_query_string(self, options, source):
+        fields = options.get('fields') or [options.get('default_field', '_all')]
+        fields = [field.split('^')[0] for field in fields]
+        default_operator = options.get('default_operator', 'OR').upper()
+        parser = QueryStringParser(options['query'], default_operator)
+        return parser.parse()(self, source, fields)
+
+    def match_text(self, source, fields, text):
+        """Matches a single query string term against the given fields."""
+        text = re.sub(r'\\(.)', r'\1', text)
+        if text == '*':
+            return any(self.values(source, field) for field in fields)
+        is_wildcard = '*' in text or '?' in text
+        text = text.lower()
+        for field in fields:
+            analyzed = self.is_analyzed(field)
+            for stored in self.values(source, field):
+                stored_text = six.text_type(stored).lower()
+                candidates = _tokens(stored_text) if analyzed else []
+                candidates.append(stored_text)
+                if is_wildcard:
+                    if any(fnmatch.fnmatchcase(candidate, text) for candidate in candidates):
+                        return True
+                elif analyzed and _tokens(text) and all(t in candidates for t in _tokens(text)):
+                    return True
+                elif text in candidates or _compare(stored, text) == 0:
+                    return True
+        return False
+
+    def match_phrase(self, source, fields, phrase):
+        phrase_tokens = _tokens(phrase)
+        for field in fields:
+            for stored in self.values(source, field):
+                stored_tokens = _tokens(stored)
+                for i in range(len(stored_tokens) - len(phrase_tokens) + 1):
+                    if stored_tokens[i:i + len(phrase_tokens)] == phrase_tokens:
+                        return True
+        return False
+
+    def match_range(self, source, fields, bounds):
+        return any(_in_range(stored, bounds) for field in fields for stored in self.values(source, field))
+
+
+class QueryStringParser(object):
+    """Parses the Lucene query string subset produced by haystack into a predicate."""
+
+    def __init__(self, query, default_operator='OR'):
+        self.tokens = QUERY_STRING_TOKEN_RE.findall(query)
+        self.position = 0
+        self.default_operator = default_operator
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        predicate = self.parse_or()
+        return predicate if predicate is not None else (lambda evaluator, source, fields: True)
+
+    def parse_or(self):
+        clauses = [self.parse_and()]
+        while self.peek() in ('OR', '||'):
+            self.next()
+            clauses.append(self.parse_and())
+        clauses = [clause for clause in clauses if clause is not None]
+        if len(clauses) == 1:
+            return clauses[0]
+        return lambda evaluator, source, fields: any(c(evaluator, source, fields) for c in clauses)
+
+    def parse_and(self):
+        # Clauses combine as in a Lucene boolean query: with any ``must``
+        # clause the ``should`` clauses are optional, otherwise one must match.
+        must, must_not, should = [], [], []
+        explicit_and = False
+        while self.peek() not in (None, ')', 'OR', '||'):
+            if self.peek() in ('AND', '&&'):
+                self.next()
+                explicit_and = True
+                if should:
+                    must.append(should.pop())
+                continue
+            clause, occur = self.parse_not()
+            if clause is None:
+                continue
+            if occur == 'must_not':
+                must_not.append(clause)
+            elif occur == 'must' or explicit_and or self.default_operator == 'AND':
+                must.append(clause)
+            else:
+                should.append(clause)
+            explicit_and = False
+        if not (must or must_not or should):
+            return None
+
+        def matches(evaluator, source, fields):
+            if not all(c(evaluator, source, fields) for c in must):
+                return False
+            if any(c(evaluator, source, fields) for c in must_not):
+                return False
+            return bool(must) or not should or any(c(evaluator, source, fields) for c in should)
+        return matches
+
+    def parse_not(self):
+        """Returns the next clause and how it occurs: ``must``, ``must_not`` or ``should``."""
+        token = self.peek()
+        if token in ('NOT', '!') or (token and token.startswith('-') and len(token) > 1):
+            if token in ('NOT', '!'):
+                self.next()
+            else:
+                self.tokens[self.position] = token[1:]
+            return self.parse_atom(), 'must_not'
+        if token and token.startswith('+') and len(token) > 1:
+            self.tokens[self.position] = token[1:]
+            return self.parse_atom(), 'must'
+        return self.parse_atom(), 'should'
+
+    def parse_atom(self, fields=None):
+        token = self.next()
+        if token == '(':
+            clause = self.parse_or()
+            self.next()
+            if clause is None:
+                return None
+            return self._with_fields(clause, fields)
+        if token in ('[', '{'):
+            return self._with_fields(self.parse_range(token), fields)
+        if token.startswith('"'):
+            phrase = token[1:-1]
+            self._skip_modifiers()
+            return self._with_fields(
+                lambda evaluator, source, fields: evaluator.match_phrase(source, fields, phrase), fields)
+
+        field, text = self._split_field(token)
+        if field is not None:
+            if text == '*' and field == '*':
+                return lambda evaluator, source, fields: True
+            if text:
+                self.tokens.insert(self.position, text)
+            return self.parse_atom([field])
+
+        text = re.sub(r'(?<!\\)[\^~][\d.]*$', '', token)
+        return self._with_fields(
+            lambda evaluator, source, fields: evaluator.match_text(source, fields, text), fields)
+
+    def parse_range(self, opening):
+        lower = self.next()
+        self.next()  # TO
+        upper = self.next()
+        closing = self.next()
+        bounds = {
+            'gte' if opening == '[' else 'gt': lower,
+            'lte' if closing == ']' else 'lt': upper,
+        }
+        return lambda evaluator, source, fields: evaluator.match_range(source, fields, bounds)
+
+    def _skip_modifiers(self):
+        token = self.peek()
+        if token and re.match(r'^[\^~][\d.]*$', token):
+            self.next()
+
+    def _split_field(self, token):
+        match = re.match(r'^((?:[^:\\]|\\.)+):(.*)$', token)
+        if match is None:
+            return None, token
+        return match.group(1), match.group(2)
+
+    def _with_fields(self, clause, fields):
+        if fields is None:
+            return clause
+        return lambda evaluator, source, default_fields: clause(evaluator, source, fields)
+
+
+class InMemorySearchBackend(Elasticsearch5SearchBackend):
+
+    def __init__(self, connection_alias, **connection_options):
+        connection_options.setdefault('URL', 'http://localhost:9200/')
+        super(InMemorySearchBackend, self).__init__(connection_alias, **connection_options)
+        self.conn = InMemoryElasticsearch()
+        self._read_conn = None
+        # Sizes come from the in-memory client, not the one built by the parent.
+        self.response_sizes = ResponseSizeRecorder.install(self.read_conn)
+
+    def more_like_this(self, *args, **kwargs):
+        raise NotImplementedError('More like this is not supported by the in-memory backend.')
+
+
+class InMemorySearchEngine(Elasticsearch5SearchEngine):
+    backend = InMemorySearchBackend
+    query = Elasticsearch5SearchQuery
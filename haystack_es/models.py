@@ -1 +1,101 @@
-# -*- coding: utf-8 -*-
+# -*- coding: utf-8
+
+from django.utils import six
+
+from haystack.models import SearchResult
+from haystack.utils import log as logging
+
+__all__ = ['LazySearchResult']
+
+
+def _search_result_method(name):
+    return six.get_unbound_function(getattr(SearchResult, name))
+
+
+class LazySearchResult(object):
+    """A search result which converts its fields on first access.
+
+    The raw ``_source`` of the hit is kept as is and each field is run through
+    its ``SearchField.convert`` only when the attribute is read. Select it with
+    ``SearchQuerySet().result_class(LazySearchResult)``.
+
+    It offers the public API of ``haystack.models.SearchResult`` but uses
+    ``__slots__`` instead of an instance ``__dict__``.
+    """
+
+    __slots__ = ('app_label', 'model_name', 'pk', 'score', 'stored_fields', '_object', '_model',
+                 '_point_of_origin', '_distance', '_source', '_converter', '_converted', '_extra',
+                 '_stored_fields')
+
+    log = logging.getLogger('haystack')
+
+    def __init__(self, app_label, model_name, pk, score, source=None, converter=None, **kwargs):
+        self.app_label, self.model_name = app_label, model_name
+        self.pk = pk
+        self.score = score
+        self.stored_fields = None
+        self._object = None
+        self._model = None
+        self._point_of_origin = kwargs.pop('_point_of_origin', None)
+        self._distance = kwargs.pop('_distance', None)
+        self._source = source if source is not None else {}
+        self._converter = converter
+        self._converted = None
+        self._extra = kwargs or None
+        self._stored_fields = None
+
+    def __repr__(self):
+        return "<SearchResult: %s.%s (pk=%r)>" % (self.app_label, self.model_name, self.pk)
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+
+        converted = self._converted
+        if converted is not None and attr in converted:
+            return converted[attr]
+
+        if attr in self._source:
+            value = self._source[attr]
+            if self._converter is not None:
+                value = self._converter(attr, value)
+            if converted is None:
+                converted = self._converted = {}
+            converted[attr] = value
+            return value
+
+        if self._extra is not None:
+            return self._extra.get(attr)
+        return None
+
+    @property
+    def _additional_fields(self):
+        fields = list(self._source)
+        if self._converted is not None:
+            fields.extend(attr for attr in self._converted if attr not in self._source)
+        if self._extra is not None:
+            fields.extend(self._extra)
+        return fields
+
+    searchindex = property(_search_result_method('_get_searchindex'))
+    object = property(_search_result_method('_get_object'), _search_result_method('_set_object'))
+    model = property(_search_result_method('_get_model'), _search_result_method('_set_model'))
+    distance = property(_search_result_method('_get_distance'), _search_result_method('_set_distance'))
+    verbose_name = property(_search_result_method('_get_verbose_name'))
+    verbose_name_plural = property(_search_result_method('_get_verbose_name_plural'))
+    content_type = _search_result_method('content_type')
+    get_additional_fields = _search_result_method('get_additional_fields')
+    get_stored_fields = _search_result_method('get_stored_fields')
+
+    def __getstate__(self):
+        # The converter is usually a closure over the backend, convert
+        # everything up front so the result can be pickled without it.
+        state = dict((attr, getattr(self, attr)) for attr in self.__slots__ if attr != '_converter')
+        state['_converted'] = self.get_additional_fields()
+        state['_source'] = {}
+        return state
+
+    def __setstate__(self, state):
+        for attr in self.__slots__:
+            setattr(self, attr, state.get(attr))
+        self._source = self._source or {}
@@ -1,8 +1,17 @@
+from django.utils.encoding import force_text
+
 from haystack.query import SearchQuerySet as BaseSearchQuerySet
 
+from .aggregations import Aggregation, GeoBounds, GeoCentroid, GeohashGrid
+
 
 class SearchQuerySet(BaseSearchQuerySet):
 
+    def __init__(self, using=None, query=None):
+        super(SearchQuerySet, self).__init__(using=using, query=query)
+        self._batch_load = False
+        self._prefetch_depth = 0
+
     def boost_fields(self, fields):
         """Boosts fields."""
         clone = self._clone()
@@ -14,3 +23,216 @@ class SearchQuerySet(BaseSearchQuerySet):
         clone = self._clone()
         clone.query.add_boost_negative(query, negative_boost)
         return clone
+
+    def highlight(self, fields=None, fragment_size=None, number_of_fragments=None, no_match_size=None,
+                  highlighter=None, **options):
+        """Highlights ``fields``, the content field by default.
+
+        ``fields`` is a list of fields or a dict of per-field options. With
+        ``number_of_fragments=0`` whole fields are returned, ``no_match_size``
+        returns the start of fields without a match. ``highlighter`` is the ES
+        highlighter type, ``'fvh'`` and ``'postings'`` don't re-analyze the
+        text but need a field indexed with ``term_vector`` or ``index_options``.
+        """
+        for option, value in (('fields', fields), ('fragment_size', fragment_size),
+                              ('number_of_fragments', number_of_fragments), ('no_match_size', no_match_size),
+                              ('type', highlighter)):
+            if value is not None:
+                options[option] = value
+        return super(SearchQuerySet, self).highlight(**options)
+
+    def inner_hits(self, path, size=3, fields=None):
+        """Replaces the nested field ``path`` of each result with its matching objects only.
+
+        ``fields`` limits the returned attributes of the nested objects.
+        """
+        options = {'size': size}
+        if fields is not None:
+            options['_source'] = ['%s.%s' % (path, field) for field in fields]
+        clone = self._clone()
+        clone.query.add_inner_hits(path, **options)
+        return clone
+
+    def budget(self, timeout=None, terminate_after=None):
+        """Limits the search to ``timeout`` and ``terminate_after`` documents per shard.
+
+        ``timeout`` is in seconds or an ES time value such as ``'200ms'``. The
+        results found until then are returned and ``timed_out()`` is true.
+        These override the ``SEARCH_TIMEOUT`` and ``TERMINATE_AFTER`` options.
+        """
+        clone = self._clone()
+        clone.query.add_budget(timeout=timeout, terminate_after=terminate_after)
+        return clone
+
+    def preference(self, preference):
+        """Routes the search by ``preference``, e.g. a session key or ``'_local'``.
+
+        Searches with the same custom value hit the same shard copies, so
+        repeated searches of a session profit from the shard request cache.
+        """
+        clone = self._clone()
+        clone.query.add_preference(preference)
+        return clone
+
+    def template(self, name, **params):
+        """Runs the ``SEARCH_TEMPLATES`` entry ``name`` with ``params`` as a stored search template.
+
+        Only the template id and the parameters are sent. The query is the
+        one built by the template, filters of this ``SearchQuerySet`` are not
+        applied, slicing is.
+        """
+        clone = self._clone()
+        clone.query.add_template(name, params)
+        return clone
+
+    def timed_out(self):
+        """Whether the results are partial because a budget ran out."""
+        if self.query.has_run():
+            return self.query.get_timed_out()
+        return self._clone().query.get_timed_out()
+
+    def degraded(self):
+        """Whether the search was rejected by the circuit breaker and returned no results."""
+        if self.query.has_run():
+            return self.query.get_degraded()
+        return self._clone().query.get_degraded()
+
+    def rescore(self, window_size, query=None, score_mode=None, query_weight=1.0, rescore_query_weight=1.0):
+        """Runs a costly scoring query on the top ``window_size`` hits of each shard only.
+
+        ``query`` is query DSL and defaults to the ``score_functions`` of the
+        searched indexes, which then no longer apply to every match. Rescoring
+        needs results ordered by score, so searching raises
+        ``SearchBackendError`` when combined with ``order_by`` or ``collapse``.
+        """
+        clone = self._clone()
+        clone.query.add_rescore(window_size, query=query, score_mode=score_mode, query_weight=query_weight,
+                                rescore_query_weight=rescore_query_weight)
+        return clone
+
+    def collapse(self, field, size=None):
+        """Returns one result per value of ``field``, the best scoring one.
+
+        With ``size`` each result lists up to ``size`` results of its group,
+        itself included, in ``group_members``. The count is the number of
+        groups from a ``cardinality`` aggregation, close to exact up to 40000
+        groups. Above that it is approximate, and slicing by it can end
+        before the last group or ask for pages past it.
+        """
+        clone = self._clone()
+        clone.query.add_collapse(field, size=size)
+        return clone
+
+    def suggest_complete(self, prefix, size=10, field=None, contexts=None):
+        """Returns completion suggestions for a prefix.
+
+        The suggestions are ``LazySearchResult`` objects with the suggested
+        text in ``suggestion``.
+        """
+        return self.query.backend.suggest_complete(prefix, size=size, field=field, contexts=contexts,
+                                                   models=self.query.models)
+
+    def aggregate(self, **aggregations):
+        """Returns the values of ``haystack_es.aggregations`` over the matching documents.
+
+        The aggregations run in Elasticsearch with ``size: 0``, no documents
+        are fetched. The result maps each keyword to the parsed value.
+        """
+        for name, aggregation in aggregations.items():
+            if not isinstance(aggregation, Aggregation):
+                raise TypeError("'%s' is not an aggregation." % name)
+        return self._clone().query.get_aggregations(aggregations)
+
+    def geohash_grid(self, field, precision=5, size=None, **aggregations):
+        """Returns the matching documents per geohash cell of the location ``field``.
+
+        Clusters of map markers are computed in Elasticsearch instead of from
+        the fetched hits, ``aggregations`` run per cell, e.g. a ``GeoCentroid``
+        to place the cluster.
+        """
+        return self.aggregate(geohash_grid=GeohashGrid(field, precision=precision, size=size,
+                                                       aggregations=aggregations)).get('geohash_grid', [])
+
+    def geo_bounds(self, field):
+        """Returns the box enclosing the matching locations, e.g. to fit a map to them."""
+        return self.aggregate(geo_bounds=GeoBounds(field)).get('geo_bounds')
+
+    def geo_centroid(self, field):
+        """Returns the mean of the matching locations."""
+        return self.aggregate(geo_centroid=GeoCentroid(field)).get('geo_centroid')
+
+    def batch_load(self, concurrent=False):
+        """Loads the objects of each fetched page with one ``in_bulk`` per model.
+
+        Unlike ``load_all`` results whose object no longer exists are kept.
+        With ``concurrent`` the next page is requested from Elasticsearch
+        while the objects of the current page are being loaded.
+        """
+        clone = self._clone()
+        clone._batch_load = True
+        if concurrent:
+            clone._prefetch_depth = max(clone._prefetch_depth, 1)
+        return clone
+
+    def prefetch(self, depth=1):
+        """Requests the next ``depth`` pages in the background while iterating.
+
+        While a page is processed by the caller, the following pages are
+        already being fetched and converted on the prefetch thread pool.
+        Pages not started yet are cancelled when the iteration stops early.
+        """
+        if depth < 0:
+            raise ValueError("The prefetch depth can't be negative.")
+        clone = self._clone()
+        clone._prefetch_depth = depth
+        return clone
+
+    def post_process_results(self, results):
+        if self._prefetch_depth:
+            self._prefetch_pages()
+        if self._batch_load and not self._load_all:
+            self._batch_load_objects(results)
+        return super(SearchQuerySet, self).post_process_results(results)
+
+    def _manual_iter(self):
+        try:
+            for result in super(SearchQuerySet, self)._manual_iter():
+                yield result
+        finally:
+            self.query.cancel_prefetches()
+
+    def _prefetch_pages(self):
+        start, end = self.query.start_offset, self.query.end_offset
+        if end is None or end <= start:
+            return
+        # Keeps at most ``depth`` pages ahead of the one just fetched.
+        self.query.cancel_prefetches(before=end)
+        size = end - start
+        count = self.query.get_count()
+        for page in range(self._prefetch_depth):
+            page_start = end + page * size
+            if page_start >= count:
+                break
+            self.query.prefetch(page_start, page_start + size)
+
+    def _batch_load_objects(self, results):
+        models_pks = {}
+        for result in results:
+            if result._object is None:
+                models_pks.setdefault(result.model, []).append(result.pk)
+
+        loaded_objects = {}
+        for model, pks in models_pks.items():
+            for pk, obj in self._load_model_objects(model, pks).items():
+                loaded_objects[(model, force_text(pk))] = obj
+
+        for result in results:
+            obj = loaded_objects.get((result.model, force_text(result.pk)))
+            if obj is not None:
+                result._object = obj
+
+    def _clone(self, klass=None):
+        clone = super(SearchQuerySet, self)._clone(klass=klass)
+        clone._batch_load = self._batch_load
+        clone._prefetch_depth = self._prefetch_depth
+        return clone
@@ -0,0 +1,158 @@
+# -*- coding: utf-8
+"""Recording of search request bodies and their replay against a cluster.
+
+With the ``QUERY_LOG_PATH`` connection option every search body built by
+``Elasticsearch5SearchBackend.search`` is appended to that file, one compact
+JSON object per line. ``QUERY_LOG_SAMPLE_RATE`` records only a share of the
+searches and ``QUERY_LOG_SCRUBBER``, a callable or its dotted path, gets each
+body before it is written and returns it without personal data, or ``None``
+to skip it.
+
+``replay`` sends a recorded log to any cluster, e.g. to load test a mapping
+change or to warm the caches of a new index, see the ``es_replay_queries``
+management command.
+"""
+
+import io
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+from timeit import default_timer
+
+import elasticsearch
+from elasticsearch.serializer import JSONSerializer
+
+from django.utils import six
+from django.utils.module_loading import import_string
+
+__all__ = ['QueryRecorder', 'ReplayReport', 'get_query_recorder', 'percentile', 'read_query_log', 'replay']
+
+DEFAULT_REPLAY_CONCURRENCY = 4
+REPLAY_PERCENTILES = (50, 90, 99)
+
+ReplayReport = namedtuple('ReplayReport', ['requests', 'errors', 'duration', 'latencies'])
+
+log = logging.getLogger('haystack')
+
+_query_recorders = {}
+_query_recorders_lock = threading.Lock()
+
+
+class QueryRecorder(object):
+    """Appends sampled and scrubbed search bodies to an append-only log file.
+
+    The file is opened once with ``O_APPEND`` and each entry is written with a
+    single ``os.write``, so processes sharing the log don't interleave lines.
+    """
+
+    def __init__(self, path, sample_rate=1.0, scrubber=None):
+        self.path = path
+        self.sample_rate = sample_rate
+        if isinstance(scrubber, six.string_types):
+            scrubber = import_string(scrubber)
+        self.scrubber = scrubber
+        self.serializer = JSONSerializer()
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def dumps(self, entry):
+        return json.dumps(entry, default=self.serializer.default, ensure_ascii=False, separators=(',', ':'))
+
+    def record(self, body):
+        """Writes ``body`` to the log, unless it is not sampled or the scrubber drops it."""
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+
+        if self.scrubber is not None:
+            # The scrubber gets a copy, the body is still to be sent.
+            body = self.scrubber(json.loads(self.dumps(body)))
+            if body is None:
+                return False
+
+        line = (self.dumps({'timestamp': time.time(), 'body': body}) + '\n').encode('utf-8')
+        with self._lock:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            # A write to a file opened with O_APPEND is appended in one piece,
+            # a buffered file object flushes long lines in several writes.
+            written = os.write(self._fd, line)
+            while written < len(line):
+                written += os.write(self._fd, line[written:])
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+def get_query_recorder(connection_alias, path, sample_rate=1.0, scrubber=None):
+    """Returns the process wide query recorder of a connection."""
+    with _query_recorders_lock:
+        if connection_alias not in _query_recorders:
+            _query_recorders[connection_alias] = QueryRecorder(path, sample_rate=sample_rate,
+                                                               scrubber=scrubber)
+        return _query_recorders[connection_alias]
+
+
+def read_query_log(path, limit=None):
+    """Yields the recorded search bodies of the log at ``path``, oldest first."""
+    with io.open(path, encoding='utf-8') as log_file:
+        for count, line in enumerate(log_file):
+            if limit is not None and count >= limit:
+                return
+            if line.strip():
+                yield json.loads(line)['body']
+
+
+def percentile(sorted_values, percent):
+    """Returns the nearest-rank ``percent`` percentile of ``sorted_values``."""
+    if not sorted_values:
+        return None
+    rank = max(int(math.ceil(percent / 100.0 * len(sorted_values))), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def replay(conn, index_name, bodies, concurrency=DEFAULT_REPLAY_CONCURRENCY, doc_type='modelresult'):
+    """Sends the search ``bodies`` to ``index_name`` from ``concurrency`` threads.
+
+    The bodies are consumed as the threads need them, so a log of any size can
+    be replayed. Returns a ``ReplayReport`` with the sorted request latencies.
+    """
+    bodies = iter(bodies)
+    bodies_lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def send():
+        while True:
+            with bodies_lock:
+                body = next(bodies, None)
+            if body is None:
+                return
+
+            started = default_timer()
+            try:
+                conn.search(index=index_name, doc_type=doc_type, body=body)
+            except elasticsearch.TransportError:
+                errors.append(1)
+            except Exception as e:
+                # Anything else, e.g. a connection or serialization error, must
+                # not end the thread and the replay of its share of the log.
+                log.error("Failed to replay a query: %s", e, exc_info=True)
+                errors.append(1)
+            latencies.append(default_timer() - started)
+
+    started = default_timer()
+    threads = [threading.Thread(target=send) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return ReplayReport(len(latencies), len(errors), default_timer() - started, sorted(latencies))
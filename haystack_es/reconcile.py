@@ -0,0 +1,122 @@
+# -*- coding: utf-8
+"""Finds and fixes the differences between the database and the index.
+
+Instead of rebuilding the whole index, ``reconcile`` reindexes the objects of
+``index_queryset()`` missing from the index and removes the documents of
+objects no longer in it::
+
+    backend = connections['default'].get_backend()
+    index = connections['default'].get_unified_index().get_index(MyModel)
+    reconcile(backend, index)
+    ReconcileResult(objects=1000, documents=998, missing=3, stale=1)
+
+Both sides are streamed ``batch_size`` ids at a time, primary keys from the
+database paged by primary key and document ids from an index scroll,
+so memory use does not grow with the size of the index.
+"""
+
+from collections import namedtuple
+from itertools import islice
+
+from django.utils.encoding import force_text
+
+from haystack.utils import get_model_ct
+
+__all__ = ['ReconcileResult', 'find_missing', 'find_stale', 'reconcile']
+
+ReconcileResult = namedtuple('ReconcileResult', ['objects', 'documents', 'missing', 'stale'])
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class _Counter(object):
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.count = 0
+
+    def __iter__(self):
+        for item in self.iterable:
+            self.count += 1
+            yield item
+
+
+def _index_queryset(backend, index):
+    return index.index_queryset(using=backend.connection_alias)
+
+
+def _iter_pks(queryset, batch_size):
+    """Yields the primary keys of ``queryset`` in order, ``batch_size`` per query."""
+    queryset = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    while True:
+        page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        pks = list(page[:batch_size])
+        for pk in pks:
+            yield pk
+        if len(pks) < batch_size:
+            return
+        last_pk = pks[-1]
+
+
+def find_missing(backend, index, batch_size=None, pks=None):
+    """Yields the primary keys of ``index_queryset()`` without a document in the index."""
+    batch_size = batch_size or backend.batch_size
+    model = index.get_model()
+    if pks is None:
+        pks = _iter_pks(_index_queryset(backend, index), batch_size)
+    for chunk in _chunks(pks, batch_size):
+        indexed = backend.get_indexed_ids(model, chunk)
+        for pk in chunk:
+            if force_text(pk) not in indexed:
+                yield pk
+
+
+def find_stale(backend, index, batch_size=None, document_ids=None):
+    """Yields the ids of the documents whose object is not in ``index_queryset()``."""
+    batch_size = batch_size or backend.batch_size
+    model = index.get_model()
+    queryset = _index_queryset(backend, index)
+    if document_ids is None:
+        document_ids = backend.iter_document_ids(model, batch_size=batch_size)
+    for chunk in _chunks(document_ids, batch_size):
+        existing = set(force_text(pk) for pk in queryset.filter(pk__in=chunk).values_list('pk', flat=True))
+        for pk in chunk:
+            if pk not in existing:
+                yield pk
+
+
+def reconcile(backend, index, batch_size=None, dry_run=False, commit=True):
+    """Reindexes the missing objects of ``index`` and removes its stale documents.
+
+    With ``dry_run`` the differences are only counted. Returns a
+    ``ReconcileResult`` with the number of objects and documents compared.
+    """
+    batch_size = batch_size or backend.batch_size
+    model = index.get_model()
+    model_ct = get_model_ct(model)
+
+    objects = _Counter(_iter_pks(_index_queryset(backend, index), batch_size))
+    missing = 0
+    for chunk in _chunks(find_missing(backend, index, batch_size, pks=objects), batch_size):
+        missing += len(chunk)
+        if not dry_run:
+            backend.update(index, _index_queryset(backend, index).filter(pk__in=chunk), commit=False)
+
+    documents = _Counter(backend.iter_document_ids(model, batch_size=batch_size))
+    stale = 0
+    for chunk in _chunks(find_stale(backend, index, batch_size, document_ids=documents), batch_size):
+        stale += len(chunk)
+        if not dry_run:
+            backend.remove(['%s.%s' % (model_ct, pk) for pk in chunk], commit=False)
+
+    if commit and not dry_run and (missing or stale):
+        backend.conn.indices.refresh(index=backend.index_name)
+    return ReconcileResult(objects.count, documents.count, missing, stale)
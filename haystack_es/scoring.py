@@ -0,0 +1,99 @@
+# -*- coding: utf-8
+"""Declarative ``function_score`` functions for ``Elasticsearch5SearchIndex``.
+
+Functions listed in an index's ``score_functions`` adjust the score of that
+index's documents, without sorting every match with a script::
+
+    class ProductIndex(indexes.SearchIndex, indexes.Indexable):
+        score_functions = [
+            FieldValueFactor('popularity', modifier='log1p', missing=1),
+            Decay('created', scale='30d', decay=0.5),
+        ]
+"""
+
+__all__ = ['ScoreFunction', 'FieldValueFactor', 'Decay', 'Weight']
+
+
+class ScoreFunction(object):
+    """Base class of the score functions.
+
+    ``weight`` multiplies the function's score, ``filter`` is query DSL
+    limiting the documents it applies to.
+    """
+
+    def __init__(self, weight=None, filter=None):
+        self.weight = weight
+        self.filter = filter
+
+    def __repr__(self):
+        return '<%s>' % self.__class__.__name__
+
+    def build(self):
+        """Returns the function specific part of the function's query DSL."""
+        return {}
+
+    def to_dict(self):
+        function = self.build()
+        if self.weight is not None:
+            function['weight'] = self.weight
+        if self.filter is not None:
+            function['filter'] = self.filter
+        return function
+
+
+class FieldValueFactor(ScoreFunction):
+    """Scores by the value of a numeric ``field``, e.g. a popularity count."""
+
+    def __init__(self, field, factor=None, modifier=None, missing=None, **kwargs):
+        super(FieldValueFactor, self).__init__(**kwargs)
+        self.field = field
+        self.factor = factor
+        self.modifier = modifier
+        self.missing = missing
+
+    def build(self):
+        options = {'field': self.field}
+        for option in ('factor', 'modifier', 'missing'):
+            if getattr(self, option) is not None:
+                options[option] = getattr(self, option)
+        return {'field_value_factor': options}
+
+
+class Decay(ScoreFunction):
+    """Lowers the score with the distance of a date, numeric or geo ``field`` to ``origin``.
+
+    ``function`` is one of ``gauss``, ``exp`` or ``linear``. Date fields
+    default to ``now`` as origin.
+    """
+
+    FUNCTIONS = ('gauss', 'exp', 'linear')
+
+    def __init__(self, field, scale, origin=None, offset=None, decay=None, function='gauss',
+                 multi_value_mode=None, **kwargs):
+        if function not in self.FUNCTIONS:
+            raise ValueError("Decay function must be one of %s." % ', '.join(self.FUNCTIONS))
+        super(Decay, self).__init__(**kwargs)
+        self.field = field
+        self.scale = scale
+        self.origin = origin
+        self.offset = offset
+        self.decay = decay
+        self.function = function
+        self.multi_value_mode = multi_value_mode
+
+    def build(self):
+        options = {'scale': self.scale}
+        for option in ('origin', 'offset', 'decay'):
+            if getattr(self, option) is not None:
+                options[option] = getattr(self, option)
+        function = {self.field: options}
+        if self.multi_value_mode is not None:
+            function['multi_value_mode'] = self.multi_value_mode
+        return {self.function: function}
+
+
+class Weight(ScoreFunction):
+    """A constant ``weight``, usually for the documents matching ``filter``."""
+
+    def __init__(self, weight, filter=None):
+        super(Weight, self).__init__(weight=weight, filter=filter)
@@ -0,0 +1,12 @@
+# -*- coding: utf-8
+
+from django.dispatch import Signal
+
+# Sent by ``Elasticsearch5SearchBackend.search`` after every query with a
+# dictionary of per-phase timings and response statistics.
+query_executed = Signal(providing_args=['connection_alias', 'stats'])
+
+# Sent by ``Elasticsearch5SearchBackend.update`` with ``PERCOLATE_ON_UPDATE``,
+# ``matches`` maps the identifiers of the indexed objects to the ids of the
+# saved searches they match.
+saved_searches_matched = Signal(providing_args=['connection_alias', 'index', 'matches'])
@@ -0,0 +1,94 @@
+# -*- coding: utf-8
+"""Hot query shapes stored in Elasticsearch as search templates.
+
+A template is a function building a ``SearchQuerySet`` from its keyword
+arguments, listed in the ``SEARCH_TEMPLATES`` connection option::
+
+    def product_search(q, category):
+        return SearchQuerySet().filter(content=q, category__exact=category).order_by('-created')
+
+    HAYSTACK_CONNECTIONS = {'default': {
+        # ...
+        'SEARCH_TEMPLATES': {'product_search': 'myapp.search.product_search'},
+    }}
+
+The function is called once with placeholders, the query body built from its
+``SearchQuerySet`` is stored with ``setup()``, and searches only send the
+template id and the parameters::
+
+    SearchQuerySet().template('product_search', q='red shoes', category='shoes')[:20]
+"""
+
+import hashlib
+import json
+from collections import namedtuple
+
+from elasticsearch.serializer import JSONSerializer
+
+from django.utils import six
+from django.utils.inspect import get_func_args
+from django.utils.module_loading import import_string
+
+__all__ = ['SearchTemplate', 'CompiledTemplate']
+
+# Parameters of the template for the requested slice.
+FROM_PARAM = 'haystack_from'
+SIZE_PARAM = 'haystack_size'
+
+# Stands in for a parameter while the body is built. Letters only, so it
+# passes query string escaping and filter compilation unchanged.
+PLACEHOLDER = 'haystacktemplate%splaceholder'
+
+# ``escaped`` are the parameters used in query strings, which must be
+# escaped as any query string input.
+CompiledTemplate = namedtuple('CompiledTemplate', ['id', 'source', 'params', 'escaped'])
+
+
+def _find_escaped(body, placeholders, escaped, in_query_string=False):
+    if isinstance(body, dict):
+        for key, value in body.items():
+            _find_escaped(value, placeholders, escaped, in_query_string or key == 'query_string')
+    elif isinstance(body, (list, tuple)):
+        for value in body:
+            _find_escaped(value, placeholders, escaped, in_query_string)
+    elif in_query_string and isinstance(body, six.string_types):
+        escaped.update(param for param, placeholder in placeholders.items() if placeholder in body)
+
+
+class SearchTemplate(object):
+    """A named query shape built by ``build``, a function or its dotted path."""
+
+    def __init__(self, name, build):
+        if isinstance(build, six.string_types):
+            build = import_string(build)
+        self.name = name
+        self.build = build
+        self.params = tuple(get_func_args(build))
+
+    def __repr__(self):
+        return '<SearchTemplate: %s>' % self.name
+
+    def compile(self, backend, fingerprint):
+        """Returns the ``CompiledTemplate`` of this shape for ``backend``.
+
+        The id includes a hash of the source and of the schema ``fingerprint``
+        so a changed template or mapping is stored under a new id.
+        """
+        placeholders = dict((param, PLACEHOLDER % param) for param in self.params)
+        query = self.build(**placeholders).query
+        body = backend.build_search_kwargs(query.build_query(), **query.build_params())
+        body['from'] = PLACEHOLDER % FROM_PARAM
+        body['size'] = PLACEHOLDER % SIZE_PARAM
+
+        escaped = set()
+        _find_escaped(body, placeholders, escaped)
+
+        source = json.dumps(body, default=JSONSerializer().default, sort_keys=True, separators=(',', ':'))
+        for param in (FROM_PARAM, SIZE_PARAM):
+            source = source.replace('"%s"' % (PLACEHOLDER % param), '{{%s}}' % param)
+        for param, placeholder in placeholders.items():
+            source = source.replace(placeholder, '{{%s}}' % param)
+
+        digest = hashlib.sha1(('%s:%s' % (fingerprint, source)).encode('utf-8')).hexdigest()[:12]
+        template_id = '%s-%s-%s' % (backend.index_name, self.name, digest)
+        return CompiledTemplate(template_id, source, self.params, frozenset(escaped))
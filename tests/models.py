@@ -0,0 +1,19 @@
+# -*- coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from django.db import models
+from django.utils import timezone
+
+
+class Product(models.Model):
+    name = models.CharField(max_length=100)
+    category = models.CharField(max_length=100, blank=True)
+    price = models.FloatField(default=0)
+    created = models.DateTimeField(default=timezone.now)
+
+    # Not stored, set by the tests of location and flattened dict fields.
+    location = None
+    tags = None
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,25 @@
+# -*- coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from haystack_es import indexes
+
+from .models import Product
+
+
+class ProductIndex(indexes.SearchIndex, indexes.Indexable):
+    text = indexes.CharField(document=True, model_attr='name')
+    name = indexes.CharField(model_attr='name')
+    category = indexes.CharField(model_attr='category', faceted=True)
+    price = indexes.FloatField(model_attr='price')
+    created = indexes.DateTimeField(model_attr='created')
+    attributes = indexes.DictField(null=True)
+    tags = indexes.DictField(model_attr='tags', storage='flattened', null=True)
+    variants = indexes.NestedField(null=True)
+    name_suggest = indexes.CompletionField(model_attr='name', contexts=['django_ct'])
+    location = indexes.LocationField(model_attr='location', null=True)
+
+    def get_model(self):
+        return Product
+
+    def prepare_variants(self, obj):
+        return getattr(obj, 'variants', None)
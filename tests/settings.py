@@ -22,9 +22,23 @@ INSTALLED_APPS = [
     "django.contrib.auth",
     "django.contrib.contenttypes",
     "django.contrib.sites",
+    "haystack",
     "haystack_es",
+    "tests",
 ]
 
+HAYSTACK_CONNECTIONS = {
+    "default": {
+        "ENGINE": "haystack_es.backends.Elasticsearch5SearchEngine",
+        "URL": "http://localhost:9200/",
+        "INDEX_NAME": "test_haystack_es",
+    },
+    "memory": {
+        "ENGINE": "haystack_es.memory.InMemorySearchEngine",
+        "INDEX_NAME": "test_haystack_es_memory",
+    },
+}
+
 SITE_ID = 1
 
 if django.VERSION >= (1, 10):
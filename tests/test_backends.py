@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_django-haystack-es
+------------
+
+Tests for `django-haystack-es` backends module.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+
+import elasticsearch
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+
+from haystack import connections
+from haystack.exceptions import SearchBackendError
+from mock import Mock, patch
+
+from haystack_es.backends import (Elasticsearch5SearchBackend, _schema_fingerprints, reset_unified_indexes,
+                                  warm_up)
+from haystack_es.circuit import CircuitBreaker, SearchUnavailable
+from haystack_es.fields import CharField, DictField, GeometryField
+from haystack_es.instrumentation import ResponseSizeRecorder
+from haystack_es.query import SearchQuerySet
+from haystack_es.querylog import QueryRecorder, percentile, read_query_log, replay
+from haystack_es.scoring import Decay, FieldValueFactor
+from haystack_es.signals import query_executed
+
+from .models import Product
+from .search_indexes import ProductIndex
+
+
+def make_raw_results(count=2, total=None):
+    return {
+        'took': 3,
+        'timed_out': False,
+        '_shards': {'total': 5, 'successful': 5, 'failed': 0},
+        'hits': {
+            'total': count if total is None else total,
+            'hits': [
+                {
+                    '_score': 1.0,
+                    '_source': {
+                        'django_ct': 'tests.product',
+                        'django_id': str(i),
+                        'id': 'tests.product.%s' % i,
+                        'text': 'product %s' % i,
+                        'name': 'product %s' % i,
+                        'category': 'category %s' % (i % 3),
+                        'price': float(i),
+                        'created': '2017-07-27T10:00:00',
+                    },
+                }
+                for i in range(count)
+            ],
+        },
+    }
+
+
+class BackendTestCase(TestCase):
+
+    def setUp(self):
+        self.backend = connections['default'].get_backend()
+        self.backend.setup_complete = True
+        self.backend.slow_query_log.clear()
+        conn_patcher = patch.object(self.backend, 'conn')
+        self.conn = conn_patcher.start()
+        self.conn.transport.serializer.dumps.side_effect = lambda data: '{}'
+        self.addCleanup(conn_patcher.stop)
+
+
+class TestInstrumentation(BackendTestCase):
+
+    def test_query_executed_signal(self):
+        received = []
+
+        def receiver(sender, connection_alias, stats, **kwargs):
+            received.append(stats)
+
+        self.conn.search.return_value = make_raw_results(2)
+        query_executed.connect(receiver)
+        try:
+            self.backend.search('product')
+        finally:
+            query_executed.disconnect(receiver)
+
+        self.assertEqual(len(received), 1)
+        stats = received[0]
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['took'], 3)
+        self.assertEqual(stats['shards']['total'], 5)
+        for phase in ('build_time', 'request_time', 'process_time', 'total_time'):
+            self.assertGreaterEqual(stats[phase], 0)
+
+    def test_slow_query_log_and_profile(self):
+        self.conn.search.return_value = dict(make_raw_results(1), profile={'shards': []})
+        executor = Mock(submit=lambda func, *args: func(*args))
+        with patch.multiple(self.backend, slow_query_threshold=0, profile_sample_rate=1), \
+                patch('haystack_es.backends.get_prefetch_executor', return_value=executor):
+            self.backend.search('product')
+
+        entries = self.backend.slow_query_log.slowest()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['profile'], {'shards': []})
+        self.assertTrue(self.conn.search.call_args[1]['body']['profile'])
+
+    def test_response_size(self):
+        client = elasticsearch.Elasticsearch('http://localhost:9200')
+        recorder = ResponseSizeRecorder.install(client)
+        self.assertIs(client.transport.deserializer, recorder)
+        self.assertIs(ResponseSizeRecorder.install(client), recorder)
+        connection = client.transport.connection_pool.connections[0]
+        with patch.object(connection, 'perform_request', return_value=(200, {}, '{"took": 1}')):
+            self.assertEqual(client.search(index='test'), {'took': 1})
+        self.assertEqual(recorder.size, 11)
+
+
+class TestBudgets(BackendTestCase):
+
+    def test_timeout_and_terminate_after(self):
+        kwargs = self.backend.build_search_kwargs('product', timeout=0.2, terminate_after=1000)
+        self.assertEqual((kwargs['timeout'], kwargs['terminate_after']), ('200ms', 1000))
+        with patch.object(self.backend, 'search_timeout', '1s'):
+            self.assertEqual(self.backend.build_search_kwargs('product')['timeout'], '1s')
+        self.assertNotIn('timeout', self.backend.build_search_kwargs('product'))
+
+    def test_partial_results(self):
+        self.conn.search.return_value = dict(make_raw_results(2), timed_out=True)
+        self.assertTrue(self.backend.search('product')['timed_out'])
+        self.conn.search.return_value = make_raw_results(2)
+        self.assertFalse(self.backend.search('product')['timed_out'])
+
+
+class TestQueryLog(BackendTestCase):
+
+    def setUp(self):
+        super(TestQueryLog, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'queries.log')
+
+    def test_record(self):
+        def scrubber(body):
+            if 'secret' in str(body):
+                return None
+            body.pop('highlight', None)
+            return body
+
+        self.conn.search.return_value = make_raw_results(1)
+        with patch.object(self.backend, 'query_recorder', QueryRecorder(self.path, scrubber=scrubber)):
+            self.backend.search('product', highlight=True)
+            self.backend.search('secret')
+        with patch.object(self.backend, 'query_recorder', QueryRecorder(self.path, sample_rate=0)):
+            self.backend.search('product')
+
+        bodies = list(read_query_log(self.path))
+        self.assertEqual(len(bodies), 1)
+        self.assertNotIn('highlight', bodies[0])
+        self.assertIn('highlight', self.conn.search.call_args_list[0][1]['body'])
+        self.assertEqual(bodies[0]['query'], self.conn.search.call_args_list[0][1]['body']['query'])
+
+    def test_long_entries(self):
+        recorder = QueryRecorder(self.path)
+        self.addCleanup(recorder.close)
+        body = {'query': {'terms': {'django_id': [str(i) for i in range(100000)]}}}
+        for _ in range(3):
+            recorder.record(body)
+        self.assertEqual(list(read_query_log(self.path)), [body] * 3)
+
+    def test_replay(self):
+        self.conn.search.side_effect = [{}, elasticsearch.TransportError(500, 'error'), ValueError, {}]
+        report = replay(self.conn, 'test', [{'size': 1}] * 4, concurrency=2)
+        self.assertEqual((report.requests, report.errors), (4, 2))
+        self.assertEqual(self.conn.search.call_count, 4)
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(percentile([1, 2, 3, 4], 99), 4)
+
+    def test_replay_command(self):
+        recorder = QueryRecorder(self.path)
+        for _ in range(5):
+            recorder.record({'query': {'match_all': {}}})
+        connections['memory'].get_backend().setup()
+        out = StringIO()
+        call_command('es_replay_queries', self.path, using='memory', limit=4, stdout=out)
+        self.assertIn('4 queries in', out.getvalue())
+        self.assertIn('0 errors', out.getvalue())
+
+
+class TestReadWriteSplit(BackendTestCase):
+
+    def test_connections(self):
+        backend = Elasticsearch5SearchBackend(
+            'split', URL='http://localhost:9200/', INDEX_NAME='test', KWARGS={'http_auth': 'user:pass'},
+            READ_URL='http://search:9200/', WRITE_URL='http://ingest:9200/', WRITE_KWARGS={})
+        self.assertEqual(backend.read_conn.transport.hosts, [{'host': 'search', 'port': 9200}])
+        self.assertIn('authorization', backend.read_conn.transport.connection_pool.connection.headers)
+        self.assertEqual(backend.conn.transport.hosts, [{'host': 'ingest', 'port': 9200}])
+        self.assertNotIn('authorization', backend.conn.transport.connection_pool.connection.headers)
+        self.assertIs(self.backend.read_conn, self.conn)
+
+    def test_searches_use_read_connection(self):
+        with patch.object(self.backend, '_read_conn') as read_conn:
+            read_conn.search.return_value = make_raw_results(1)
+            self.backend.search('product')
+            self.backend.update(connections['default'].get_unified_index().get_index(Product), [])
+        self.assertEqual(read_conn.search.call_count, 1)
+        self.assertFalse(self.conn.search.called)
+        self.assertTrue(self.conn.indices.refresh.called)
+
+    def test_preference(self):
+        self.conn.search.return_value = make_raw_results(1)
+        self.backend.search('product')
+        self.assertNotIn('preference', self.conn.search.call_args[1])
+        with patch.object(self.backend, 'preference', '_local'):
+            self.backend.search('product')
+            self.assertEqual(self.conn.search.call_args[1]['preference'], '_local')
+            with patch.object(self.backend, 'preference_callback', lambda: 'session-1'):
+                self.backend.search('product')
+                self.assertEqual(self.conn.search.call_args[1]['preference'], 'session-1')
+                self.backend.search('product', preference='session-2')
+                self.assertEqual(self.conn.search.call_args[1]['preference'], 'session-2')
+
+    def test_preference_not_in_body(self):
+        self.conn.search.return_value = make_raw_results(1)
+        SearchQuerySet().preference('session-1').count()
+        self.assertEqual(self.conn.search.call_args[1]['preference'], 'session-1')
+        self.assertNotIn('preference', self.conn.search.call_args[1]['body'])
+
+
+class TestHighlight(BackendTestCase):
+
+    def highlight(self, sqs):
+        return self.backend.build_search_kwargs('product', **sqs.query.build_params())['highlight']
+
+    def test_content_field_by_default(self):
+        self.assertEqual(self.highlight(SearchQuerySet().highlight()), {'fields': {'text': {}}})
+
+    def test_options(self):
+        sqs = SearchQuerySet().highlight(fields=['name', 'text'], fragment_size=100, number_of_fragments=2,
+                                         no_match_size=100, highlighter='fvh')
+        self.assertEqual(self.highlight(sqs), {
+            'fields': {'name': {}, 'text': {}},
+            'fragment_size': 100,
+            'number_of_fragments': 2,
+            'no_match_size': 100,
+            'type': 'fvh',
+        })
+
+    def test_per_field_options(self):
+        sqs = SearchQuerySet().highlight(fields={'name': {'number_of_fragments': 0}, 'text': None})
+        self.assertEqual(self.highlight(sqs), {'fields': {'name': {'number_of_fragments': 0}, 'text': {}}})
+
+
+class TestCollapseCount(BackendTestCase):
+
+    def test_group_count(self):
+        kwargs = self.backend.build_search_kwargs('product', collapse={'field': 'category'})
+        count = kwargs['aggregations']['haystack_collapse_count']['cardinality']
+        self.assertEqual(count['precision_threshold'], 40000)
+
+        self.conn.search.return_value = dict(make_raw_results(2, total=5), aggregations={
+            'haystack_collapse_count': {'value': 2}})
+        results = self.backend.search('product', collapse={'field': 'category'})
+        self.assertEqual(results['hits'], 2)
+        self.assertEqual(results['facets'], {})
+
+        self.conn.search.return_value = dict(make_raw_results(2, total=2), aggregations={
+            'haystack_collapse_count': {'value': 3}})
+        self.assertEqual(self.backend.search('product', collapse={'field': 'category'})['hits'], 2)
+
+    def test_group_count_with_facets(self):
+        self.conn.search.return_value = dict(make_raw_results(2, total=5), aggregations={
+            'haystack_collapse_count': {'value': 2},
+            'category': {'buckets': [{'key': 'category 1', 'doc_count': 5}]}})
+        results = self.backend.search('product', collapse={'field': 'category'}, facets={'category': {}})
+        self.assertEqual(results['facets']['fields'], {'category': [('category 1', 5)]})
+
+
+class TestCircuitBreaker(BackendTestCase):
+
+    def test_opens_after_slow_searches(self):
+        self.conn.search.return_value = make_raw_results(1)
+        breaker = CircuitBreaker(latency_threshold=0, failure_threshold=2, reset_timeout=60)
+        with patch.object(self.backend, 'circuit_breaker', breaker):
+            self.backend.search('product')
+            self.assertFalse(breaker.is_open)
+            self.backend.search('product')
+            self.assertTrue(breaker.is_open)
+
+            with self.assertLogs('haystack', 'WARNING'):
+                results = self.backend.search('product')
+            self.assertTrue(results['degraded'])
+            self.assertEqual(results['hits'], 0)
+            with patch.object(self.backend, 'silently_fail', False):
+                self.assertRaises(SearchUnavailable, self.backend.search, 'product')
+        self.assertEqual(self.conn.search.call_count, 2)
+
+    def test_trial_search_closes(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.release(breaker.acquire(), 1.0, failed=True)
+        self.assertTrue(breaker.is_open)
+        trial = breaker.acquire()
+        self.assertTrue(trial.trial)
+        self.assertIsNone(breaker.acquire())
+        breaker.release(trial, 0.1)
+        self.assertFalse(breaker.is_open)
+
+    def test_only_trial_search_leaves_half_open(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        in_flight = breaker.acquire()
+        breaker.release(breaker.acquire(), 1.0, failed=True)
+        trial = breaker.acquire()
+        breaker.release(in_flight, 0.1)
+        self.assertTrue(breaker.is_open)
+        breaker.release(trial, 1.0, failed=True)
+        self.assertTrue(breaker.is_open)
+
+    def test_concurrency_limit(self):
+        breaker = CircuitBreaker(max_concurrent=1)
+        permit = breaker.acquire()
+        self.assertIsNotNone(permit)
+        self.assertIsNone(breaker.acquire())
+        breaker.release(permit, 0.1)
+        self.assertIsNotNone(breaker.acquire())
+
+
+class TestNestedFilters(BackendTestCase):
+
+    def test_filters_grouped_per_path(self):
+        kwargs = self.backend.build_search_kwargs('*:*', filter_context=[
+            {'variants>color__exact': 'red'}, {'category__exact': 'shirts'}, {'variants>size__exact': 'xl'}
+        ], limit_to_registered_models=False)
+        self.assertEqual(kwargs['query']['bool']['filter']['bool']['must'], [
+            {'nested': {'path': 'variants', 'query': {'bool': {'must': [
+                {'term': {'variants.color': 'red'}},
+                {'term': {'variants.size': 'xl'}},
+            ]}}}},
+            {'term': {'category.raw': 'shirts'}},
+        ])
+
+    def test_inner_hits(self):
+        kwargs = self.backend.build_search_kwargs(
+            '*:*', filter_context=[{'variants>color__exact': 'red'}], limit_to_registered_models=False,
+            inner_hits={'variants': {'size': 2}})
+        self.assertEqual(kwargs['query']['bool']['filter'], {'nested': {
+            'path': 'variants',
+            'query': {'term': {'variants.color': 'red'}},
+            'inner_hits': {'size': 2},
+        }})
+        self.assertEqual(kwargs['_source'], {'excludes': ['variants']})
+
+
+class TestScoring(BackendTestCase):
+
+    def setUp(self):
+        super(TestScoring, self).setUp()
+        patcher = patch.object(ProductIndex, 'score_functions', [
+            FieldValueFactor('price', modifier='log1p', missing=1),
+            Decay('created', scale='30d', decay=0.5, weight=2),
+        ])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.functions = [
+            {'field_value_factor': {'field': 'price', 'modifier': 'log1p', 'missing': 1},
+             'filter': {'term': {'django_ct': 'tests.product'}}},
+            {'gauss': {'created': {'scale': '30d', 'decay': 0.5}}, 'weight': 2,
+             'filter': {'term': {'django_ct': 'tests.product'}}},
+        ]
+
+    def test_function_score(self):
+        kwargs = self.backend.build_search_kwargs('shirt')
+        function_score = kwargs['query']['bool']['must']['function_score']
+        self.assertEqual(function_score['functions'], self.functions)
+        self.assertEqual(function_score['query']['query_string']['query'], 'shirt')
+        self.assertEqual(function_score['score_mode'], 'multiply')
+        self.assertEqual(function_score['boost_mode'], 'multiply')
+
+    def test_rescore(self):
+        kwargs = self.backend.build_search_kwargs('shirt', rescore={'window_size': 50})
+        self.assertIn('query_string', kwargs['query']['bool']['must'])
+        self.assertEqual(kwargs['rescore'], {
+            'window_size': 50,
+            'query': {
+                'rescore_query': {'function_score': {
+                    'functions': self.functions, 'score_mode': 'multiply', 'boost_mode': 'replace'}},
+                'query_weight': 1.0,
+                'rescore_query_weight': 1.0,
+                'score_mode': 'multiply',
+            },
+        })
+
+    def test_rescore_sorted_or_collapsed(self):
+        self.assertRaises(SearchBackendError, self.backend.build_search_kwargs, 'shirt',
+                          sort_by=[('price', 'asc')], rescore={'window_size': 50})
+        self.assertRaises(SearchBackendError, self.backend.build_search_kwargs, 'shirt',
+                          collapse={'field': 'category'}, rescore={'window_size': 50})
+
+    def test_other_models_unaffected(self):
+        kwargs = self.backend.build_search_kwargs('shirt', models=[Product], limit_to_registered_models=False)
+        self.assertIn('function_score', kwargs['query']['bool']['must'])
+        with patch.object(self.backend, 'build_models_list', return_value=['tests.other']):
+            kwargs = self.backend.build_search_kwargs('shirt')
+        self.assertIn('query_string', kwargs['query']['bool']['must'])
+
+
+class TestSetup(TestCase):
+
+    def setUp(self):
+        self.backend = connections['memory'].get_backend()
+        self.backend.clear()
+
+    def test_mapping_is_put_once(self):
+        with patch.object(self.backend.conn.indices, 'put_mapping',
+                          wraps=self.backend.conn.indices.put_mapping) as put_mapping:
+            self.backend.setup()
+            other = Elasticsearch5SearchBackend('memory', URL='http://localhost:9200/',
+                                                INDEX_NAME=self.backend.index_name)
+            other.conn = self.backend.conn
+            other.setup()
+            self.assertTrue(other.setup_complete)
+            self.assertEqual(put_mapping.call_count, 1)
+
+            # A new process only checks the fingerprint stored in the mapping.
+            _schema_fingerprints.clear()
+            other.setup()
+            self.assertEqual(put_mapping.call_count, 1)
+
+    def test_geo_shape_mapping(self):
+        fields = {'shape': GeometryField(index_fieldname='shape', tree='quadtree', precision='100m')}
+        content_field, mapping = self.backend.build_schema(fields)
+        self.assertEqual(mapping['shape'], {'type': 'geo_shape', 'tree': 'quadtree', 'precision': '100m'})
+
+    def test_highlight_mapping(self):
+        fields = {
+            'text': CharField(index_fieldname='text', document=True, term_vector='with_positions_offsets'),
+            'name': CharField(index_fieldname='name', index_options='offsets'),
+        }
+        content_field, mapping = self.backend.build_schema(fields)
+        self.assertEqual(mapping['text']['term_vector'], 'with_positions_offsets')
+        self.assertEqual(mapping['name']['index_options'], 'offsets')
+        self.assertNotIn('term_vector', mapping['name'])
+
+    def test_dict_mappings(self):
+        fields = {
+            'attributes': DictField(index_fieldname='attributes', dynamic='strict'),
+            'payload': DictField(index_fieldname='payload', storage='disabled'),
+            'tags': DictField(index_fieldname='tags', storage='flattened'),
+        }
+        content_field, mapping = self.backend.build_schema(fields)
+        self.assertEqual(mapping['attributes'], {'type': 'object', 'dynamic': 'strict'})
+        self.assertEqual(mapping['payload'], {'type': 'object', 'enabled': False})
+        self.assertEqual(mapping['tags'], {'type': 'keyword', 'fields': {'raw': {'type': 'keyword'}}})
+        with self.assertRaises(ValueError):
+            DictField(storage='flattened', dynamic=False)
+
+    def test_warm_up(self):
+        warm_up('memory')
+        self.assertTrue(self.backend.setup_complete)
+
+
+class TestSharedIndexes(TestCase):
+
+    def in_thread(self, func):
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(func()))
+        thread.start()
+        thread.join()
+        return result
+
+    def test_index_state_shared_between_threads(self):
+        index = connections['memory'].get_unified_index().get_index(Product)
+        backend = connections['memory'].get_backend()
+        field_converters = backend.get_field_converters(index)
+        schema = backend.get_schema(connections['memory'].get_unified_index())
+        index.full_prepare(Product(pk=1, name='Main', category='a', price=1.0))
+
+        def load():
+            unified_index = connections['memory'].get_unified_index()
+            thread_index = unified_index.get_index(Product)
+            thread_backend = connections['memory'].get_backend()
+            return {
+                'index': thread_index,
+                'field_map': thread_index.field_map,
+                'prepared_data': thread_index.prepared_data,
+                'backend': thread_backend,
+                'field_converters': thread_backend.get_field_converters(thread_index),
+                'schema': thread_backend.get_schema(unified_index),
+            }
+
+        result = self.in_thread(load)
+        self.assertIs(result['index'], index)
+        self.assertIs(result['field_map'], index.field_map)
+        self.assertIsNone(result['prepared_data'])
+        self.assertEqual(index.prepared_data['name'], 'Main')
+        self.assertIsNot(result['backend'], backend)
+        self.assertIs(result['field_converters'], field_converters)
+        self.assertIs(result['schema'], schema)
+
+    def test_unified_index_reset(self):
+        unified_index = connections['memory'].get_unified_index()
+        self.assertIs(connections.reload('memory').get_unified_index(), unified_index)
+        reset_unified_indexes('memory')
+        reloaded = connections.reload('memory').get_unified_index()
+        self.assertIsNot(reloaded, unified_index)
+        with self.settings(HAYSTACK_CONNECTIONS=settings.HAYSTACK_CONNECTIONS):
+            self.assertIsNot(connections.reload('memory').get_unified_index(), reloaded)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_django-haystack-es
+------------
+
+Tests for `django-haystack-es` memory module.
+"""
+
+import json
+from datetime import datetime
+
+from django.test import TestCase
+from django.utils import timezone
+
+from haystack import connections
+
+from haystack_es.query import SearchQuerySet
+
+from .models import Product
+
+
+class MemoryBackendTestCase(TestCase):
+    """Indexes a few products into the in-memory backend."""
+
+    def setUp(self):
+        self.backend = connections['memory'].get_backend()
+        self.backend.clear()
+        self.index = connections['memory'].get_unified_index().get_index(Product)
+        self.products = [
+            Product(pk=1, name='Red shirt', category='shirts', price=10,
+                    created=timezone.make_aware(datetime(2017, 1, 10))),
+            Product(pk=2, name='Blue shirt', category='shirts', price=20,
+                    created=timezone.make_aware(datetime(2017, 2, 10))),
+            Product(pk=3, name='Green trousers', category='trousers', price=30,
+                    created=timezone.make_aware(datetime(2017, 2, 20))),
+        ]
+        self.backend.update(self.index, self.products)
+
+    def sqs(self):
+        return SearchQuerySet(using='memory')
+
+    def search(self, query):
+        response = self.backend.conn.search(index=self.backend.index_name, body={'query': query})
+        return sorted(hit['_id'].split('.')[-1] for hit in response['hits']['hits'])
+
+
+class TestInMemoryBackend(MemoryBackendTestCase):
+
+    def test_content_and_filters(self):
+        self.assertEqual(self.sqs().count(), 3)
+        self.assertEqual([r.pk for r in self.sqs().filter(content='shirt').order_by('price')], ['1', '2'])
+        self.assertEqual([r.pk for r in self.sqs().filter(category__exact='trousers')], ['3'])
+        self.assertEqual(sorted(r.pk for r in self.sqs().filter(price__range='15,30')), ['2', '3'])
+        self.assertEqual([r.pk for r in self.sqs().filter(name__startswith='gre')], ['3'])
+
+    def test_sorting_and_paging(self):
+        results = self.sqs().order_by('-price')
+        self.assertEqual([r.pk for r in results[:2]], ['3', '2'])
+        self.assertEqual([r.pk for r in results[2:]], ['1'])
+
+    def test_facets(self):
+        counts = self.sqs().facet('category').date_facet(
+            'created', start_date=datetime(2017, 1, 1), end_date=datetime(2017, 3, 1), gap_by='month'
+        ).facet_counts()
+        self.assertEqual(counts['fields']['category'], [('shirts', 2), ('trousers', 1)])
+        self.assertEqual(counts['dates']['created'], [(datetime(2017, 1, 1), 1), (datetime(2017, 2, 1), 2)])
+
+    def test_nested(self):
+        self.products[0].variants = [{'color': 'red', 'size': 's'}, {'color': 'blue', 'size': 'xl'}]
+        self.products[1].variants = [{'color': 'red', 'size': 'xl'}]
+        self.backend.update(self.index, self.products[:2])
+        results = self.sqs().filter(**{'variants>color__exact': 'red', 'variants>size__exact': 'xl'})
+        self.assertEqual([r.pk for r in results], ['2'])
+        self.assertEqual(self.search({'nested': {'path': 'variants', 'query': {'bool': {'must': [
+            {'term': {'variants.color': 'blue'}}, {'term': {'variants.size': 's'}}]}}}}), [])
+
+    def test_bool_should(self):
+        should = [{'term': {'category.raw': 'trousers'}}, {'range': {'price': {'lte': 10}}}]
+        self.assertEqual(self.search({'bool': {'should': should}}), ['1', '3'])
+        self.assertEqual(self.search({'bool': {'should': should, 'minimum_should_match': 2}}), [])
+        # With a required clause, should clauses are optional.
+        self.assertEqual(self.search({'bool': {'filter': [{'term': {'category.raw': 'shirts'}}],
+                                               'should': should}}), ['1', '2'])
+
+    def test_query_string_operators(self):
+        def query_string(query, **options):
+            return self.search({'query_string': dict(options, query=query, default_field='text')})
+
+        self.assertEqual(query_string('shirt AND red'), ['1'])
+        self.assertEqual(query_string('red OR trousers'), ['1', '3'])
+        # Negated clauses must not match whatever the default operator.
+        self.assertEqual(query_string('shirt NOT red'), ['2'])
+        self.assertEqual(query_string('shirt AND NOT red'), ['2'])
+        self.assertEqual(query_string('shirt -blue trousers'), ['1', '3'])
+        self.assertEqual(query_string('NOT shirt'), ['3'])
+        self.assertEqual(query_string('+shirt red'), ['1', '2'])
+        self.assertEqual(query_string('red blue', default_operator='AND'), [])
+        self.assertEqual(query_string('(red OR blue) AND shirt'), ['1', '2'])
+        self.assertEqual(query_string('red AND shirt trousers'), ['1'])
+        self.assertEqual(query_string('gre*'), ['3'])
+        self.assertEqual(query_string('category:trousers OR price:10'), ['1', '3'])
+
+    def test_response_size(self):
+        self.assertIs(self.backend.response_sizes, self.backend.conn.transport.deserializer)
+        response = self.backend.conn.search(index=self.backend.index_name, body={'query': {'match_all': {}}})
+        self.assertEqual(self.backend.response_sizes.size, len(json.dumps(response)))
+
+    def test_remove(self):
+        self.backend.remove(self.products[0])
+        self.assertEqual(self.sqs().count(), 2)
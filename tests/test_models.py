@@ -8,7 +8,18 @@ test_django-haystack-es
 Tests for `django-haystack-es` models module.
 """
 
+import pickle
+from datetime import datetime
+
 from django.test import TestCase
+from django.utils import timezone
+
+from haystack import connections
+
+from haystack_es.models import LazySearchResult
+from haystack_es.query import SearchQuerySet
+
+from .models import Product
 
 
 class TestHaystack_es(TestCase):
@@ -21,3 +32,33 @@ class TestHaystack_es(TestCase):
 
     def tearDown(self):
         pass
+
+
+class TestLazySearchResult(TestCase):
+
+    def setUp(self):
+        self.backend = connections['memory'].get_backend()
+        self.backend.clear()
+        index = connections['memory'].get_unified_index().get_index(Product)
+        self.backend.update(index, [
+            Product(pk=1, name='Red shirt', category='shirts', price=10,
+                    created=timezone.make_aware(datetime(2017, 1, 10))),
+        ])
+
+    def test_fields_are_converted_on_access(self):
+        result = SearchQuerySet(using='memory').result_class(LazySearchResult)[0]
+        self.assertIsInstance(result, LazySearchResult)
+        self.assertIsNone(result._converted)
+        self.assertEqual(result.pk, '1')
+        self.assertEqual(result.name, 'Red shirt')
+        self.assertEqual(result.created, datetime(2017, 1, 10))
+        self.assertEqual(sorted(result._converted), ['created', 'name'])
+        self.assertIsNone(result.missing)
+        self.assertEqual(result.get_additional_fields()['price'], 10.0)
+        self.assertFalse(hasattr(result, '__dict__'))
+
+    def test_pickle(self):
+        result = SearchQuerySet(using='memory').result_class(LazySearchResult)[0]
+        restored = pickle.loads(pickle.dumps(result))
+        self.assertEqual(restored.name, 'Red shirt')
+        self.assertEqual(restored.get_additional_fields(), result.get_additional_fields())
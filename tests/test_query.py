@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_django-haystack-es
+------------
+
+Tests for `django-haystack-es` query module.
+"""
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+
+from haystack import connections
+from haystack.exceptions import SearchBackendError
+from mock import Mock, patch
+
+from haystack_es import memory
+from haystack_es.aggregations import (Cardinality, ExtendedStats, GeoBoundsResult, GeoCentroid,
+                                      GeoCentroidResult, Histogram, Nested, Percentiles, Stats, StatsResult)
+from haystack_es.fields import GeometryField, LazyGeometry, LazyPoint
+from haystack_es.query import SearchQuerySet
+from haystack_es.reconcile import ReconcileResult, find_missing, reconcile
+from haystack_es.signals import saved_searches_matched
+from haystack_es.templates import SearchTemplate
+
+from .models import Product
+
+
+def product_search(q, category):
+    return SearchQuerySet(using='memory').filter(content=q, category__exact=category).order_by('price')
+
+
+class QueryTestCase(TestCase):
+
+    def setUp(self):
+        self.backend = connections['memory'].get_backend()
+        self.backend.clear()
+        self.index = connections['memory'].get_unified_index().get_index(Product)
+        self.products = [
+            Product.objects.create(name='product %s' % i, category='category %s' % (i % 3), price=i)
+            for i in range(25)
+        ]
+        self.backend.update(self.index, self.products)
+
+    def sqs(self):
+        return SearchQuerySet(using='memory').order_by('price')
+
+
+class TestBatchLoad(QueryTestCase):
+
+    def test_one_query_per_page(self):
+        results = self.sqs().batch_load()
+        with self.assertNumQueries(1):
+            self.assertEqual([r.object for r in results[:10]], self.products[:10])
+
+    def test_missing_objects_are_kept(self):
+        self.products[0].delete()
+        results = self.sqs().batch_load()[:3]
+        self.assertEqual(len(results), 3)
+        self.assertEqual([r.object for r in results[1:]], self.products[1:3])
+
+    def test_concurrent_prefetches_next_page(self):
+        results = self.sqs().batch_load(concurrent=True)
+        with self.assertNumQueries(3):
+            self.assertEqual([r.object for r in results], self.products)
+
+
+class TestPrefetch(QueryTestCase):
+
+    def test_lookahead(self):
+        results = self.sqs().prefetch(depth=2)
+        iterator = iter(results)
+        self.assertEqual(next(iterator).price, 0)
+        self.assertEqual(sorted(results.query._prefetched), [(10, 20), (20, 30)])
+        with patch.object(self.backend, 'search', wraps=self.backend.search) as search:
+            self.assertEqual([r.price for r in iterator], list(range(1, 25)))
+        self.assertEqual(search.call_count, 0)
+        self.assertEqual(results.query._prefetched, {})
+
+    def test_cancelled_on_early_exit(self):
+        results = self.sqs().prefetch()
+        for result in results:
+            break
+        self.assertEqual(results.query._prefetched, {})
+
+    def test_negative_depth(self):
+        with self.assertRaises(ValueError):
+            self.sqs().prefetch(depth=-1)
+
+    def test_unused_prefetch_cancelled(self):
+        query = self.sqs().query
+        query.set_limits(0, 10)
+        future = Mock()
+        query._prefetched[(0, 10)] = (query._clone(), future)
+        query.run(spelling_query='product')
+        future.cancel.assert_called_once_with()
+        self.assertEqual(query._prefetched, {})
+        self.assertEqual(len(query._results), 10)
+
+
+class TestSuggestComplete(QueryTestCase):
+
+    def test_suggest_complete(self):
+        suggestions = SearchQuerySet(using='memory').models(Product).suggest_complete('product 1', size=3)
+        self.assertEqual([s.suggestion for s in suggestions], ['product 1', 'product 10', 'product 11'])
+        self.assertEqual(suggestions[0].pk, str(self.products[1].pk))
+        self.assertEqual(suggestions[0].name_suggest, 'product 1')
+        self.assertIsNone(suggestions[0].name)
+
+
+class TestInnerHits(QueryTestCase):
+
+    def test_only_matching_variants_are_returned(self):
+        product = self.products[0]
+        product.variants = [
+            {'color': 'red', 'size': 's'},
+            {'color': 'red', 'size': 'xl'},
+            {'color': 'blue', 'size': 'xl'},
+        ]
+        self.backend.update(self.index, [product])
+        results = SearchQuerySet(using='memory').filter(
+            **{'variants>color__exact': 'red', 'variants>size__exact': 'xl'}
+        ).inner_hits('variants', fields=['size'])
+        self.assertEqual([r.pk for r in results], [str(product.pk)])
+        self.assertEqual(results[0].variants, [{'size': 'xl'}])
+
+
+class TestFlattenedDict(QueryTestCase):
+
+    def test_filter_and_read_back(self):
+        product = self.products[0]
+        product.tags = {'color': 'red', 'sizes': ['s', 'm'], 'shipping': {'days': 2}}
+        self.backend.update(self.index, [product])
+        results = SearchQuerySet(using='memory').filter(tags__exact='shipping.days=2')
+        self.assertEqual([r.pk for r in results], [str(product.pk)])
+        self.assertEqual(results[0].tags, {'color': 'red', 'sizes': ['m', 's'], 'shipping.days': '2'})
+
+
+class TestCollapse(QueryTestCase):
+
+    def test_one_result_per_group(self):
+        with patch.object(self.backend.conn, 'search', wraps=self.backend.conn.search) as search:
+            results = self.sqs().collapse('category', size=2)
+            self.assertEqual(results.count(), 3)
+            page = list(results[:10])
+            self.assertEqual(search.call_count, 2)
+        self.assertEqual([r.pk for r in page], [str(p.pk) for p in self.products[:3]])
+        self.assertEqual([r.category for r in page], ['category 0', 'category 1', 'category 2'])
+        self.assertEqual([m.pk for m in page[1].group_members],
+                         [str(self.products[1].pk), str(self.products[4].pk)])
+
+    def test_without_group_members(self):
+        results = list(self.sqs().filter(price__gte=20).collapse('category'))
+        self.assertEqual([r.price for r in results], [20.0, 21.0, 22.0])
+        self.assertIsNone(results[0].group_members)
+
+
+class TestBudget(QueryTestCase):
+
+    def test_terminate_after(self):
+        results = self.sqs().budget(terminate_after=5)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(results.timed_out())
+        self.assertFalse(self.sqs().timed_out())
+        self.assertFalse(results.degraded())
+
+
+class TestRemove(QueryTestCase):
+
+    def test_remove_queryset(self):
+        with patch.object(self.backend, 'batch_size', 4), \
+                patch.object(self.backend.conn, 'bulk', wraps=self.backend.conn.bulk) as bulk, \
+                self.assertNumQueries(1):
+            deleted = self.backend.remove(Product.objects.filter(price__lt=10))
+        self.assertEqual(deleted, 10)
+        self.assertEqual(bulk.call_count, 3)
+        self.assertEqual(self.sqs().count(), 15)
+
+    def test_remove_iterable(self):
+        deleted = self.backend.remove(self.products[:2] + ['tests.product.0'])
+        self.assertEqual(deleted, 2)
+        self.assertEqual(self.sqs().count(), 23)
+
+    def test_remove_by_query(self):
+        with patch.object(self.backend.conn, 'delete_by_query',
+                          wraps=self.backend.conn.delete_by_query) as delete_by_query:
+            response = self.backend.remove_by_query(self.sqs().filter(category__exact='category 0'), slices=2,
+                                                    requests_per_second=500)
+        self.assertEqual(response['deleted'], 9)
+        self.assertEqual(delete_by_query.call_args[1]['slices'], 2)
+        self.assertEqual(delete_by_query.call_args[1]['requests_per_second'], 500)
+        self.assertEqual(self.sqs().count(), 16)
+
+    def test_clear_models(self):
+        self.backend.clear(models=[Product])
+        self.assertEqual(self.sqs().count(), 0)
+
+
+class TestReconcile(QueryTestCase):
+
+    def setUp(self):
+        super(TestReconcile, self).setUp()
+        self.backend.remove(self.products[:3])
+        Product.objects.filter(pk__in=[product.pk for product in self.products[-2:]]).delete()
+
+    def test_reconcile(self):
+        with patch.object(self.backend.conn, 'mget', wraps=self.backend.conn.mget) as mget, \
+                patch.object(self.backend.conn, 'scroll', wraps=self.backend.conn.scroll) as scroll:
+            result = reconcile(self.backend, self.index, batch_size=10)
+        self.assertEqual(result, ReconcileResult(objects=23, documents=25, missing=3, stale=2))
+        self.assertEqual(mget.call_count, 3)
+        self.assertEqual(scroll.call_count, 3)
+        self.assertEqual(sorted(int(result.pk) for result in self.sqs()[:30]),
+                         sorted(Product.objects.values_list('pk', flat=True)))
+        self.assertEqual(reconcile(self.backend, self.index), ReconcileResult(23, 23, 0, 0))
+
+    def test_find_missing_pages_by_pk(self):
+        with self.assertNumQueries(5):
+            missing = list(find_missing(self.backend, self.index, batch_size=5))
+        self.assertEqual(missing, [product.pk for product in self.products[:3]])
+
+    def test_command_dry_run(self):
+        out = StringIO()
+        call_command('es_reconcile', 'tests', using='memory', dry_run=True, stdout=out)
+        self.assertEqual(out.getvalue().strip(),
+                         'tests.product: 23 objects, 22 documents, 3 missing to reindex, 2 stale to remove')
+        self.assertEqual(self.sqs().count(), 22)
+
+
+class TestPercolator(QueryTestCase):
+
+    def setUp(self):
+        super(TestPercolator, self).setUp()
+        self.backend.conn.indices.delete(index=self.backend.percolator_index_name, ignore=404)
+        self.backend.percolator_setup_complete = False
+        self.backend.save_search('expensive', SearchQuerySet(using='memory').filter(price__gte=20))
+        self.backend.save_search('category-1',
+                                 SearchQuerySet(using='memory').filter(category__exact='category 1'))
+
+    def test_percolate(self):
+        documents = [self.index.full_prepare(product) for product in self.products[20:23]]
+        self.assertEqual([sorted(ids) for ids in self.backend.percolate(documents)],
+                         [['expensive'], ['expensive'], ['category-1', 'expensive']])
+        self.backend.delete_saved_search('expensive')
+        self.assertEqual(self.backend.percolate(documents), [[], [], ['category-1']])
+
+    def test_percolate_on_update(self):
+        matched = []
+
+        def receiver(sender, **kwargs):
+            matched.append(kwargs['matches'])
+
+        saved_searches_matched.connect(receiver)
+        try:
+            with patch.object(self.backend, 'percolate_on_update', True), \
+                    patch.object(self.backend.conn, 'msearch', wraps=self.backend.conn.msearch) as msearch:
+                self.backend.update(self.index, self.products[:3])
+        finally:
+            saved_searches_matched.disconnect(receiver)
+        self.assertEqual(msearch.call_count, 1)
+        self.assertEqual(matched, [{'tests.product.%s' % self.products[1].pk: ['category-1']}])
+
+
+class TestPreference(QueryTestCase):
+
+    def test_preference(self):
+        sqs = self.sqs().preference('session-1')
+        self.assertEqual(sqs._clone().query.build_params()['preference'], 'session-1')
+        self.assertNotIn('preference', self.sqs().query.build_params())
+        with patch.object(self.backend.conn, 'search', wraps=self.backend.conn.search) as search:
+            self.assertEqual(len(sqs.filter(price__lt=5)), 5)
+        self.assertEqual(search.call_args[1]['preference'], 'session-1')
+
+
+class TestGeo(QueryTestCase):
+
+    def setUp(self):
+        super(TestGeo, self).setUp()
+        locations = [(57.64911, 10.40744), (57.6, 10.5), {'lat': 52.5, 'lon': 13.4}]
+        for product, location in zip(self.products, locations):
+            product.location = location
+        self.backend.update(self.index, self.products[:3])
+
+    def test_aggregations(self):
+        cells = self.sqs().geohash_grid('location', precision=3, center=GeoCentroid('location'))
+        self.assertEqual([(cell.key, cell.doc_count) for cell in cells], [('u4p', 2), ('u33', 1)])
+        self.assertAlmostEqual(cells[0].aggregations['center'].lon, 10.45372)
+        self.assertEqual(self.sqs().geo_bounds('location'),
+                         GeoBoundsResult(top_left=(57.64911, 10.40744), bottom_right=(52.5, 13.4)))
+        self.assertEqual(self.sqs().filter(price__gt=1).geo_centroid('location'),
+                         GeoCentroidResult(52.5, 13.4))
+        self.assertIsNone(self.sqs().filter(price__gt=5).geo_bounds('location'))
+
+    def test_lazy_geometries(self):
+        location = self.sqs()[0].location
+        self.assertIsInstance(location, LazyPoint)
+        self.assertEqual((location.lat, location.lon), (57.64911, 10.40744))
+        self.assertEqual(location.coords, (10.40744, 57.64911))
+        self.assertIsNone(self.sqs()[5].location)
+        self.assertEqual(len({location, LazyPoint(57.64911, 10.40744)}), 1)
+        # A GEOS point stand-in, GEOS may not be installed.
+        point = type('Point', (object,), {'geom_type': 'Point', 'coords': (10.40744, 57.64911)})()
+        self.assertEqual(location, point)
+        self.assertNotEqual(location, LazyPoint(57.64911, 10.4))
+
+        field = GeometryField(model_attr='shape')
+        shape = {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]}
+        geometry = field.convert(field.prepare(type('Shape', (object,), {'shape': shape})))
+        self.assertIsInstance(geometry, LazyGeometry)
+        self.assertEqual((geometry.type, geometry.coordinates), ('polygon', shape['coordinates']))
+
+
+class TestSearchTemplates(QueryTestCase):
+
+    def setUp(self):
+        super(TestSearchTemplates, self).setUp()
+        patcher = patch.object(self.backend, 'search_templates', {
+            'product_search': SearchTemplate('product_search', 'tests.test_query.product_search')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_compile(self):
+        compiled = self.backend.get_search_template('product_search')
+        self.assertEqual(compiled.params, ('q', 'category'))
+        self.assertEqual(compiled.escaped, frozenset(['q']))
+        for param in ('{{q}}', '{{category}}', '{{haystack_from}}', '{{haystack_size}}'):
+            self.assertIn(param, compiled.source)
+        self.assertTrue(compiled.id.startswith('%s-product_search-' % self.backend.index_name))
+
+    def test_search(self):
+        sqs = SearchQuerySet(using='memory').template('product_search', q='product', category='category 1')
+        with patch.object(self.backend.conn, 'search_template',
+                          wraps=self.backend.conn.search_template) as search_template:
+            results = sqs[1:3]
+        self.assertEqual([result.price for result in results], [4.0, 7.0])
+        self.assertEqual(sqs.count(), 8)
+        body = search_template.call_args[1]['body']
+        self.assertEqual(sorted(body), ['id', 'params'])
+        self.assertEqual(body['params']['haystack_from'], 1)
+        self.assertEqual(body['params']['haystack_size'], 2)
+
+    def test_lost_template_is_stored_again(self):
+        sqs = SearchQuerySet(using='memory').template('product_search', q='product', category='category 1')
+        self.assertEqual(sqs.count(), 8)
+        memory._templates.clear()
+        with patch.object(self.backend.conn, 'put_template', wraps=self.backend.conn.put_template) as put:
+            self.assertEqual(sqs.all().count(), 8)
+        self.assertEqual(put.call_count, 1)
+
+    def test_escaping_and_missing_parameters(self):
+        sqs = SearchQuerySet(using='memory').template('product_search', q='product (', category='category 1')
+        self.assertEqual(sqs.query.build_params()['template'][1]['q'], 'product \\(')
+        with self.assertRaises(SearchBackendError):
+            len(SearchQuerySet(using='memory').template('product_search', q='product'))
+
+
+class TestAggregate(QueryTestCase):
+
+    def test_metrics(self):
+        with patch.object(self.backend.conn, 'search', wraps=self.backend.conn.search) as search:
+            values = self.sqs().filter(price__lt=10).aggregate(
+                price=Stats('price'), spread=ExtendedStats('price'), categories=Cardinality('category'),
+                median=Percentiles('price', percents=[50]))
+            self.assertEqual(search.call_count, 1)
+            self.assertEqual(search.call_args[1]['body']['size'], 0)
+        self.assertEqual(values['price'], StatsResult(count=10, min=0.0, max=9.0, avg=4.5, sum=45.0))
+        self.assertEqual(values['spread'].sum_of_squares, 285.0)
+        self.assertAlmostEqual(values['spread'].variance, 8.25)
+        self.assertEqual(values['categories'], 3)
+        self.assertEqual(list(values['median'].items()), [(50.0, 4.5)])
+
+    def test_buckets(self):
+        product = self.products[0]
+        product.variants = [{'size': 's', 'price': 2.0}, {'size': 'xl', 'price': 4.0}]
+        self.backend.update(self.index, [product])
+        values = self.sqs().aggregate(
+            prices=Histogram('price', 10, aggregations={'categories': Cardinality('category')}),
+            variants=Nested('variants', {'price': Stats('variants.price')}))
+        self.assertEqual([(b.key, b.doc_count) for b in values['prices']], [(0.0, 10), (10.0, 10), (20.0, 5)])
+        self.assertEqual(values['prices'][2].aggregations, {'categories': 3})
+        self.assertEqual(values['variants'].doc_count, 2)
+        self.assertEqual(values['variants'].aggregations['price'].avg, 3.0)
+
+    def test_not_an_aggregation(self):
+        with self.assertRaises(TypeError):
+            self.sqs().aggregate(price={'stats': {'field': 'price'}})
+
+
+class TestFilterChain(QueryTestCase):
+
+    def test_clones_share_compiled_filters(self):
+        base = self.sqs().filter(category__exact='category 1')
+        first = base.filter(price__gte=3)
+        second = base.filter(price__gte=3)
+        self.assertIs(first.query.filter_chain.parent, base.query.filter_chain)
+        self.assertEqual(first.query.filter_chain, second.query.filter_chain)
+        self.assertEqual(hash(first.query.filter_chain), hash(second.query.filter_chain))
+
+        compile_filter = self.backend.compile_filter
+        with patch.object(self.backend, 'compile_filter', wraps=compile_filter) as compile_filter:
+            self.assertEqual(len(first), 7)
+            self.assertEqual(len(base.filter(name__startswith='product')), 8)
+        self.assertEqual(compile_filter.call_count, 3)
+
+    def test_duplicate_filters(self):
+        sqs = self.sqs().filter(category__exact='category 1').filter(category__exact='category 1')
+        self.assertEqual(len(sqs.query.filter_chain), 1)
+        self.assertEqual(len(sqs.query.filter_chain.compile(self.backend)), 1)
+        combined = sqs & self.sqs().filter(category__exact='category 1', price__gte=3)
+        self.assertEqual(len(combined.query.filter_chain), 2)
+
+    def test_compiled_per_connection(self):
+        chain = self.sqs().filter(category__exact='category 1').query.filter_chain
+        other = connections['default'].get_backend()
+        with patch.object(other, 'compile_filter', return_value='other') as compile_filter:
+            self.assertEqual(chain.compile(other), ['other'])
+        self.assertEqual(compile_filter.call_count, 1)
+        self.assertNotEqual(chain.compile(self.backend), ['other'])
+
+
+class TestLazySpelling(QueryTestCase):
+
+    def setUp(self):
+        super(TestLazySpelling, self).setUp()
+        patcher = patch.multiple(self.backend, include_spelling=True, spelling_mode='lazy',
+                                 spelling_field='name', spelling_threshold=1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_suggestion_on_demand(self):
+        with patch.object(self.backend.conn, 'search', wraps=self.backend.conn.search) as search:
+            sqs = self.sqs().filter(content='product')
+            self.assertEqual(len(sqs), 25)
+            self.assertNotIn('suggest', search.call_args[1]['body'])
+            self.assertEqual(sqs.spelling_suggestion(), 'product')
+            self.assertEqual(sqs.spelling_suggestion('prodct'), 'product')
+            self.assertEqual(search.call_count, 3)
+
+            # Cached per query string.
+            self.assertEqual(sqs.spelling_suggestion('prodct'), 'product')
+            self.assertEqual(search.call_count, 3)
+
+    def test_suggestion_below_threshold(self):
+        with patch.object(self.backend.conn, 'search', wraps=self.backend.conn.search) as search:
+            sqs = self.sqs().filter(content='prodct')
+            self.assertEqual(len(sqs), 0)
+            self.assertEqual(search.call_count, 2)
+            self.assertEqual(sqs.spelling_suggestion(), 'product')
+            self.assertEqual(search.call_count, 2)